@@ -1,5 +1,6 @@
 __author__ = 'chris'
 
+import errno
 import json
 import os
 import obelisk
@@ -14,21 +15,25 @@ from twisted.web import server
 from twisted.web.resource import NoResource
 from twisted.web import http
 from twisted.web.server import Site
-from twisted.internet import defer, reactor, task
-from twisted.protocols.basic import FileSender
+from twisted.internet import reactor, task
 
 from config import DATA_FOLDER, RESOLVER, delete_value, set_value, get_value, str_to_bool, TRANSACTION_FEE, \
     SERVER_VERSION
 from protos.countries import CountryCode
 from protos import objects
 from keys import blockchainid
+from keys import cryptopool
+from keys import verification
 from keys.keychain import KeyChain
 from dht.utils import digest
 from market.profile import Profile
+from db.contracts import PURCHASES_UNFUNDED, PURCHASES_IN_PROGRESS, PURCHASES_TRADE_RECEIPTS, \
+    SALES_UNFUNDED, SALES_IN_PROGRESS, SALES_TRADE_RECEIPTS, CASES
 from market.contracts import Contract, check_order_for_payment
 from market.btcprice import BtcPrice
 from net.upnp import PortMapper
 from api.utils import sanitize_html
+from log import Logger
 from market.migration import migratev2
 from twisted.web import static
 
@@ -70,6 +75,7 @@ class OpenBazaarAPI(APIResource):
         self.password = password
         self.authenticated_sessions = authenticated_sessions
         self.failed_login_attempts = {}
+        self.log = Logger(system=self)
         task.LoopingCall(self._keep_sessions_alive).start(890, False)
         APIResource.__init__(self)
 
@@ -86,6 +92,13 @@ class OpenBazaarAPI(APIResource):
         else:
             self.failed_login_attempts[host] = 1
 
+    def _query_failed(self, failure, request):
+        # database calls run on a thread pool so their errors no longer reach twisted.web
+        self.log.error("%s failed: %s" % (request.path, failure.getErrorMessage()))
+        request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+        request.write(json.dumps({}))
+        request.finish()
+
     @POST('^/api/v1/login')
     def login(self, request):
         request.setHeader('content-type', "application/json")
@@ -110,42 +123,65 @@ class OpenBazaarAPI(APIResource):
     @GET('^/api/v1/get_image')
     @authenticated
     def get_image(self, request):
-        @defer.inlineCallbacks
-        def _showImage(resp=None):
-            @defer.inlineCallbacks
-            def _setContentDispositionAndSend(file_path, extension, content_type):
-                request.setHeader('content-disposition', 'filename="%s.%s"' % (file_path, extension))
-                request.setHeader('content-type', content_type)
-                request.setHeader('cache-control', 'max-age=604800')
-
-                f = open(file_path, "rb")
-                yield FileSender().beginFileTransfer(f, request)
-                f.close()
-                defer.returnValue(0)
+        def _sendImage(image):
+            request.setHeader('content-disposition', 'filename="%s.jpg"' % image_hash)
+            request.setHeader('content-type', "image/jpeg")
+            request.setHeader('cache-control', 'max-age=604800')
+            request.write(image)
+            request.finish()
 
-            if os.path.exists(image_path):
-                yield _setContentDispositionAndSend(image_path, "jpg", "image/jpeg")
-            else:
-                request.setResponseCode(http.NOT_FOUND)
-                request.write("No such image '%s'" % request.path)
+        def _readImage(image_path):
+            with open(image_path, "rb") as f:
+                return f.read()
+
+        def _cacheImage(image):
+            self.db.filecache.put(image_hash, image)
+            _sendImage(image)
+
+        def _notFound():
+            request.setResponseCode(http.NOT_FOUND)
+            request.write("No such image '%s'" % request.path)
             request.finish()
 
-        if "hash" in request.args and len(request.args["hash"][0]) == 40:
-            if self.db.filemap.get_file(request.args["hash"][0]) is not None:
-                image_path = self.db.filemap.get_file(request.args["hash"][0])
+        def _readFailed(failure):
+            # the file can vanish between the exists check and the read
+            if failure.check(IOError) and failure.value.errno == errno.ENOENT:
+                _notFound()
+            else:
+                request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+                request.write("Failed to read image '%s'" % request.path)
+                request.finish()
+
+        def _showImage(image_path):
+            if os.path.exists(image_path):
+                self.db.deferred.run(_readImage, image_path).addCallbacks(_cacheImage, _readFailed)
             else:
-                image_path = os.path.join(DATA_FOLDER, "cache", request.args["hash"][0])
+                _notFound()
+
+        def _locateImage(image_path):
+            if image_path is None:
+                image_path = os.path.join(DATA_FOLDER, "cache", image_hash)
             if not os.path.exists(image_path) and "guid" in request.args:
                 node = None
                 for connection in self.protocol.values():
                     if connection.handler.node is not None and \
                                     connection.handler.node.id == unhexlify(request.args["guid"][0]):
                         node = connection.handler.node
-                        self.mserver.get_image(node, unhexlify(request.args["hash"][0])).addCallback(_showImage)
+                        self.mserver.images.fetch(node, unhexlify(image_hash), visible=True).addCallback(
+                            lambda _: _showImage(image_path))
                 if node is None:
-                    _showImage()
+                    _showImage(image_path)
+            else:
+                _showImage(image_path)
+
+        if "hash" in request.args and len(request.args["hash"][0]) == 40:
+            image_hash = request.args["hash"][0]
+            cached = self.db.filecache.get(image_hash)
+            if cached is not None:
+                _sendImage(cached)
             else:
-                _showImage()
+                self.db.deferred.filemap.get_file(image_hash).addCallbacks(_locateImage, self._query_failed,
+                                                                           errbackArgs=(request,))
         else:
             request.write(NoResource().render(request))
             request.finish()
@@ -596,7 +632,7 @@ class OpenBazaarAPI(APIResource):
             for keyword in request.args["keywords"]:
                 if keyword != "":
                     self.kserver.set(digest(keyword.lower()), unhexlify(c.get_contract_id()),
-                                     self.kserver.node.getProto().SerializeToString())
+                                     self.kserver.node.getSerializedProto())
             request.write(json.dumps({"success": True, "id": c.get_contract_id()}))
             request.finish()
             return server.NOT_DONE_YET
@@ -646,7 +682,7 @@ class OpenBazaarAPI(APIResource):
             return server.NOT_DONE_YET
         else:
             for vendor in self.protocol.vendors.values():
-                self.db.vendors.save_vendor(vendor.id.encode("hex"), vendor.getProto().SerializeToString())
+                self.db.vendors.save_vendor(vendor.id.encode("hex"), vendor.getSerializedProto())
             PortMapper().clean_my_mappings(self.kserver.node.port)
             self.protocol.shutdown()
             reactor.stop()
@@ -745,10 +781,9 @@ class OpenBazaarAPI(APIResource):
                 else:
                     request.write(json.dumps({"success": False, "reason": success}))
                     request.finish()
-            file_name = request.args["id"][0] + ".json"
-            file_path = os.path.join(DATA_FOLDER, "store", "contracts", "in progress", file_name)
-            with open(file_path, 'r') as filename:
-                order = json.load(filename, object_pairs_hook=OrderedDict)
+            if self.db.contracts.get_folder(request.args["id"][0]) != SALES_IN_PROGRESS:
+                raise Exception("Order is not in progress")
+            order = self.db.contracts.load(request.args["id"][0])
             c = Contract(self.db, contract=order, testnet=self.protocol.testnet)
             if "vendor_order_confirmation" not in c.contract:
                 c.add_order_confirmation(self.protocol.blockchain,
@@ -785,6 +820,7 @@ class OpenBazaarAPI(APIResource):
                     with open(os.path.join(DATA_FOLDER, "store", "media", hash_value), 'wb') as outfile:
                         outfile.write(img)
                     self.db.filemap.insert(hash_value, os.path.join("store", "media", hash_value))
+                    self.db.filecache.invalidate(hash_value)
                     ret.append(hash_value)
             elif "avatar" in request.args:
                 avi = request.args["avatar"][0].decode("base64")
@@ -792,6 +828,7 @@ class OpenBazaarAPI(APIResource):
                 with open(os.path.join(DATA_FOLDER, "store", "avatar"), 'wb') as outfile:
                     outfile.write(avi)
                 self.db.filemap.insert(hash_value, os.path.join("store", "avatar"))
+                self.db.filecache.invalidate(hash_value)
                 ret.append(hash_value)
             elif "header" in request.args:
                 hdr = request.args["header"][0].decode("base64")
@@ -799,6 +836,7 @@ class OpenBazaarAPI(APIResource):
                 with open(os.path.join(DATA_FOLDER, "store", "header"), 'wb') as outfile:
                     outfile.write(hdr)
                 self.db.filemap.insert(hash_value, os.path.join("store", "header"))
+                self.db.filecache.invalidate(hash_value)
                 ret.append(hash_value)
             request.write(json.dumps({"success": True, "image_hashes": ret}, indent=4))
             request.finish()
@@ -818,11 +856,7 @@ class OpenBazaarAPI(APIResource):
             else:
                 request.write(json.dumps({"success": False, "reason": success}))
                 request.finish()
-        file_path = os.path.join(DATA_FOLDER, "purchases", "in progress", request.args["id"][0] + ".json")
-        if not os.path.exists(file_path):
-            file_path = os.path.join(DATA_FOLDER, "purchases", "trade receipts", request.args["id"][0] + ".json")
-        with open(file_path, 'r') as filename:
-            order = json.load(filename, object_pairs_hook=OrderedDict)
+        order = self.db.contracts.load(request.args["id"][0])
         c = Contract(self.db, contract=order, testnet=self.protocol.testnet)
         if "buyer_receipt" not in c.contract:
             c.add_receipt(True,
@@ -1007,6 +1041,30 @@ class OpenBazaarAPI(APIResource):
         request.finish()
         return server.NOT_DONE_YET
 
+    @GET('^/api/v1/stats')
+    @authenticated
+    def get_stats(self, request):
+        stats = {
+            "dht_storage": self.kserver.storage.get_stats(),
+            "dht_lookups": {
+                "values": self.kserver.valueCache.get_stats(),
+                "nodes": self.kserver.nodeCache.get_stats()
+            },
+            "database": self.db.pool.get_stats(),
+            "crypto_pool": cryptopool.pool.get_stats(),
+            "database_threads": self.db.deferred.get_stats(),
+            "file_cache": self.db.filecache.get_stats(),
+            "image_fetches": self.mserver.images.get_stats(),
+            "republisher": self.mserver.republisher.get_stats(),
+            "broadcast": self.mserver.last_broadcast.get_progress() if self.mserver.last_broadcast else None,
+            "signature_cache": verification.cache.get_stats(),
+            "contracts": self.db.contracts.get_stats()
+        }
+        request.setHeader('content-type', "application/json")
+        request.write(json.dumps(stats, indent=4))
+        request.finish()
+        return server.NOT_DONE_YET
+
     @GET('^/api/v1/get_notifications')
     @authenticated
     def get_notifications(self, request):
@@ -1053,8 +1111,12 @@ class OpenBazaarAPI(APIResource):
     @authenticated
     def broadcast(self, request):
         try:
-            def get_response(num):
-                request.write(json.dumps({"success": True, "peers reached": num}, indent=4))
+            def get_response(progress):
+                request.write(json.dumps({"success": True,
+                                          "peers reached": progress["reached"],
+                                          "followers": progress["followers"],
+                                          "seconds": progress["seconds"],
+                                          "per second": progress["per_second"]}, indent=4))
                 request.finish()
             self.mserver.broadcast(request.args["message"][0]).addCallback(get_response)
             return server.NOT_DONE_YET
@@ -1124,54 +1186,59 @@ class OpenBazaarAPI(APIResource):
     @GET('^/api/v1/get_sales')
     @authenticated
     def get_sales(self, request):
+        def respond(sales):
+            sales_list = []
+            for sale in sales:
+                sale_json = {
+                    "order_id": sale[0],
+                    "title": sale[1],
+                    "description": sale[2],
+                    "timestamp": sale[3],
+                    "btc_total": sale[4],
+                    "status": sale[5],
+                    "thumbnail_hash": sale[6],
+                    "buyer": sale[7],
+                    "contract_type": sale[8],
+                    "unread": sale[9],
+                    "status_changed": False if sale[10] == 0 else True
+                }
+                sales_list.append(sale_json)
+            request.setHeader('content-type', "application/json")
+            request.write(json.dumps(sanitize_html(sales_list), indent=4))
+            request.finish()
+
         if "status" in request.args:
-            sales = self.db.sales.get_by_status(request.args["status"][0])
+            d = self.db.deferred.sales.get_by_status(request.args["status"][0])
         else:
-            sales = self.db.sales.get_all()
-        sales_list = []
-        for sale in sales:
-            sale_json = {
-                "order_id": sale[0],
-                "title": sale[1],
-                "description": sale[2],
-                "timestamp": sale[3],
-                "btc_total": sale[4],
-                "status": sale[5],
-                "thumbnail_hash": sale[6],
-                "buyer": sale[7],
-                "contract_type": sale[8],
-                "unread": sale[9],
-                "status_changed": False if sale[10] == 0 else True
-            }
-            sales_list.append(sale_json)
-        request.setHeader('content-type', "application/json")
-        request.write(json.dumps(sanitize_html(sales_list), indent=4))
-        request.finish()
+            d = self.db.deferred.sales.get_all()
+        d.addCallbacks(respond, self._query_failed, errbackArgs=(request,))
         return server.NOT_DONE_YET
 
     @GET('^/api/v1/get_purchases')
     @authenticated
     def get_purchases(self, request):
-        purchases = self.db.purchases.get_all()
-        purchases_list = []
-        for purchase in purchases:
-            purchase_json = {
-                "order_id": purchase[0],
-                "title": purchase[1],
-                "description": purchase[2],
-                "timestamp": purchase[3],
-                "btc_total": purchase[4],
-                "status": purchase[5],
-                "thumbnail_hash": purchase[6],
-                "vendor": purchase[7],
-                "contract_type": purchase[8],
-                "unread": purchase[9],
-                "status_changed": False if purchase[10] == 0 else True
-            }
-            purchases_list.append(purchase_json)
-        request.setHeader('content-type', "application/json")
-        request.write(json.dumps(sanitize_html(purchases_list), indent=4))
-        request.finish()
+        def respond(purchases):
+            purchases_list = []
+            for purchase in purchases:
+                purchase_json = {
+                    "order_id": purchase[0],
+                    "title": purchase[1],
+                    "description": purchase[2],
+                    "timestamp": purchase[3],
+                    "btc_total": purchase[4],
+                    "status": purchase[5],
+                    "thumbnail_hash": purchase[6],
+                    "vendor": purchase[7],
+                    "contract_type": purchase[8],
+                    "unread": purchase[9],
+                    "status_changed": False if purchase[10] == 0 else True
+                }
+                purchases_list.append(purchase_json)
+            request.setHeader('content-type', "application/json")
+            request.write(json.dumps(sanitize_html(purchases_list), indent=4))
+            request.finish()
+
+        self.db.deferred.purchases.get_all().addCallbacks(respond, self._query_failed, errbackArgs=(request,))
         return server.NOT_DONE_YET
 
     @POST('^/api/v1/check_for_payment')
@@ -1200,42 +1267,23 @@ class OpenBazaarAPI(APIResource):
         #TODO: if this is either a funded direct payment sale or complete moderated sale but
         #TODO: the payout tx has not hit the blockchain, rebroadcast.
 
-        filename = request.args["order_id"][0] + ".json"
-        if os.path.exists(os.path.join(DATA_FOLDER, "purchases", "unfunded", filename)):
-            file_path = os.path.join(DATA_FOLDER, "purchases", "unfunded", filename)
-            status = self.db.purchases.get_status(request.args["order_id"][0])
-            self.db.purchases.status_changed(request.args["order_id"][0], 0)
-        elif os.path.exists(os.path.join(DATA_FOLDER, "purchases", "in progress", filename)):
-            file_path = os.path.join(DATA_FOLDER, "purchases", "in progress", filename)
-            status = self.db.purchases.get_status(request.args["order_id"][0])
-            self.db.purchases.status_changed(request.args["order_id"][0], 0)
-        elif os.path.exists(os.path.join(DATA_FOLDER, "purchases", "trade receipts", filename)):
-            file_path = os.path.join(DATA_FOLDER, "purchases", "trade receipts", filename)
-            status = self.db.purchases.get_status(request.args["order_id"][0])
-            self.db.purchases.status_changed(request.args["order_id"][0], 0)
-        elif os.path.exists(os.path.join(DATA_FOLDER, "store", "contracts", "unfunded", filename)):
-            file_path = os.path.join(DATA_FOLDER, "store", "contracts", "unfunded", filename)
-            status = self.db.sales.get_status(request.args["order_id"][0])
-            self.db.sales.status_changed(request.args["order_id"][0], 0)
-        elif os.path.exists(os.path.join(DATA_FOLDER, "store", "contracts", "in progress", filename)):
-            file_path = os.path.join(DATA_FOLDER, "store", "contracts", "in progress", filename)
-            status = self.db.sales.get_status(request.args["order_id"][0])
-            self.db.sales.status_changed(request.args["order_id"][0], 0)
-        elif os.path.exists(os.path.join(DATA_FOLDER, "store", "contracts", "trade receipts", filename)):
-            file_path = os.path.join(DATA_FOLDER, "store", "contracts", "trade receipts", filename)
-            status = self.db.sales.get_status(request.args["order_id"][0])
-            self.db.sales.status_changed(request.args["order_id"][0], 0)
-        elif os.path.exists(os.path.join(DATA_FOLDER, "cases", filename)):
-            file_path = os.path.join(DATA_FOLDER, "cases", filename)
-            self.db.cases.status_changed(request.args["order_id"][0], 0)
+        order_id = request.args["order_id"][0]
+        folder = self.db.contracts.get_folder(order_id)
+        if folder in (PURCHASES_UNFUNDED, PURCHASES_IN_PROGRESS, PURCHASES_TRADE_RECEIPTS):
+            status = self.db.purchases.get_status(order_id)
+            self.db.purchases.status_changed(order_id, 0)
+        elif folder in (SALES_UNFUNDED, SALES_IN_PROGRESS, SALES_TRADE_RECEIPTS):
+            status = self.db.sales.get_status(order_id)
+            self.db.sales.status_changed(order_id, 0)
+        elif folder == CASES:
+            self.db.cases.status_changed(order_id, 0)
             status = 4
         else:
             request.write(json.dumps({}, indent=4))
             request.finish()
             return server.NOT_DONE_YET
 
-        with open(file_path, 'r') as filename:
-            order = json.load(filename, object_pairs_hook=OrderedDict)
+        order = self.db.contracts.load(order_id)
 
         if status == 0 or status == 2:
             check_order_for_payment(request.args["order_id"][0], self.db, self.protocol.blockchain,
@@ -1389,22 +1437,45 @@ class OpenBazaarAPI(APIResource):
     @GET('^/api/v1/get_ratings')
     @authenticated
     def get_ratings(self, request):
+        written = []
+
+        def write_batch(ratings):
+            # stream the JSON list out as each batch of ratings is verified
+            if not written:
+                request.setHeader('content-type', "application/json")
+            for rating in ratings:
+                request.write(("[\n" if not written else ",\n") + json.dumps(sanitize_html(rating), indent=4))
+                written.append(True)
+
         def parse_response(ratings):
-            if ratings is not None:
+            if written:
+                request.write("\n]")
+                request.finish()
+            elif ratings is not None:
                 request.setHeader('content-type', "application/json")
                 request.write(json.dumps(sanitize_html(ratings), indent=4))
                 request.finish()
             else:
                 request.write(json.dumps({}))
                 request.finish()
+
+        def parse_failed(failure):
+            # close the list if part of it has already gone out
+            if written:
+                request.write("\n]")
+            else:
+                request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+                request.write(json.dumps({}))
+            request.finish()
         if "guid" in request.args:
             def get_node(node):
                 if node is not None:
                     if "contract_id" in request.args and request.args["contract_id"][0] != "":
-                        self.mserver.get_ratings(node, unhexlify(request.args["contract_id"][0]))\
-                            .addCallback(parse_response)
+                        self.mserver.get_ratings(node, unhexlify(request.args["contract_id"][0]), write_batch)\
+                            .addCallbacks(parse_response, parse_failed)
                     else:
-                        self.mserver.get_ratings(node).addCallback(parse_response)
+                        self.mserver.get_ratings(node, on_batch=write_batch).addCallbacks(parse_response,
+                                                                                          parse_failed)
                 else:
                     request.write(json.dumps({}))
                     request.finish()
@@ -2,7 +2,6 @@ __author__ = 'chris'
 
 import ast
 import json
-import os
 import time
 from binascii import unhexlify
 from random import shuffle
@@ -13,7 +12,7 @@ from twisted.internet.protocol import Protocol, Factory, connectionDone
 from txws import WebSocketProtocol, WebSocketFactory
 
 from api.utils import smart_unicode, sanitize_html
-from config import DATA_FOLDER, str_to_bool
+from config import str_to_bool
 from dht.node import Node
 from keys.keychain import KeyChain
 from log import Logger
@@ -186,12 +185,8 @@ class WSProtocol(Protocol):
                                 listing_json["contract_type"] = str(Listings.ContractType.Name(l.contract_type))
                             for country in l.ships_to:
                                 listing_json["listing"]["ships_to"].append(str(CountryCode.Name(country)))
-                            if not os.path.isfile(os.path.join( \
-                                    DATA_FOLDER, 'cache', l.thumbnail_hash.encode("hex"))):
-                                self.factory.mserver.get_image(node, l.thumbnail_hash)
-                            if not os.path.isfile(os.path.join( \
-                                    DATA_FOLDER, 'cache', listings.avatar_hash.encode("hex"))):
-                                self.factory.mserver.get_image(node, listings.avatar_hash)
+                            self.factory.mserver.images.fetch(node, l.thumbnail_hash, visible=True)
+                            self.factory.mserver.images.fetch(node, listings.avatar_hash)
                             self.transport.write(json.dumps(sanitize_html(listing_json), indent=4))
                             count += 1
                             self.factory.outstanding_listings[message_id].append(l.contract_hash)
@@ -278,12 +273,9 @@ class WSProtocol(Protocol):
                                            (n.relayAddress.ip, n.relayAddress.port),
                                            n.natType, n.vendor)
                         if n.guid == KeyChain(self.factory.db).guid:
-                            proto = self.factory.db.listings.get_proto()
-                            l = Listings()
-                            l.ParseFromString(proto)
-                            for listing in l.listing:
-                                if listing.contract_hash == val.valueKey:
-                                    respond(listing, node_to_ask)
+                            listing = self.factory.db.listings.get_listing(val.valueKey)
+                            if listing is not None:
+                                respond(listing, node_to_ask)
                         else:
                             self.factory.mserver.get_contract_metadata(node_to_ask, val.valueKey)\
                                 .addCallback(respond, node_to_ask)
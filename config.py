@@ -13,7 +13,7 @@ from ConfigParser import ConfigParser
 from urlparse import urlparse
 
 SERVER_VERSION = "0.2.6"
-PROTOCOL_VERSION = 2
+PROTOCOL_VERSION = 3
 CONFIG_FILE = join(os.getcwd(), 'ob.cfg')
 
 # FIXME probably a better way to do this. This curretly checks two levels deep.
@@ -27,6 +27,12 @@ DEFAULTS = {
     'data_folder': None,
     'ksize': '20',
     'alpha': '3',
+    'db_threads': '4',
+    'file_cache_size': '33554432',
+    'contract_cache_size': '100',
+    'signature_cache_size': '10000',
+    'crypto_processes': '2',
+    'broadcast_concurrency': '20',
     'transaction_fee': '10000',
     'libbitcoin_servers': 'tcp://libbitcoin1.openbazaar.org:9091',
     'libbitcoin_servers_testnet': 'tcp://libbitcoin2.openbazaar.org:9091, <Z&{.=LJSPySefIKgCu99w.L%b^6VvuVp0+pbnOM',
@@ -164,6 +170,12 @@ else:
 DATA_FOLDER = _platform_agnostic_data_path(cfg.get('CONSTANTS', 'DATA_FOLDER'))
 KSIZE = int(cfg.get('CONSTANTS', 'KSIZE'))
 ALPHA = int(cfg.get('CONSTANTS', 'ALPHA'))
+DB_THREADS = int(cfg.get('CONSTANTS', 'DB_THREADS'))
+FILE_CACHE_SIZE = int(cfg.get('CONSTANTS', 'FILE_CACHE_SIZE'))
+CONTRACT_CACHE_SIZE = int(cfg.get('CONSTANTS', 'CONTRACT_CACHE_SIZE'))
+SIGNATURE_CACHE_SIZE = int(cfg.get('CONSTANTS', 'SIGNATURE_CACHE_SIZE'))
+CRYPTO_PROCESSES = int(cfg.get('CONSTANTS', 'CRYPTO_PROCESSES'))
+BROADCAST_CONCURRENCY = int(cfg.get('CONSTANTS', 'BROADCAST_CONCURRENCY'))
 TRANSACTION_FEE = int(cfg.get('CONSTANTS', 'TRANSACTION_FEE'))
 RESOLVER = cfg.get('CONSTANTS', 'RESOLVER')
 SSL = str_to_bool(cfg.get('AUTHENTICATION', 'SSL'))
@@ -0,0 +1,175 @@
+__author__ = 'chris'
+
+import json
+import os
+import threading
+from collections import OrderedDict
+from config import DATA_FOLDER
+
+# The folders, relative to the data folder, an order's contract can be kept in.
+PURCHASES_UNFUNDED = os.path.join("purchases", "unfunded")
+PURCHASES_IN_PROGRESS = os.path.join("purchases", "in progress")
+PURCHASES_TRADE_RECEIPTS = os.path.join("purchases", "trade receipts")
+SALES_UNFUNDED = os.path.join("store", "contracts", "unfunded")
+SALES_IN_PROGRESS = os.path.join("store", "contracts", "in progress")
+SALES_TRADE_RECEIPTS = os.path.join("store", "contracts", "trade receipts")
+CASES = "cases"
+
+FOLDERS = (PURCHASES_UNFUNDED, PURCHASES_IN_PROGRESS, PURCHASES_TRADE_RECEIPTS,
+           SALES_UNFUNDED, SALES_IN_PROGRESS, SALES_TRADE_RECEIPTS, CASES)
+
+
+class ContractRepository(object):
+    """
+    Keeps track of which folder each order's contract is saved in so it can be
+    found by order id without probing the file system, and holds the most
+    recently used contracts in memory already parsed.
+
+    Contracts saved before the index existed are found the old way the first
+    time they're asked for and indexed from then on.
+    """
+
+    def __init__(self, pool, cache_size=100, data_folder=DATA_FOLDER):
+        self.pool = pool
+        self.cache_size = cache_size
+        self.data_folder = data_folder
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_path(self, order_id):
+        """
+        Return the path to the contract for `order_id` or None if we don't have it.
+        """
+        folder = self.get_folder(order_id)
+        if folder is None:
+            return None
+        return self._path(folder, order_id)
+
+    def get_folder(self, order_id):
+        """
+        Return which of the `FOLDERS` the contract for `order_id` is in or None.
+        """
+        conn = self.pool.reader()
+        cursor = conn.cursor()
+        cursor.execute('''SELECT folder FROM contract_files WHERE id=?''', (order_id,))
+        ret = cursor.fetchone()
+        conn.close()
+        if ret is not None and os.path.isfile(self._path(ret[0], order_id)):
+            return ret[0]
+        for folder in FOLDERS:
+            if os.path.isfile(self._path(folder, order_id)):
+                self._set_folder(order_id, folder)
+                return folder
+        if ret is not None:
+            self._delete_folder(order_id)
+        return None
+
+    def load(self, order_id):
+        """
+        Return the contract for `order_id` as an `OrderedDict` or None if it
+        can't be found. The caller gets its own copy to modify.
+        """
+        with self.lock:
+            contract = self.entries.pop(order_id, None)
+            if contract is not None:
+                self.entries[order_id] = contract
+                self.hits += 1
+                return _copy(contract)
+            self.misses += 1
+        file_path = self.get_path(order_id)
+        if file_path is None:
+            return None
+        with open(file_path, 'r') as filename:
+            contract = json.load(filename, object_pairs_hook=OrderedDict)
+        self._cache(order_id, contract)
+        return _copy(contract)
+
+    def save(self, order_id, contract, folder):
+        """
+        Write the contract into `folder`, replacing the file atomically and
+        removing the copy in the folder it was in before, if any.
+        """
+        previous = self.get_folder(order_id)
+        file_path = self._path(folder, order_id)
+        tmp_path = file_path + ".tmp"
+        with open(tmp_path, 'wb') as outfile:
+            outfile.write(json.dumps(contract, indent=4))
+        _replace(tmp_path, file_path)
+        self._set_folder(order_id, folder)
+        self._cache(order_id, _copy(contract))
+        if previous is not None and previous != folder:
+            os.remove(self._path(previous, order_id))
+
+    def move(self, order_id, folder):
+        """
+        Move the contract into `folder`. Returns False if there is no such contract.
+        """
+        previous = self.get_folder(order_id)
+        if previous is None:
+            return False
+        if previous != folder:
+            _replace(self._path(previous, order_id), self._path(folder, order_id))
+            self._set_folder(order_id, folder)
+        return True
+
+    def delete(self, order_id):
+        file_path = self.get_path(order_id)
+        if file_path is not None:
+            os.remove(file_path)
+        self._delete_folder(order_id)
+        with self.lock:
+            self.entries.pop(order_id, None)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+    def _path(self, folder, order_id):
+        return os.path.join(self.data_folder, folder, order_id + ".json")
+
+    def _cache(self, order_id, contract):
+        if self.cache_size <= 0:
+            return
+        with self.lock:
+            self.entries.pop(order_id, None)
+            self.entries[order_id] = contract
+            while len(self.entries) > self.cache_size:
+                self.entries.popitem(last=False)
+
+    def _set_folder(self, order_id, folder):
+        conn = self.pool.writer()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''INSERT OR REPLACE INTO contract_files(id, folder) VALUES (?,?)''', (order_id, folder))
+            conn.commit()
+        conn.close()
+
+    def _delete_folder(self, order_id):
+        conn = self.pool.writer()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''DELETE FROM contract_files WHERE id=?''', (order_id,))
+            conn.commit()
+        conn.close()
+
+
+def _replace(src, dst):
+    # os.rename won't overwrite an existing file on windows
+    if os.name == "nt" and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def _copy(value):
+    # a faster deepcopy for the dicts, lists and scalars json gives us
+    if isinstance(value, dict):
+        return value.__class__((k, _copy(v)) for k, v in value.iteritems())
+    elif isinstance(value, list):
+        return [_copy(v) for v in value]
+    return value
@@ -2,43 +2,324 @@ __author__ = 'chris'
 
 import os
 import sqlite3 as lite
+import threading
 import time
 from api.utils import sanitize_html
-from collections import Counter
-from config import DATA_FOLDER
+from collections import Counter, OrderedDict
+from config import DATA_FOLDER, DB_THREADS, FILE_CACHE_SIZE, CONTRACT_CACHE_SIZE
+from db.contracts import ContractRepository
 from dht.node import Node
 from dht.utils import digest
 from protos import objects
 from protos.objects import Listings, Followers, Following
 from os.path import join
-from db.migrations import migration1, migration2, migration3, migration4, migration5, migration6, migration7
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
+from db.migrations import migration1, migration2, migration3, migration4, migration5, migration6, migration7, \
+    migration8, migration9, migration10, migration11, migration12
+
+
+class ConnectionPool(object):
+    """
+    Long-lived SQLite connections shared by all of the store classes for one
+    database file.
+
+    Writes go through a single writer connection; entering it with `with conn:`
+    takes the write lock and commits (or rolls back) on exit. Reads check out
+    one of up to `size` idle reader connections and hand it back on `close()`.
+    Keeping the connections open avoids reparsing the schema on every call and
+    lets sqlite3 reuse its cached prepared statements. The database runs in WAL
+    mode so readers are not blocked by the writer.
+
+    A `size` of 0 disables pooling: every checkout opens a fresh connection and
+    `close()` really closes it.
+    """
+
+    def __init__(self, path, size=4):
+        self.path = path
+        self.size = size
+        self.lock = threading.RLock()
+        self.idle = []
+        self.write_conn = None
+        self.opened = 0
+        self.reused = 0
+
+    def _open(self):
+        conn = lite.connect(self.path, check_same_thread=False, cached_statements=256)
+        conn.text_factory = str
+        conn.execute('''PRAGMA journal_mode=WAL''')
+        with self.lock:
+            self.opened += 1
+        return conn
+
+    def reader(self):
+        with self.lock:
+            if len(self.idle) > 0:
+                self.reused += 1
+                return PooledConnection(self, self.idle.pop())
+        return PooledConnection(self, self._open())
+
+    def writer(self):
+        if self.size == 0:
+            return WriterConnection(self._open(), pooled=False)
+        with self.lock:
+            if self.write_conn is None:
+                self.write_conn = WriterConnection(self._open())
+            else:
+                self.reused += 1
+            return self.write_conn
+
+    def release(self, conn):
+        conn.rollback()
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+            writer, self.write_conn = self.write_conn, None
+        for conn in idle:
+            conn.close()
+        if writer is not None:
+            with writer.lock:
+                writer.conn.close()
+
+    def get_stats(self):
+        return {
+            "opened": self.opened,
+            "reused": self.reused,
+            "idle_readers": len(self.idle)
+        }
+
+
+class PooledConnection(object):
+    """
+    A reader connection checked out of a :class:`ConnectionPool`. `close()`
+    returns it to the pool.
+    """
+
+    def __init__(self, pool, conn):
+        self.pool = pool
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def close(self):
+        if self.conn is not None:
+            self.pool.release(self.conn)
+            self.conn = None
+
+
+class WriterConnection(object):
+    """
+    The writer connection of a :class:`ConnectionPool`. Only one thread at a
+    time may be inside its `with` block.
+    """
+
+    def __init__(self, conn, pooled=True):
+        self.conn = conn
+        self.lock = threading.RLock()
+        self.pooled = pooled
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            return self.conn.__enter__()
+        except Exception:
+            self.lock.release()
+            raise
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            return self.conn.__exit__(exc_type, exc_value, traceback)
+        finally:
+            self.lock.release()
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        if not self.pooled:
+            self.conn.close()
+
+
+class DeferredDatabase(object):
+    """
+    Runs datastore calls on a dedicated thread pool so slow disk access never
+    blocks the reactor. Stores are reached the same way as on :class:`Database`
+    and every method returns a `Deferred`, for example::
+
+        db.deferred.filemap.read_file(hash_value).addCallback(...)
+
+    The pool is started on first use and stopped when the reactor shuts down.
+    """
+
+    def __init__(self, db, size=4):
+        self.db = db
+        self.size = size
+        self.threadpool = None
+        self.queued = 0
+        self.max_queued = 0
+        self.completed = 0
+
+    def __getattr__(self, name):
+        return DeferredStore(self, getattr(self.db, name))
+
+    def run(self, func, *args, **kwargs):
+        """
+        Call `func` on the thread pool and return a `Deferred` for its result.
+        """
+        if self.threadpool is None:
+            self.threadpool = ThreadPool(0, self.size, "datastore")
+            self.threadpool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        d = threads.deferToThreadPool(reactor, self.threadpool, func, *args, **kwargs)
+        return d.addBoth(self._finished)
+
+    def _finished(self, result):
+        self.queued -= 1
+        self.completed += 1
+        return result
+
+    def stop(self):
+        if self.threadpool is not None:
+            self.threadpool.stop()
+            self.threadpool = None
+
+    def get_stats(self):
+        return {
+            "threads": self.size,
+            "queue_depth": self.queued,
+            "max_queue_depth": self.max_queued,
+            "completed": self.completed
+        }
+
+
+class DeferredStore(object):
+    """
+    A store whose methods run on the :class:`DeferredDatabase` thread pool.
+    """
+
+    def __init__(self, deferred_db, store):
+        self.deferred_db = deferred_db
+        self.store = store
+
+    def __getattr__(self, name):
+        method = getattr(self.store, name)
+
+        def run(*args, **kwargs):
+            return self.deferred_db.run(method, *args, **kwargs)
+        return run
+
+
+class FileCache(object):
+    """
+    A least recently used cache of file contents keyed by their hex hash. The
+    cache is bounded by the total size of the cached files rather than the
+    number of entries and files larger than the whole cache are never kept.
+    """
+
+    def __init__(self, max_bytes=33554432):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, hash_value):
+        """
+        Return the cached contents for `hash_value` or None on a miss.
+        """
+        with self.lock:
+            data = self.entries.pop(hash_value, None)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries[hash_value] = data
+            self.hits += 1
+            return data
+
+    def put(self, hash_value, data):
+        with self.lock:
+            self._remove(hash_value)
+            if len(data) > self.max_bytes:
+                return
+            self.entries[hash_value] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, hash_value):
+        with self.lock:
+            self._remove(hash_value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _remove(self, hash_value):
+        data = self.entries.pop(hash_value, None)
+        if data is not None:
+            self.size -= len(data)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "size": self.size,
+                "max_size": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
 
 
 class Database(object):
 
-    __slots__ = ['PATH', 'filemap', 'profile', 'listings', 'keys', 'follow', 'messages',
-                 'notifications', 'broadcasts', 'vendors', 'moderators', 'purchases', 'sales',
-                 'cases', 'ratings', 'transactions', 'settings', 'audit_shopping']
+    __slots__ = ['PATH', 'pool', 'deferred', 'filecache', 'filemap', 'contracts', 'profile', 'listings', 'keys',
+                 'follow', 'messages', 'notifications', 'broadcasts', 'vendors', 'moderators', 'purchases', 'sales',
+                 'cases', 'ratings', 'published', 'seed_nodes', 'transactions', 'settings', 'audit_shopping']
 
     def __init__(self, testnet=False, filepath=None):
         object.__setattr__(self, 'PATH', self._database_path(testnet, filepath))
-        object.__setattr__(self, 'filemap', HashMap(self.PATH))
-        object.__setattr__(self, 'profile', ProfileStore(self.PATH))
-        object.__setattr__(self, 'listings', ListingsStore(self.PATH))
-        object.__setattr__(self, 'keys', KeyStore(self.PATH))
-        object.__setattr__(self, 'follow', FollowData(self.PATH))
-        object.__setattr__(self, 'messages', MessageStore(self.PATH))
-        object.__setattr__(self, 'notifications', NotificationStore(self.PATH))
-        object.__setattr__(self, 'broadcasts', BroadcastStore(self.PATH))
-        object.__setattr__(self, 'vendors', VendorStore(self.PATH))
-        object.__setattr__(self, 'moderators', ModeratorStore(self.PATH))
-        object.__setattr__(self, 'purchases', Purchases(self.PATH))
-        object.__setattr__(self, 'sales', Sales(self.PATH))
-        object.__setattr__(self, 'cases', Cases(self.PATH))
-        object.__setattr__(self, 'ratings', Ratings(self.PATH))
-        object.__setattr__(self, 'transactions', Transactions(self.PATH))
-        object.__setattr__(self, 'settings', Settings(self.PATH))
-        object.__setattr__(self, 'audit_shopping', ShoppingEvents(self.PATH))
+        object.__setattr__(self, 'pool', ConnectionPool(self.PATH))
+        object.__setattr__(self, 'deferred', DeferredDatabase(self, DB_THREADS))
+        object.__setattr__(self, 'filecache', FileCache(FILE_CACHE_SIZE))
+        object.__setattr__(self, 'filemap', HashMap(self.pool))
+        object.__setattr__(self, 'contracts', ContractRepository(self.pool, CONTRACT_CACHE_SIZE))
+        object.__setattr__(self, 'profile', ProfileStore(self.pool))
+        object.__setattr__(self, 'listings', ListingsStore(self.pool))
+        object.__setattr__(self, 'keys', KeyStore(self.pool))
+        object.__setattr__(self, 'follow', FollowData(self.pool))
+        object.__setattr__(self, 'messages', MessageStore(self.pool))
+        object.__setattr__(self, 'notifications', NotificationStore(self.pool))
+        object.__setattr__(self, 'broadcasts', BroadcastStore(self.pool))
+        object.__setattr__(self, 'vendors', VendorStore(self.pool))
+        object.__setattr__(self, 'moderators', ModeratorStore(self.pool))
+        object.__setattr__(self, 'purchases', Purchases(self.pool))
+        object.__setattr__(self, 'sales', Sales(self.pool))
+        object.__setattr__(self, 'cases', Cases(self.pool))
+        object.__setattr__(self, 'ratings', Ratings(self.pool))
+        object.__setattr__(self, 'published', PublishedKeywords(self.pool))
+        object.__setattr__(self, 'seed_nodes', SeedNodes(self.pool))
+        object.__setattr__(self, 'transactions', Transactions(self.pool))
+        object.__setattr__(self, 'settings', Settings(self.pool))
+        object.__setattr__(self, 'audit_shopping', ShoppingEvents(self.pool))
 
         self._initialize_datafolder_tree()
         self._initialize_database(self.PATH)
@@ -46,6 +327,13 @@ class Database(object):
     def get_database_path(self):
         return self.PATH
 
+    def close(self):
+        """
+        Stop the datastore threads and close all pooled connections.
+        """
+        self.deferred.stop()
+        self.pool.close()
+
     def _initialize_database(self, database_path):
         """
         Create database, if not present, and clear cache.
@@ -124,6 +412,7 @@ class Database(object):
         cursor.execute('''CREATE TABLE profile(id INTEGER PRIMARY KEY, serializedUserInfo BLOB, tempHandle TEXT)''')
 
         cursor.execute('''CREATE TABLE listings(id INTEGER PRIMARY KEY, serializedListings BLOB)''')
+        cursor.execute('''CREATE TABLE listing_metadata(contractHash BLOB PRIMARY KEY, serializedListing BLOB)''')
 
         cursor.execute('''CREATE TABLE keys(type TEXT PRIMARY KEY, privkey BLOB, pubkey BLOB)''')
 
@@ -167,6 +456,16 @@ class Database(object):
         cursor.execute('''CREATE TABLE ratings(listing TEXT, ratingID TEXT,  rating TEXT)''')
         cursor.execute('''CREATE INDEX index_listing ON ratings(listing);''')
         cursor.execute('''CREATE INDEX index_rating_id ON ratings(ratingID);''')
+        cursor.execute('''CREATE TABLE verified_ratings(ratingID TEXT, vendor TEXT,
+    PRIMARY KEY(ratingID, vendor))''')
+
+        cursor.execute('''CREATE TABLE contract_files(id TEXT PRIMARY KEY, folder TEXT)''')
+
+        cursor.execute('''CREATE TABLE published(keyword TEXT, id TEXT, timestamp INTEGER,
+    PRIMARY KEY(keyword, id))''')
+
+        cursor.execute('''CREATE TABLE seed_nodes(guid BLOB PRIMARY KEY, node BLOB, score INTEGER,
+    first_seen INTEGER, last_seen INTEGER)''')
 
         cursor.execute('''CREATE TABLE transactions(tx BLOB);''')
 
@@ -204,29 +503,89 @@ class Database(object):
             migration4.migrate(self.PATH)
             migration5.migrate(self.PATH)
             migration6.migrate(self.PATH)
+            migration7.migrate(self.PATH)
+            migration8.migrate(self.PATH)
+            migration9.migrate(self.PATH)
+            migration10.migrate(self.PATH)
+            migration11.migrate(self.PATH)
+            migration12.migrate(self.PATH)
         elif version == 1:
             migration2.migrate(self.PATH)
             migration3.migrate(self.PATH)
             migration4.migrate(self.PATH)
             migration5.migrate(self.PATH)
             migration6.migrate(self.PATH)
+            migration7.migrate(self.PATH)
+            migration8.migrate(self.PATH)
+            migration9.migrate(self.PATH)
+            migration10.migrate(self.PATH)
+            migration11.migrate(self.PATH)
+            migration12.migrate(self.PATH)
         elif version == 2:
             migration3.migrate(self.PATH)
             migration4.migrate(self.PATH)
             migration5.migrate(self.PATH)
             migration6.migrate(self.PATH)
+            migration7.migrate(self.PATH)
+            migration8.migrate(self.PATH)
+            migration9.migrate(self.PATH)
+            migration10.migrate(self.PATH)
+            migration11.migrate(self.PATH)
+            migration12.migrate(self.PATH)
         elif version == 3:
             migration4.migrate(self.PATH)
             migration5.migrate(self.PATH)
             migration6.migrate(self.PATH)
+            migration7.migrate(self.PATH)
+            migration8.migrate(self.PATH)
+            migration9.migrate(self.PATH)
+            migration10.migrate(self.PATH)
+            migration11.migrate(self.PATH)
+            migration12.migrate(self.PATH)
         elif version == 4:
             migration5.migrate(self.PATH)
             migration6.migrate(self.PATH)
+            migration7.migrate(self.PATH)
+            migration8.migrate(self.PATH)
+            migration9.migrate(self.PATH)
+            migration10.migrate(self.PATH)
+            migration11.migrate(self.PATH)
+            migration12.migrate(self.PATH)
         elif version == 5:
             migration6.migrate(self.PATH)
             migration7.migrate(self.PATH)
+            migration8.migrate(self.PATH)
+            migration9.migrate(self.PATH)
+            migration10.migrate(self.PATH)
+            migration11.migrate(self.PATH)
+            migration12.migrate(self.PATH)
         elif version == 6:
             migration7.migrate(self.PATH)
+            migration8.migrate(self.PATH)
+            migration9.migrate(self.PATH)
+            migration10.migrate(self.PATH)
+            migration11.migrate(self.PATH)
+            migration12.migrate(self.PATH)
+        elif version == 7:
+            migration8.migrate(self.PATH)
+            migration9.migrate(self.PATH)
+            migration10.migrate(self.PATH)
+            migration11.migrate(self.PATH)
+            migration12.migrate(self.PATH)
+        elif version == 8:
+            migration9.migrate(self.PATH)
+            migration10.migrate(self.PATH)
+            migration11.migrate(self.PATH)
+            migration12.migrate(self.PATH)
+        elif version == 9:
+            migration10.migrate(self.PATH)
+            migration11.migrate(self.PATH)
+            migration12.migrate(self.PATH)
+        elif version == 10:
+            migration11.migrate(self.PATH)
+            migration12.migrate(self.PATH)
+        elif version == 11:
+            migration12.migrate(self.PATH)
 
 
 class HashMap(object):
@@ -237,11 +596,11 @@ class HashMap(object):
     data on disk.
     """
 
-    def __init__(self, database_path):
-        self.PATH = database_path
+    def __init__(self, pool):
+        self.pool = pool
 
     def insert(self, hash_value, filepath):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''INSERT OR REPLACE INTO hashmap(hash, filepath)
@@ -250,7 +609,7 @@ class HashMap(object):
         conn.close()
 
     def get_file(self, hash_value):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT filepath FROM hashmap WHERE hash=?''', (hash_value,))
         ret = cursor.fetchone()
@@ -259,8 +618,16 @@ class HashMap(object):
             return None
         return DATA_FOLDER + ret[0]
 
+    def read_file(self, hash_value, mode="rb"):
+        """
+        Return the contents of the file mapped to `hash_value`. Raises if the
+        hash is unknown or the file can't be read.
+        """
+        with open(self.get_file(hash_value), mode) as f:
+            return f.read()
+
     def get_all(self):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT * FROM hashmap ''')
         ret = cursor.fetchall()
@@ -268,7 +635,7 @@ class HashMap(object):
         return ret
 
     def delete(self, hash_value):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''DELETE FROM hashmap WHERE hash = ?''', (hash_value,))
@@ -276,7 +643,7 @@ class HashMap(object):
         conn.close()
 
     def delete_all(self):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''DELETE FROM hashmap''')
@@ -292,13 +659,17 @@ class ProfileStore(object):
     object). Also we will just serve this over the wire so we don't have to manually
     rebuild it every startup. To interact with the profile you should use the
     `market.profile` module and not this class directly.
+
+    `version` is bumped on every change so callers can cache data derived
+    from the profile.
     """
 
-    def __init__(self, database_path):
-        self.PATH = database_path
+    def __init__(self, pool):
+        self.pool = pool
+        self.version = 0
 
     def set_proto(self, proto):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             handle = self.get_temp_handle()
@@ -306,9 +677,10 @@ class ProfileStore(object):
                           VALUES (?,?,?)''', (1, proto, handle))
             conn.commit()
         conn.close()
+        self.version += 1
 
     def get_proto(self):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT serializedUserInfo FROM profile WHERE id = 1''')
         ret = cursor.fetchone()
@@ -318,7 +690,7 @@ class ProfileStore(object):
         return ret[0]
 
     def set_temp_handle(self, handle):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             if self.get_proto() is None:
@@ -330,7 +702,7 @@ class ProfileStore(object):
         conn.close()
 
     def get_temp_handle(self):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT tempHandle FROM profile WHERE id = 1''')
         ret = cursor.fetchone()
@@ -343,68 +715,81 @@ class ProfileStore(object):
 
 class ListingsStore(object):
     """
-    Stores a serialized `Listings` protobuf object. It contains metadata for all the
-    contracts hosted by this store. We will send this in response to a GET_LISTING
-    query. This should be updated each time a new contract is created.
+    Stores the metadata for all the contracts hosted by this store, one
+    serialized `ListingMetadata` protobuf per contract hash. The full `Listings`
+    object we send in response to a GET_LISTING query is assembled from these
+    rows. This should be updated each time a new contract is created.
+
+    `version` is bumped on every change so callers can cache data derived
+    from the listings.
     """
 
-    def __init__(self, database_path):
-        self.PATH = database_path
+    def __init__(self, pool):
+        self.pool = pool
+        self.version = 0
 
     def add_listing(self, proto):
         """
         Will also update an existing listing if the contract hash is the same.
         """
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
-            l = Listings()
-            ser = self.get_proto()
-            if ser is not None:
-                l.ParseFromString(ser)
-                for listing in l.listing:
-                    if listing.contract_hash == proto.contract_hash:
-                        l.listing.remove(listing)
-            l.listing.extend([proto])
-            cursor.execute('''INSERT OR REPLACE INTO listings(id, serializedListings)
-                          VALUES (?,?)''', (1, l.SerializeToString()))
+            cursor.execute('''INSERT OR REPLACE INTO listing_metadata(contractHash, serializedListing)
+                          VALUES (?,?)''', (proto.contract_hash, proto.SerializeToString()))
             conn.commit()
         conn.close()
+        self.version += 1
 
     def delete_listing(self, hash_value):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
-            ser = self.get_proto()
-            if ser is None:
-                return
-            l = Listings()
-            l.ParseFromString(ser)
-            for listing in l.listing:
-                if listing.contract_hash == hash_value:
-                    l.listing.remove(listing)
-            cursor.execute('''INSERT OR REPLACE INTO listings(id, serializedListings)
-                          VALUES (?,?)''', (1, l.SerializeToString()))
+            cursor.execute('''DELETE FROM listing_metadata WHERE contractHash=?''', (hash_value,))
             conn.commit()
         conn.close()
+        self.version += 1
 
     def delete_all_listings(self):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
-            cursor.execute('''DELETE FROM listings''')
+            cursor.execute('''DELETE FROM listing_metadata''')
             conn.commit()
         conn.close()
+        self.version += 1
 
-    def get_proto(self):
-        conn = Database.connect_database(self.PATH)
+    def get_listing(self, hash_value):
+        """
+        Return the `ListingMetadata` for a single contract or None.
+        """
+        conn = self.pool.reader()
         cursor = conn.cursor()
-        cursor.execute('''SELECT serializedListings FROM listings WHERE id = 1''')
+        cursor.execute('''SELECT serializedListing FROM listing_metadata WHERE contractHash=?''', (hash_value,))
         ret = cursor.fetchone()
         conn.close()
         if ret is None:
             return None
-        return ret[0]
+        listing = Listings().ListingMetadata()
+        listing.ParseFromString(ret[0])
+        return listing
+
+    def get_proto(self):
+        """
+        Return all listings as a serialized `Listings` protobuf in the order
+        they were last saved, or None if there aren't any.
+        """
+        conn = self.pool.reader()
+        cursor = conn.cursor()
+        cursor.execute('''SELECT serializedListing FROM listing_metadata ORDER BY rowid''')
+        ret = cursor.fetchall()
+        conn.close()
+        if not ret:
+            return None
+        l = Listings()
+        for row in ret:
+            l.listing.add().ParseFromString(row[0])
+        return l.SerializeToString()
 
 
 class KeyStore(object):
@@ -412,11 +797,11 @@ class KeyStore(object):
     Stores the keys for this node.
     """
 
-    def __init__(self, database_path):
-        self.PATH = database_path
+    def __init__(self, pool):
+        self.pool = pool
 
     def set_key(self, key_type, privkey, pubkey):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''INSERT OR REPLACE INTO keys(type, privkey, pubkey)
@@ -425,7 +810,7 @@ class KeyStore(object):
         conn.close()
 
     def get_key(self, key_type):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT privkey, pubkey FROM keys WHERE type=?''', (key_type,))
         ret = cursor.fetchone()
@@ -436,7 +821,7 @@ class KeyStore(object):
             return ret
 
     def delete_all_keys(self):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''DELETE FROM keys''')
@@ -450,11 +835,11 @@ class FollowData(object):
     for this node.
     """
 
-    def __init__(self, database_path):
-        self.PATH = database_path
+    def __init__(self, pool):
+        self.pool = pool
 
     def follow(self, proto):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             f = Following()
@@ -471,7 +856,7 @@ class FollowData(object):
         conn.close()
 
     def unfollow(self, guid):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             f = Following()
@@ -487,7 +872,7 @@ class FollowData(object):
         conn.close()
 
     def get_following(self):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT serializedFollowing FROM following WHERE id=1''')
         ret = cursor.fetchall()
@@ -508,7 +893,7 @@ class FollowData(object):
         return False
 
     def set_follower(self, proto):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         p = Followers.Follower()
         p.ParseFromString(proto)
         with conn:
@@ -519,7 +904,7 @@ class FollowData(object):
         conn.close()
 
     def delete_follower(self, guid):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''DELETE FROM followers WHERE guid=?''', (guid.encode("hex"), ))
@@ -527,24 +912,37 @@ class FollowData(object):
         conn.close()
 
     def get_followers(self, start=0):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
 
         cursor.execute('''SELECT Count(*) FROM followers''')
         count = cursor.fetchone()[0]
 
-        f = Followers()
+        serialized_followers = []
         if count > 0:
             smt = '''select serializedFollower from followers order by rowid desc limit 30 offset ''' + str(start)
             cursor.execute(smt)
             serialized_followers = cursor.fetchall()
-            conn.close()
-            for proto in serialized_followers:
-                p = Followers.Follower()
-                p.ParseFromString(proto[0].decode("hex"))
-                f.followers.extend([p])
+        conn.close()
+
+        f = Followers()
+        for proto in serialized_followers:
+            p = Followers.Follower()
+            p.ParseFromString(proto[0].decode("hex"))
+            f.followers.extend([p])
         return (f.SerializeToString(), count)
 
+    def get_follower_guids(self):
+        """
+        Returns the raw guid of every follower.
+        """
+        conn = self.pool.reader()
+        cursor = conn.cursor()
+        cursor.execute('''SELECT guid FROM followers''')
+        ret = cursor.fetchall()
+        conn.close()
+        return [row[0].decode("hex") for row in ret]
+
 
 class MessageStore(object):
     """
@@ -552,8 +950,8 @@ class MessageStore(object):
     messages and conversations as well as marking as read.
     """
 
-    def __init__(self, database_path):
-        self.PATH = database_path
+    def __init__(self, pool):
+        self.pool = pool
 
     def save_message(self, guid, handle, pubkey, subject, message_type, message,
                      timestamp, avatar_hash, signature, is_outgoing, msg_id=None):
@@ -561,7 +959,7 @@ class MessageStore(object):
         Store message in database.
         """
         try:
-            conn = Database.connect_database(self.PATH)
+            conn = self.pool.writer()
             with conn:
                 outgoing = 1 if is_outgoing else 0
                 msgID = digest(message + str(timestamp)).encode("hex") if msg_id is None else msg_id
@@ -584,7 +982,7 @@ class MessageStore(object):
             timestamp = 4294967295
         else:
             timestamp = self.get_timestamp(msgID)
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT guid, handle, pubkey, subject, messageType, message,
 timestamp, avatarHash, signature, outgoing, read, msgID FROM messages
@@ -597,7 +995,7 @@ WHERE guid=? AND messageType=? AND timestamp<? ORDER BY timestamp DESC LIMIT 20'
         """
         Return all messages matching guid and message_type.
         """
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT guid, handle, pubkey, subject, messageType, message, timestamp,
 avatarHash, signature, outgoing, read FROM messages WHERE subject=? ''',
@@ -614,7 +1012,7 @@ avatarHash, signature, outgoing, read FROM messages WHERE subject=? ''',
           Array of dictionaries, one element for each guid. Dictionaries
           include last message only.
         """
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT DISTINCT guid FROM messages''',)
         guids = cursor.fetchall()
@@ -655,7 +1053,7 @@ WHERE guid=? and messageType=? and avatarHash NOT NULL''', (g[0], "CHAT"))
         """
         Get Counter of guids which have unread, incoming messages.
         """
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT guid FROM messages WHERE read=0 and outgoing=0 and subject=""''',)
         ret = []
@@ -666,7 +1064,7 @@ WHERE guid=? and messageType=? and avatarHash NOT NULL''', (g[0], "CHAT"))
         return Counter(ret)
 
     def get_timestamp(self, msgID):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT timestamp FROM messages WHERE msgID=? and messageType=?''', (msgID, "CHAT"))
         ts = cursor.fetchone()[0]
@@ -679,7 +1077,7 @@ WHERE guid=? and messageType=? and avatarHash NOT NULL''', (g[0], "CHAT"))
         """
         Mark all messages for guid as read.
         """
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''UPDATE messages SET read=? WHERE guid=?;''', (1, guid))
@@ -690,7 +1088,7 @@ WHERE guid=? and messageType=? and avatarHash NOT NULL''', (g[0], "CHAT"))
         """
         Delete all messages of type 'CHAT' for guid.
         """
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''DELETE FROM messages WHERE guid=? AND messageType="CHAT"''', (guid, ))
@@ -703,11 +1101,11 @@ class NotificationStore(object):
     All notifications are stored here.
     """
 
-    def __init__(self, database_path):
-        self.PATH = database_path
+    def __init__(self, pool):
+        self.pool = pool
 
     def save_notification(self, notif_id, guid, handle, notif_type, order_id, title, timestamp, image_hash):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''INSERT INTO notifications(notifID, guid, handle, type, orderId, title, timestamp,
@@ -717,7 +1115,7 @@ imageHash, read) VALUES (?,?,?,?,?,?,?,?,?)''', (notif_id, guid, handle, notif_t
         conn.close()
 
     def get_notifications(self, notif_id, limit):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         start = self.get_row(notif_id)
         cursor.execute('''SELECT notifID, guid, handle, type, orderId, title, timestamp,
@@ -727,7 +1125,7 @@ imageHash, read FROM notifications WHERE rowid <=? AND rowid > ?''', (start, sta
         return ret
 
     def get_row(self, notif_id):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT MAX(rowid) FROM notifications''')
         max_row = cursor.fetchone()[0]
@@ -739,7 +1137,7 @@ imageHash, read FROM notifications WHERE rowid <=? AND rowid > ?''', (start, sta
         return max_row if not ret else ret[0]
 
     def mark_as_read(self, notif_id):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''UPDATE notifications SET read=? WHERE notifID=?;''', (1, notif_id))
@@ -747,7 +1145,7 @@ imageHash, read FROM notifications WHERE rowid <=? AND rowid > ?''', (start, sta
         conn.close()
 
     def get_unread_count(self):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT notifID FROM notifications WHERE read=?''', (0, ))
         ret = cursor.fetchall()
@@ -755,7 +1153,7 @@ imageHash, read FROM notifications WHERE rowid <=? AND rowid > ?''', (start, sta
         return len(ret)
 
     def delete_notification(self, notif_id):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''DELETE FROM notifications WHERE notifID=?''', (notif_id,))
@@ -768,11 +1166,11 @@ class BroadcastStore(object):
     Stores broadcast messages that our node receives.
     """
 
-    def __init__(self, database_path):
-        self.PATH = database_path
+    def __init__(self, pool):
+        self.pool = pool
 
     def save_broadcast(self, broadcast_id, guid, handle, message, timestamp, avatar_hash):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''INSERT INTO broadcasts(id, guid, handle, message, timestamp, avatarHash)
@@ -781,7 +1179,7 @@ class BroadcastStore(object):
         conn.close()
 
     def get_broadcasts(self):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT id, guid, handle, message, timestamp, avatarHash FROM broadcasts''')
         ret = cursor.fetchall()
@@ -789,7 +1187,7 @@ class BroadcastStore(object):
         return ret
 
     def delete_broadcast(self, broadcast_id):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''DELETE FROM broadcasts WHERE id=?''', (broadcast_id,))
@@ -802,11 +1200,11 @@ class VendorStore(object):
     Stores a list of vendors this node has heard about. Useful for
     filling out data in the homepage.
     """
-    def __init__(self, database_path):
-        self.PATH = database_path
+    def __init__(self, pool):
+        self.pool = pool
 
     def save_vendor(self, guid, serialized_node):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             try:
@@ -818,7 +1216,7 @@ class VendorStore(object):
         conn.close()
 
     def get_vendors(self):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT serializedNode FROM vendors''')
         ret = cursor.fetchall()
@@ -842,7 +1240,7 @@ class VendorStore(object):
         return nodes
 
     def delete_vendor(self, guid):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''DELETE FROM vendors WHERE guid=?''', (guid,))
@@ -856,12 +1254,12 @@ class ModeratorStore(object):
     for it to be used in a new listing.
     """
 
-    def __init__(self, database_path):
-        self.PATH = database_path
+    def __init__(self, pool):
+        self.pool = pool
 
     def save_moderator(self, guid, pubkey, bitcoin_key, bicoin_sig, name,
                        avatar_hash, fee, handle="", short_desc=""):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             try:
@@ -875,7 +1273,7 @@ bitcoinSignature, handle, name, description, avatar, fee)
         conn.close()
 
     def get_moderator(self, guid):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT * FROM moderators WHERE guid=?''', (guid,))
         ret = cursor.fetchone()
@@ -883,7 +1281,7 @@ bitcoinSignature, handle, name, description, avatar, fee)
         return ret
 
     def delete_moderator(self, guid):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''DELETE FROM moderators WHERE guid=?''', (guid,))
@@ -893,7 +1291,7 @@ bitcoinSignature, handle, name, description, avatar, fee)
     def clear_all(self, except_guids=None):
         if except_guids is None:
             except_guids = []
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''DELETE FROM moderators WHERE guid NOT IN ({seq})'''.format(
@@ -908,12 +1306,12 @@ class Purchases(object):
     Stores a list of this node's purchases.
     """
 
-    def __init__(self, database_path):
-        self.PATH = database_path
+    def __init__(self, pool):
+        self.pool = pool
 
     def new_purchase(self, order_id, title, description, timestamp, btc,
                      address, status, thumbnail, vendor, proofSig, contract_type):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             try:
@@ -927,7 +1325,7 @@ address, status, thumbnail, vendor, proofSig, contractType, unread) VALUES (?,?,
         conn.close()
 
     def get_purchase(self, order_id):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT id, title, description, timestamp, btc, address, status,
  thumbnail, vendor, contractType, proofSig, unread FROM purchases WHERE id=?''', (order_id,))
@@ -939,7 +1337,7 @@ address, status, thumbnail, vendor, proofSig, contractType, unread) VALUES (?,?,
             return ret[0]
 
     def delete_purchase(self, order_id):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''DELETE FROM purchases WHERE id=?''', (order_id,))
@@ -947,7 +1345,7 @@ address, status, thumbnail, vendor, proofSig, contractType, unread) VALUES (?,?,
         conn.close()
 
     def get_all(self):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT id, title, description, timestamp, btc, status,
  thumbnail, vendor, contractType, unread, statusChanged FROM purchases ''')
@@ -956,7 +1354,7 @@ address, status, thumbnail, vendor, proofSig, contractType, unread) VALUES (?,?,
         return ret
 
     def get_unfunded(self):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT id, timestamp FROM purchases WHERE status=0 OR status=2''')
         ret = cursor.fetchall()
@@ -964,7 +1362,7 @@ address, status, thumbnail, vendor, proofSig, contractType, unread) VALUES (?,?,
         return ret
 
     def update_status(self, order_id, status):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''UPDATE purchases SET status=? WHERE id=?;''', (status, order_id))
@@ -972,7 +1370,7 @@ address, status, thumbnail, vendor, proofSig, contractType, unread) VALUES (?,?,
         conn.close()
 
     def status_changed(self, order_id, status):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''UPDATE purchases SET statusChanged=? WHERE id=?;''', (status, order_id))
@@ -980,7 +1378,7 @@ address, status, thumbnail, vendor, proofSig, contractType, unread) VALUES (?,?,
         conn.close()
 
     def get_status(self, order_id):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT status FROM purchases WHERE id=?''', (order_id,))
         ret = cursor.fetchone()
@@ -991,7 +1389,7 @@ address, status, thumbnail, vendor, proofSig, contractType, unread) VALUES (?,?,
             return ret[0]
 
     def update_unread(self, order_id, reset=False):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             if reset is False:
@@ -1002,7 +1400,7 @@ address, status, thumbnail, vendor, proofSig, contractType, unread) VALUES (?,?,
         conn.close()
 
     def update_outpoint(self, order_id, outpoint):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''UPDATE purchases SET outpoint=? WHERE id=?;''', (outpoint, order_id))
@@ -1010,7 +1408,7 @@ address, status, thumbnail, vendor, proofSig, contractType, unread) VALUES (?,?,
         conn.close()
 
     def get_outpoint(self, order_id):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT outpoint FROM purchases WHERE id=?''', (order_id,))
         ret = cursor.fetchone()
@@ -1021,7 +1419,7 @@ address, status, thumbnail, vendor, proofSig, contractType, unread) VALUES (?,?,
             return ret[0]
 
     def get_proof_sig(self, order_id):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT proofSig FROM purchases WHERE id=?''', (order_id,))
         ret = cursor.fetchone()
@@ -1037,12 +1435,12 @@ class Sales(object):
     Stores a list of this node's sales.
     """
 
-    def __init__(self, database_path):
-        self.PATH = database_path
+    def __init__(self, pool):
+        self.pool = pool
 
     def new_sale(self, order_id, title, description, timestamp, btc,
                  address, status, thumbnail, buyer, contract_type):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             try:
@@ -1056,7 +1454,7 @@ status, thumbnail, buyer, contractType, unread) VALUES (?,?,?,?,?,?,?,?,?,?,?)''
         conn.close()
 
     def get_sale(self, order_id):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT id, title, description, timestamp, btc, address, status,
 thumbnail, buyer, contractType, unread FROM sales WHERE id=?''', (order_id,))
@@ -1068,7 +1466,7 @@ thumbnail, buyer, contractType, unread FROM sales WHERE id=?''', (order_id,))
             return ret[0]
 
     def delete_sale(self, order_id):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''DELETE FROM sales WHERE id=?''', (order_id,))
@@ -1076,7 +1474,7 @@ thumbnail, buyer, contractType, unread FROM sales WHERE id=?''', (order_id,))
         conn.close()
 
     def get_all(self):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT id, title, description, timestamp, btc, status,
 thumbnail, buyer, contractType, unread, statusChanged FROM sales ''')
@@ -1085,7 +1483,7 @@ thumbnail, buyer, contractType, unread, statusChanged FROM sales ''')
         return ret
 
     def get_by_status(self, status):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT id, title, description, timestamp, btc, status,
 thumbnail, buyer, contractType, unread, statusChanged FROM sales WHERE
@@ -1095,7 +1493,7 @@ status=?''', (status,))
         return ret
 
     def get_unfunded(self):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT id, timestamp FROM sales WHERE status=0''')
         ret = cursor.fetchall()
@@ -1103,7 +1501,7 @@ status=?''', (status,))
         return ret
 
     def update_status(self, order_id, status):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''UPDATE sales SET status=? WHERE id=?;''', (status, order_id))
@@ -1111,7 +1509,7 @@ status=?''', (status,))
         conn.close()
 
     def status_changed(self, order_id, status):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''UPDATE sales SET statusChanged=? WHERE id=?;''', (status, order_id))
@@ -1119,7 +1517,7 @@ status=?''', (status,))
         conn.close()
 
     def get_status(self, order_id):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT status FROM sales WHERE id=?''', (order_id,))
         ret = cursor.fetchone()
@@ -1130,7 +1528,7 @@ status=?''', (status,))
             return ret[0]
 
     def update_unread(self, order_id, reset=False):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             if reset is False:
@@ -1141,7 +1539,7 @@ status=?''', (status,))
         conn.close()
 
     def update_outpoint(self, order_id, outpoint):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''UPDATE sales SET outpoint=? WHERE id=?;''', (outpoint, order_id))
@@ -1149,7 +1547,7 @@ status=?''', (status,))
         conn.close()
 
     def update_payment_tx(self, order_id, txid):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''UPDATE sales SET paymentTX=? WHERE id=?;''', (txid, order_id))
@@ -1157,7 +1555,7 @@ status=?''', (status,))
         conn.close()
 
     def get_outpoint(self, order_id):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT outpoint FROM sales WHERE id=?''', (order_id,))
         ret = cursor.fetchone()
@@ -1173,12 +1571,12 @@ class Cases(object):
     Stores a list of this node's moderation cases.
     """
 
-    def __init__(self, database_path):
-        self.PATH = database_path
+    def __init__(self, pool):
+        self.pool = pool
 
     def new_case(self, order_id, title, timestamp, order_date, btc,
                  thumbnail, buyer, vendor, validation, claim):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             try:
@@ -1192,7 +1590,7 @@ buyer, vendor, validation, claim, status, unread) VALUES (?,?,?,?,?,?,?,?,?,?,?,
         conn.close()
 
     def delete_case(self, order_id):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''DELETE FROM cases WHERE id=?''', (order_id,))
@@ -1200,7 +1598,7 @@ buyer, vendor, validation, claim, status, unread) VALUES (?,?,?,?,?,?,?,?,?,?,?,
         conn.close()
 
     def get_all(self):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT id, title, timestamp, orderDate, btc, thumbnail,
 buyer, vendor, validation, claim, status, unread, statusChanged FROM cases ''')
@@ -1209,7 +1607,7 @@ buyer, vendor, validation, claim, status, unread, statusChanged FROM cases ''')
         return ret
 
     def update_unread(self, order_id, reset=False):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             if reset is False:
@@ -1220,7 +1618,7 @@ buyer, vendor, validation, claim, status, unread, statusChanged FROM cases ''')
         conn.close()
 
     def get_claim(self, order_id):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT claim FROM cases WHERE id=?''', (order_id,))
         ret = cursor.fetchone()
@@ -1231,7 +1629,7 @@ buyer, vendor, validation, claim, status, unread, statusChanged FROM cases ''')
             return ret[0]
 
     def update_status(self, order_id, status):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''UPDATE cases SET status=? WHERE id=?;''', (status, order_id))
@@ -1239,7 +1637,7 @@ buyer, vendor, validation, claim, status, unread, statusChanged FROM cases ''')
         conn.close()
 
     def status_changed(self, order_id, status):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''UPDATE cases SET statusChanged=? WHERE id=?;''', (status, order_id))
@@ -1252,11 +1650,11 @@ class Ratings(object):
     Store ratings for each contract in the db.
     """
 
-    def __init__(self, database_path):
-        self.PATH = database_path
+    def __init__(self, pool):
+        self.pool = pool
 
     def add_rating(self, listing_hash, rating):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             rating_id = digest(rating).encode("hex")
             cursor = conn.cursor()
@@ -1266,7 +1664,7 @@ class Ratings(object):
         conn.close()
 
     def get_listing_ratings(self, listing_hash, starting_id=None):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         if starting_id is None:
             cursor.execute('''SELECT rating FROM ratings WHERE listing=?''', (listing_hash,))
@@ -1287,7 +1685,7 @@ class Ratings(object):
                 return ret
 
     def get_all_ratings(self, starting_id=None):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         if starting_id is None:
             cursor.execute('''SELECT rating FROM ratings''')
@@ -1306,6 +1704,118 @@ class Ratings(object):
                 conn.close()
                 return ret
 
+    def add_verified(self, vendor, rating_ids):
+        """
+        Remember that the ratings in `rating_ids` were served by `vendor` (a hex
+        encoded public key) and passed verification.
+        """
+        conn = self.pool.writer()
+        with conn:
+            cursor = conn.cursor()
+            cursor.executemany('''INSERT OR IGNORE INTO verified_ratings(ratingID, vendor) VALUES (?,?)''',
+                               [(rating_id, vendor) for rating_id in rating_ids])
+            conn.commit()
+        conn.close()
+
+    def get_verified(self, vendor, rating_ids):
+        """
+        Return the set of `rating_ids` previously verified for `vendor`.
+        """
+        conn = self.pool.reader()
+        cursor = conn.cursor()
+        ret = set()
+        # stay under sqlite's limit on the number of bound parameters
+        for i in range(0, len(rating_ids), 500):
+            batch = rating_ids[i:i + 500]
+            cursor.execute('''SELECT ratingID FROM verified_ratings WHERE vendor=? AND ratingID IN (%s)'''
+                           % ",".join("?" * len(batch)), [vendor] + list(batch))
+            ret.update(row[0] for row in cursor.fetchall())
+        conn.close()
+        return ret
+
+
+class PublishedKeywords(object):
+    """
+    Records when each of our keyword entries was last stored in the DHT so
+    they're only republished as they near expiry.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def get_all(self):
+        """
+        Return a dict mapping (keyword, id) to the time it was last published.
+        """
+        conn = self.pool.reader()
+        cursor = conn.cursor()
+        cursor.execute('''SELECT keyword, id, timestamp FROM published''')
+        ret = dict(((keyword, entry_id), timestamp) for keyword, entry_id, timestamp in cursor.fetchall())
+        conn.close()
+        return ret
+
+    def update(self, keyword, entry_ids, timestamp):
+        conn = self.pool.writer()
+        with conn:
+            cursor = conn.cursor()
+            cursor.executemany('''INSERT OR REPLACE INTO published(keyword, id, timestamp) VALUES (?,?,?)''',
+                               [(keyword, entry_id, timestamp) for entry_id in entry_ids])
+            conn.commit()
+        conn.close()
+
+    def delete(self, entries):
+        """
+        Forget a list of (keyword, id) tuples.
+        """
+        conn = self.pool.writer()
+        with conn:
+            cursor = conn.cursor()
+            cursor.executemany('''DELETE FROM published WHERE keyword=? AND id=?''', entries)
+            conn.commit()
+        conn.close()
+
+
+class SeedNodes(object):
+    """
+    The nodes found by the seed crawler with how reliably they answer and
+    when they were last heard from, so a restarted seed doesn't have to
+    rediscover the network.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def get_all(self):
+        """
+        Return a list of (serialized node, score, first seen, last seen) tuples.
+        """
+        conn = self.pool.reader()
+        cursor = conn.cursor()
+        cursor.execute('''SELECT node, score, first_seen, last_seen FROM seed_nodes''')
+        ret = cursor.fetchall()
+        conn.close()
+        return ret
+
+    def update(self, entries):
+        """
+        Save a list of (guid, serialized node, score, first seen, last seen) tuples.
+        """
+        conn = self.pool.writer()
+        with conn:
+            cursor = conn.cursor()
+            cursor.executemany('''INSERT OR REPLACE INTO seed_nodes(guid, node, score, first_seen, last_seen)
+    VALUES (?,?,?,?,?)''', entries)
+            conn.commit()
+        conn.close()
+
+    def delete(self, guids):
+        conn = self.pool.writer()
+        with conn:
+            cursor = conn.cursor()
+            cursor.executemany('''DELETE FROM seed_nodes WHERE guid=?''', [(guid,) for guid in guids])
+            conn.commit()
+        conn.close()
+
 
 class Transactions(object):
     """
@@ -1313,11 +1823,11 @@ class Transactions(object):
     The transactions should be periodically rebroadcast to ensure they make it in the chain.
     """
 
-    def __init__(self, database_path):
-        self.PATH = database_path
+    def __init__(self, pool):
+        self.pool = pool
 
     def add_transaction(self, tx):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''INSERT INTO transactions(tx) VALUES (?)''', (tx,))
@@ -1325,7 +1835,7 @@ class Transactions(object):
         conn.close()
 
     def delete_transaction(self, tx):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''DELETE FROM transactions WHERE tx=?''', (tx,))
@@ -1333,7 +1843,7 @@ class Transactions(object):
         conn.close()
 
     def get_transactions(self):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT tx FROM transactions''')
         ret = cursor.fetchall()
@@ -1346,13 +1856,13 @@ class Settings(object):
     Stores the UI settings.
     """
 
-    def __init__(self, database_path):
-        self.PATH = database_path
+    def __init__(self, pool):
+        self.pool = pool
 
     def update(self, refundAddress, currencyCode, country, language, timeZone, notifications,
                shipping_addresses, blocked, terms_conditions, refund_policy, moderator_list, smtp_notifications,
                smtp_server, smtp_sender, smtp_recipient, smtp_username, smtp_password):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''INSERT OR REPLACE INTO settings(id, refundAddress, currencyCode, country,
@@ -1367,7 +1877,7 @@ smtpRecipient, smtpUsername, smtpPassword) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?
         conn.close()
 
     def get(self):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT * FROM settings WHERE id=1''')
         ret = cursor.fetchone()
@@ -1375,7 +1885,7 @@ smtpRecipient, smtpUsername, smtpPassword) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?
         return ret
 
     def set_credentials(self, username, password):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             cursor.execute('''INSERT OR REPLACE INTO settings(id, username, password) VALUES (?,?,?)''',
@@ -1384,7 +1894,7 @@ smtpRecipient, smtpUsername, smtpPassword) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?
         conn.close()
 
     def get_credentials(self):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT username, password FROM settings WHERE id=2''')
         ret = cursor.fetchone()
@@ -1396,11 +1906,11 @@ class ShoppingEvents(object):
     Stores audit events for shoppers on your storefront
     """
 
-    def __init__(self, database_path):
-        self.PATH = database_path
+    def __init__(self, pool):
+        self.pool = pool
 
     def set(self, shopper_guid, action_id, contract_hash=None):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.writer()
         with conn:
             cursor = conn.cursor()
             timestamp = int(time.time())
@@ -1412,7 +1922,7 @@ class ShoppingEvents(object):
         conn.close()
 
     def get(self):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT * FROM audit_shopping''')
         ret = cursor.fetchall()
@@ -1420,7 +1930,7 @@ class ShoppingEvents(object):
         return ret
 
     def get_events_by_id(self, event_id):
-        conn = Database.connect_database(self.PATH)
+        conn = self.pool.reader()
         cursor = conn.cursor()
         cursor.execute('''SELECT * FROM audit_shopping WHERE event_id=?''', event_id)
         ret = cursor.fetchall()
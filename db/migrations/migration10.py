@@ -0,0 +1,16 @@
+import sqlite3
+
+
+def migrate(database_path):
+    print "migrating to db version 10"
+    conn = sqlite3.connect(database_path)
+    conn.text_factory = str
+    cursor = conn.cursor()
+
+    # create new table, it's filled in as contracts are looked up
+    cursor.execute('''CREATE TABLE IF NOT EXISTS contract_files(id TEXT PRIMARY KEY, folder TEXT)''')
+
+    # update version
+    cursor.execute('''PRAGMA user_version = 10''')
+    conn.commit()
+    conn.close()
@@ -0,0 +1,17 @@
+import sqlite3
+
+
+def migrate(database_path):
+    print "migrating to db version 11"
+    conn = sqlite3.connect(database_path)
+    conn.text_factory = str
+    cursor = conn.cursor()
+
+    # create new table, replaces store/listings.pickle
+    cursor.execute('''CREATE TABLE IF NOT EXISTS published(keyword TEXT, id TEXT, timestamp INTEGER,
+    PRIMARY KEY(keyword, id))''')
+
+    # update version
+    cursor.execute('''PRAGMA user_version = 11''')
+    conn.commit()
+    conn.close()
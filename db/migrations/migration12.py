@@ -0,0 +1,17 @@
+import sqlite3
+
+
+def migrate(database_path):
+    print "migrating to db version 12"
+    conn = sqlite3.connect(database_path)
+    conn.text_factory = str
+    cursor = conn.cursor()
+
+    # create new table for the nodes found by the seed crawler
+    cursor.execute('''CREATE TABLE IF NOT EXISTS seed_nodes(guid BLOB PRIMARY KEY, node BLOB, score INTEGER,
+    first_seen INTEGER, last_seen INTEGER)''')
+
+    # update version
+    cursor.execute('''PRAGMA user_version = 12''')
+    conn.commit()
+    conn.close()
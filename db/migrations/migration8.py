@@ -0,0 +1,29 @@
+import sqlite3
+from protos.objects import Listings
+
+
+def migrate(database_path):
+    print "migrating to db version 8"
+    conn = sqlite3.connect(database_path)
+    conn.text_factory = str
+    cursor = conn.cursor()
+
+    # create new table
+    cursor.execute('''CREATE TABLE IF NOT EXISTS listing_metadata(contractHash BLOB PRIMARY KEY,
+    serializedListing BLOB)''')
+
+    # move the listings out of the serialized blob
+    cursor.execute('''SELECT serializedListings FROM listings WHERE id = 1''')
+    ret = cursor.fetchone()
+    if ret is not None and ret[0] is not None:
+        l = Listings()
+        l.ParseFromString(ret[0])
+        for listing in l.listing:
+            cursor.execute('''INSERT OR REPLACE INTO listing_metadata(contractHash, serializedListing)
+                          VALUES (?,?)''', (listing.contract_hash, listing.SerializeToString()))
+    cursor.execute('''DELETE FROM listings''')
+
+    # update version
+    cursor.execute('''PRAGMA user_version = 8''')
+    conn.commit()
+    conn.close()
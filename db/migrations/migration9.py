@@ -0,0 +1,17 @@
+import sqlite3
+
+
+def migrate(database_path):
+    print "migrating to db version 9"
+    conn = sqlite3.connect(database_path)
+    conn.text_factory = str
+    cursor = conn.cursor()
+
+    # create new table
+    cursor.execute('''CREATE TABLE IF NOT EXISTS verified_ratings(ratingID TEXT, vendor TEXT,
+    PRIMARY KEY(ratingID, vendor))''')
+
+    # update version
+    cursor.execute('''PRAGMA user_version = 9''')
+    conn.commit()
+    conn.close()
@@ -0,0 +1,93 @@
+"""
+Benchmark for the pooled datastore connections.
+
+Measures requests/sec for `MarketProtocol.rpc_get_image` and the
+`/api/v1/get_sales` handler with pooling disabled (a fresh connection per
+query, as before) and enabled. Run with `python -m db.tests.bench_datastore`.
+It is not collected by the test runner.
+"""
+import os
+import shutil
+import tempfile
+import time
+
+from twisted.internet import defer, reactor
+from twisted.web.test.requesthelper import DummyRequest
+
+from api.restapi import OpenBazaarAPI
+from config import DATA_FOLDER
+from db.datastore import ConnectionPool, Database
+from dht.node import Node
+from dht.utils import digest
+from market.protocol import MarketProtocol
+
+
+class BenchAPI(OpenBazaarAPI):
+    """
+    Just enough of the REST API to call its handlers directly.
+    """
+    # pylint: disable=super-init-not-called
+    def __init__(self, db):
+        self.db = db
+        self.authenticated_sessions = ["localhost"]
+
+
+class NullRouter(object):
+    def addContact(self, node):
+        pass
+
+
+@defer.inlineCallbacks
+def rate(name, func, count):
+    start = time.time()
+    for _ in range(count):
+        yield func()
+    elapsed = time.time() - start
+    print "%-24s %6d requests in %.3fs (%d req/sec)" % (name, count, elapsed, count / max(elapsed, 1e-9))
+
+
+def get_sales(api):
+    request = DummyRequest([])
+    api.get_sales(request)
+    return request.notifyFinish()
+
+
+@defer.inlineCallbacks
+def bench(db, image_hash, label, count):
+    protocol = MarketProtocol(Node(digest("bench")), NullRouter(), None, db)
+    sender = Node(digest("sender"), "127.0.0.1", 18467)
+    yield rate("rpc_get_image (%s)" % label, lambda: protocol.rpc_get_image(sender, image_hash), count)
+
+    api = BenchAPI(db)
+    yield rate("get_sales (%s)" % label, lambda: get_sales(api), count)
+
+
+@defer.inlineCallbacks
+def main(count=200):
+    folder = tempfile.mkdtemp()
+    fd, image_path = tempfile.mkstemp(dir=DATA_FOLDER)
+    try:
+        os.write(fd, os.urandom(64 * 1024))
+        os.close(fd)
+        db = Database(filepath=os.path.join(folder, "bench.db"))
+        image_hash = digest("image")
+        db.filemap.insert(image_hash.encode("hex"), os.path.relpath(image_path, DATA_FOLDER))
+        for i in range(5):
+            db.sales.new_sale(str(i), "title", "description", int(time.time()), 0.1, "address",
+                              0, "thumbnail", "buyer", "physical good")
+
+        for size, label in ((0, "unpooled"), (4, "pooled")):
+            db.pool.close()
+            object.__setattr__(db, "pool", ConnectionPool(db.PATH, size))
+            for store in ("filemap", "sales"):
+                getattr(db, store).pool = db.pool
+            yield bench(db, image_hash, label, count)
+        db.close()
+    finally:
+        os.remove(image_path)
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main().addBoth(lambda _: reactor.stop())
+    reactor.run()
@@ -1,7 +1,13 @@
+import json
 import os
+import shutil
+import tempfile
 import unittest
 import time
-from db.datastore import Database
+from collections import OrderedDict
+from db.contracts import ContractRepository, FOLDERS, PURCHASES_UNFUNDED, PURCHASES_IN_PROGRESS, CASES
+from db.datastore import Database, FileCache
+from db.migrations import migration8
 from dht.utils import digest
 from config import DATA_FOLDER
 from protos.objects import Profile, Listings, Following, Metadata, Followers, Node, FULL_CONE
@@ -70,6 +76,7 @@ class DatastoreTest(unittest.TestCase):
         self.settings = self.db.settings
 
     def tearDown(self):
+        self.db.close()
         os.remove("test.db")
 
     def test_hashmapInsert(self):
@@ -125,15 +132,30 @@ class DatastoreTest(unittest.TestCase):
         self.ls.delete_all_listings()
         self.ls.add_listing(self.lm)
         self.ls.delete_listing(self.test_hash)
-        l = self.ls.get_proto()
-        val = Listings()
-        val.ParseFromString(l)
-        self.assertEqual(0, len(val.listing))
+        self.assertIsNone(self.ls.get_proto())
 
         # Try to delete when table is already empty
         self.ls.delete_all_listings()
         self.assertEqual(None, self.ls.delete_listing(self.test_hash))
 
+    def test_getListing(self):
+        self.ls.delete_all_listings()
+        self.ls.add_listing(self.lm)
+        self.assertEqual(self.lm, self.ls.get_listing(self.test_hash))
+        self.assertIsNone(self.ls.get_listing(self.test_hash2))
+
+    def test_migrateListingsBlob(self):
+        l = Listings()
+        l.listing.extend([self.lm])
+        conn = self.db.pool.writer()
+        with conn:
+            conn.cursor().execute('''INSERT OR REPLACE INTO listings(id, serializedListings)
+                                  VALUES (?,?)''', (1, l.SerializeToString()))
+        migration8.migrate(self.db.PATH)
+        val = Listings()
+        val.ParseFromString(self.ls.get_proto())
+        self.assertEqual(l, val)
+
     def test_setGUIDKey(self):
         self.ks.set_key("guid", "privkey", "signed_privkey")
         key = self.ks.get_key("guid")
@@ -171,6 +193,20 @@ class DatastoreTest(unittest.TestCase):
         f = self.fd.get_followers()
         self.assertEqual(f[0], '')
 
+    def test_getFollowerGuids(self):
+        self.assertEqual(self.fd.get_follower_guids(), [])
+        for i in range(35):
+            self.f.guid = digest(str(i))
+            self.fd.set_follower(self.f.SerializeToString())
+        self.assertEqual(sorted(self.fd.get_follower_guids()), sorted(digest(str(i)) for i in range(35)))
+        self.fd.delete_follower(digest("0"))
+        self.assertNotIn(digest("0"), self.fd.get_follower_guids())
+
+    def test_getFollowersReleasesReader(self):
+        idle = len(self.db.pool.idle)
+        self.assertEqual(self.fd.get_followers(), ('', 0))
+        self.assertEqual(len(self.db.pool.idle), max(idle, 1))
+
     def test_MassageStore(self):
         msgs = self.ms.get_messages(self.u.guid, 'CHAT')
         self.assertEqual(0, len(msgs))
@@ -347,3 +383,104 @@ class DatastoreTest(unittest.TestCase):
 
 
 
+
+    def test_connectionPoolReusesConnections(self):
+        self.hm.insert(self.test_hash, self.test_file)
+        self.hm.get_file(self.test_hash)
+        opened = self.db.pool.get_stats()["opened"]
+        for _ in range(10):
+            self.hm.insert(self.test_hash2, self.test_file2)
+            self.assertEqual(self.hm.get_file(self.test_hash2), DATA_FOLDER + self.test_file2)
+        self.assertEqual(self.db.pool.get_stats()["opened"], opened)
+        self.assertEqual(self.db.pool.get_stats()["idle_readers"], 1)
+
+    def test_writerRollsBackOnError(self):
+        def fail():
+            conn = self.db.pool.writer()
+            with conn:
+                conn.cursor().execute('''INSERT INTO hashmap(hash, filepath) VALUES (?,?)''',
+                                      (self.test_hash, self.test_file))
+                raise ValueError
+        self.assertRaises(ValueError, fail)
+        self.assertIsNone(self.hm.get_file(self.test_hash))
+        self.hm.insert(self.test_hash, self.test_file)
+        self.assertEqual(self.hm.get_file(self.test_hash), DATA_FOLDER + self.test_file)
+
+    def test_fileCacheEvictsLeastRecentlyUsedBytes(self):
+        cache = FileCache(max_bytes=10)
+        cache.put(self.test_hash, "aaaa")
+        cache.put(self.test_hash2, "bbbb")
+        self.assertEqual(cache.get(self.test_hash), "aaaa")
+        cache.put("c", "cccc")
+        self.assertIsNone(cache.get(self.test_hash2))
+        self.assertEqual(cache.get(self.test_hash), "aaaa")
+        cache.put("d", "d" * 11)
+        self.assertIsNone(cache.get("d"))
+        cache.invalidate(self.test_hash)
+        self.assertIsNone(cache.get(self.test_hash))
+        stats = cache.get_stats()
+        self.assertEqual(stats["entries"], 1)
+        self.assertEqual(stats["size"], 4)
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 3)
+        self.assertEqual(stats["evictions"], 1)
+
+    def test_verifiedRatings(self):
+        self.db.ratings.add_verified("vendor", [self.test_hash, self.test_hash2])
+        self.db.ratings.add_verified("vendor", [self.test_hash])
+        self.assertEqual(self.db.ratings.get_verified("vendor", [self.test_hash, "other"]), {self.test_hash})
+        self.assertEqual(self.db.ratings.get_verified("other vendor", [self.test_hash]), set())
+        rating_ids = [str(i) for i in range(1200)]
+        self.db.ratings.add_verified("vendor", rating_ids)
+        self.assertEqual(len(self.db.ratings.get_verified("vendor", rating_ids)), 1200)
+
+    def test_contractRepository(self):
+        folder = tempfile.mkdtemp()
+        try:
+            for f in FOLDERS:
+                os.makedirs(os.path.join(folder, f))
+            contracts = ContractRepository(self.db.pool, 2, folder)
+            contract = OrderedDict([("buyer_order", OrderedDict([("quantity", 1)]))])
+            contracts.save("order1", contract, PURCHASES_UNFUNDED)
+            self.assertEqual(contracts.get_folder("order1"), PURCHASES_UNFUNDED)
+
+            self.assertTrue(contracts.move("order1", PURCHASES_IN_PROGRESS))
+            self.assertFalse(os.path.exists(os.path.join(folder, PURCHASES_UNFUNDED, "order1.json")))
+            self.assertEqual(contracts.get_path("order1"),
+                             os.path.join(folder, PURCHASES_IN_PROGRESS, "order1.json"))
+            self.assertEqual(contracts.load("order1"), contract)
+            self.assertFalse(contracts.move("missing", CASES))
+            self.assertIsNone(contracts.load("missing"))
+
+            # callers get their own copy
+            loaded = contracts.load("order1")
+            loaded["buyer_order"]["quantity"] = 2
+            self.assertEqual(contracts.load("order1")["buyer_order"]["quantity"], 1)
+
+            # files saved before the index existed are found and indexed
+            with open(os.path.join(folder, CASES, "order2.json"), "w") as outfile:
+                outfile.write(json.dumps(contract))
+            self.assertEqual(contracts.get_folder("order2"), CASES)
+            conn = self.db.pool.reader()
+            folders = dict(conn.cursor().execute("SELECT id, folder FROM contract_files").fetchall())
+            conn.close()
+            self.assertEqual(folders, {"order1": PURCHASES_IN_PROGRESS, "order2": CASES})
+
+            contracts.save("order3", contract, CASES)
+            contracts.load("order2")
+            self.assertEqual(contracts.get_stats()["entries"], 2)
+            self.assertNotIn("order1", contracts.entries)
+
+            contracts.delete("order3")
+            self.assertIsNone(contracts.get_folder("order3"))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_seedNodes(self):
+        guid = digest("node")
+        self.db.seed_nodes.update([(guid, "serialized", 3, 100, 200)])
+        self.db.seed_nodes.update([(guid, "serialized2", 4, 100, 300), (digest("other"), "other", 1, 150, 150)])
+        self.assertEqual(sorted(self.db.seed_nodes.get_all()),
+                         [("other", 1, 150, 150), ("serialized2", 4, 100, 300)])
+        self.db.seed_nodes.delete([guid])
+        self.assertEqual(self.db.seed_nodes.get_all(), [("other", 1, 150, 150)])
@@ -5,12 +5,13 @@ Copyright (c) 2014 Brian Muller
 Copyright (c) 2015 OpenBazaar
 """
 
+import os
 import pickle
-import httplib
 import random
 from binascii import hexlify
 from twisted.internet.task import LoopingCall
-from twisted.internet import defer, reactor, task
+from twisted.internet import defer, reactor
+from twisted.web.client import Agent, readBody
 
 import nacl.signing
 import nacl.hash
@@ -19,7 +20,7 @@ import nacl.encoding
 from seed import peers
 from log import Logger
 from dht.protocol import KademliaProtocol
-from dht.utils import deferredDict, digest
+from dht.utils import deferredDict, digest, LookupCache
 from dht.storage import ForgetfulStorage
 from dht.node import Node
 from dht.crawling import ValueSpiderCrawl
@@ -27,10 +28,52 @@ from dht.crawling import NodeSpiderCrawl
 
 from protos import objects
 
-from config import SEEDS, SEEDS_TESTNET
+from config import DATA_FOLDER, SEEDS, SEEDS_TESTNET
 from random import shuffle
 
 
+def fetchSeed(seed, pubkey, query="", timeout=10):
+    """
+    Fetch the list of nodes from an HTTP seed without blocking the reactor.
+
+    Args:
+        seed: A `string` consisting of "ip:port" or "hostname:port"
+        pubkey: The hex encoded public key to verify the signature on the response
+        query: the query string, for example "?type=vendors"
+
+    Returns:
+        A `Deferred` firing with a `list` of serialized `Node` protobufs. It errbacks if
+        the seed can't be reached within `timeout` seconds or the signature is invalid.
+    """
+    d = Agent(reactor, connectTimeout=timeout).request("GET", "http://%s/%s" % (seed, query))
+    timer = reactor.callLater(timeout, d.cancel)
+
+    def parse(data):
+        proto = peers.PeerSeeds()
+        proto.ParseFromString(data.decode("zlib"))
+        verify_key = nacl.signing.VerifyKey(pubkey, encoder=nacl.encoding.HexEncoder)
+        verify_key.verify("".join(proto.serializedNode), proto.signature)
+        return list(proto.serializedNode)
+
+    def stopTimer(result):
+        if timer.active():
+            timer.cancel()
+        return result
+    return d.addCallback(readBody).addBoth(stopTimer).addCallback(parse)
+
+
+def _minimumTTL(values):
+    """
+    Return the smallest ttl of a list of serialized `Value` objects.
+    """
+    ttls = []
+    for value in values:
+        v = objects.Value()
+        v.ParseFromString(value)
+        ttls.append(v.ttl)
+    return min(ttls)
+
+
 def _anyRespondSuccess(responses):
     """
     Given the result of a DeferredList of calls to peers, ensure that at least
@@ -64,8 +107,16 @@ class Server(object):
         self.alpha = alpha
         self.log = Logger(system=self)
         self.storage = storage or ForgetfulStorage()
+        self.storage.start_expiry()
         self.node = node
         self.protocol = KademliaProtocol(self.node, self.storage, ksize, db, signing_key)
+        self.protocol.timeoutListeners.append(lambda node: self.nodeCache.invalidate(node.id))
+        self.pendingStores = {}
+        self.storeDelay = 1
+        self.valueCache = LookupCache(60)
+        self.nodeCache = LookupCache(300)
+        self.seedCache = os.path.join(DATA_FOLDER, "seeds.pickle")
+        self.seedPeers = []
         self.refreshLoop = LoopingCall(self.refreshTable)
         reactor.callLater(1800, self.refreshLoop.start, 3600)
 
@@ -101,44 +152,76 @@ class Server(object):
 
         return defer.gatherResults(ds).addCallback(republishKeys)
 
-    def querySeed(self, list_seed_pubkey):
+    def querySeed(self, list_seed_pubkey, useCache=True):
         """
-        Query an HTTP seed and return a `list` if (ip, port) `tuple` pairs.
+        Query all the HTTP seeds for peers at once.
 
         Args:
             Receives a list of one or more tuples Example [(seed, pubkey)]
             seed: A `string` consisting of "ip:port" or "hostname:port"
             pubkey: The hex encoded public key to verify the signature on the response
-        """
+            useCache: Start with the peers saved from the last successful query, if any.
 
-        nodes = []
+        Returns:
+            A `Deferred` firing with a `list` of (ip, port) `tuple` pairs as soon as the
+            first seed responds with a valid signature, or straight away if we have saved
+            peers. Peers from the seeds responding after that are bootstrapped as they
+            arrive. Fires with an empty `list` if no seed could be reached.
+        """
         if not list_seed_pubkey:
             self.log.error('failed to query seed {0} from ob.cfg'.format(list_seed_pubkey))
-            return nodes
-        else:
-            for sp in list_seed_pubkey:
-                seed, pubkey = sp
-                try:
-                    self.log.info("querying %s for peers" % seed)
-                    c = httplib.HTTPConnection(seed)
-                    c.request("GET", "/")
-                    response = c.getresponse()
-                    self.log.debug("Http response from %s: %s, %s" % (seed, response.status, response.reason))
-                    data = response.read()
-                    reread_data = data.decode("zlib")
-                    proto = peers.PeerSeeds()
-                    proto.ParseFromString(reread_data)
-                    for peer in proto.serializedNode:
-                        n = objects.Node()
-                        n.ParseFromString(peer)
-                        tup = (str(n.nodeAddress.ip), n.nodeAddress.port)
-                        nodes.append(tup)
-                    verify_key = nacl.signing.VerifyKey(pubkey, encoder=nacl.encoding.HexEncoder)
-                    verify_key.verify("".join(proto.serializedNode), proto.signature)
-                    self.log.info("%s returned %s addresses" % (seed, len(nodes)))
-                except Exception, e:
-                    self.log.error("failed to query seed: %s" % str(e))
-            return nodes
+            return defer.succeed([])
+
+        d = defer.Deferred()
+        if useCache and os.path.isfile(self.seedCache):
+            try:
+                with open(self.seedCache, 'r') as f:
+                    cached = pickle.load(f)
+                if len(cached) > 0:
+                    self.log.info("starting with %s addresses saved from the seeds" % len(cached))
+                    d.callback(cached)
+            except Exception:
+                self.log.warning("failed to load the saved seed peers")
+        pending = [len(list_seed_pubkey)]
+
+        def parse(serializedNodes, seed):
+            nodes = []
+            for peer in serializedNodes:
+                n = objects.Node()
+                n.ParseFromString(peer)
+                nodes.append((str(n.nodeAddress.ip), n.nodeAddress.port))
+            self.log.info("%s returned %s addresses" % (seed, len(nodes)))
+            self.saveSeedPeers(nodes)
+            if not d.called:
+                d.callback(nodes)
+            else:
+                self.bootstrap(nodes, retry=False)
+
+        def failed(failure, seed):
+            self.log.error("failed to query seed %s: %s" % (seed, failure.getErrorMessage()))
+
+        def done(_):
+            pending[0] -= 1
+            if pending[0] == 0 and not d.called:
+                d.callback([])
+
+        for seed, pubkey in list_seed_pubkey:
+            self.log.info("querying %s for peers" % seed)
+            fetchSeed(seed, pubkey).addCallback(parse, seed).addErrback(failed, seed).addBoth(done)
+        return d
+
+    def saveSeedPeers(self, nodes):
+        """
+        Add the peers from a seed to the list we start with next time.
+        """
+        for node in nodes:
+            if node not in self.seedPeers:
+                self.seedPeers.append(node)
+        try:
+            with open(self.seedCache, 'w') as f:
+                pickle.dump(self.seedPeers, f)
+        except Exception:
+            self.log.warning("failed to save the seed peers")
 
     def bootstrappableNeighbors(self):
         """
@@ -153,25 +236,31 @@ class Server(object):
         neighbors = self.protocol.router.findNeighbors(self.node)
         return [tuple(n)[-2:] for n in neighbors]
 
-    def bootstrap(self, addrs, deferred=None):
+    def bootstrap(self, addrs, deferred=None, retry=True):
         """
         Bootstrap the server by connecting to other known nodes in the network.
 
         Args:
-            addrs: A `list` of (ip, port) `tuple` pairs.  Note that only IP addresses
+            addrs: A `list` of (ip, port) `tuple` pairs, or a `Deferred` firing with one
+                   such as returned by `querySeed`.  Note that only IP addresses
                    are acceptable - hostnames will cause an error.
+            retry: If none of the nodes respond, query the seeds again.
         """
-
-        # if the transport hasn't been initialized yet, wait a second
-        if self.protocol.multiplexer.transport is None:
-            return task.deferLater(reactor, 1, self.bootstrap, addrs)
-        self.log.info("bootstrapping with %s addresses, finding neighbors..." % len(addrs))
-
         if deferred is None:
             d = defer.Deferred()
         else:
             d = deferred
 
+        if isinstance(addrs, defer.Deferred):
+            addrs.addCallback(lambda found: self.bootstrap(found, d, retry) and None)
+            return d
+
+        # if the transport hasn't been initialized yet, wait a second
+        if self.protocol.multiplexer.transport is None:
+            reactor.callLater(1, self.bootstrap, addrs, d, retry)
+            return d
+        self.log.info("bootstrapping with %s addresses, finding neighbors..." % len(addrs))
+
         def initTable(results):
             response = False
             potential_relay_nodes = []
@@ -196,10 +285,10 @@ class Server(object):
                     except Exception:
                         self.log.warning("bootstrap node returned invalid GUID")
             if not response:
-                if self.protocol.multiplexer.testnet:
-                    self.bootstrap(self.querySeed(SEEDS_TESTNET), d)
-                else:
-                    self.bootstrap(self.querySeed(SEEDS), d)
+                if retry:
+                    seeds = SEEDS_TESTNET if self.protocol.multiplexer.testnet else SEEDS
+                    self.log.warning("no bootstrap nodes responded, querying the seeds again in 10 seconds")
+                    reactor.callLater(10, lambda: self.bootstrap(self.querySeed(seeds, False), d))
                 return
             if len(potential_relay_nodes) > 0 and self.node.nat_type != objects.FULL_CONE:
                 shuffle(potential_relay_nodes)
@@ -246,13 +335,16 @@ class Server(object):
             :class:`None` if not found, the value otherwise.
         """
         dkey = digest(keyword)
-        node = Node(dkey)
-        nearest = self.protocol.router.findNeighbors(node)
-        if len(nearest) == 0:
-            self.log.warning("there are no known neighbors to get key %s" % dkey.encode('hex'))
-            return defer.succeed(None)
-        spider = ValueSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha, save_at_nearest)
-        return spider.find()
+
+        def crawl():
+            node = Node(dkey)
+            nearest = self.protocol.router.findNeighbors(node)
+            if len(nearest) == 0:
+                self.log.warning("there are no known neighbors to get key %s" % dkey.encode('hex'))
+                return defer.succeed(None)
+            spider = ValueSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha, save_at_nearest)
+            return spider.find()
+        return self.valueCache.lookup(dkey, crawl, _minimumTTL)
 
     def set(self, keyword, key, value, ttl=604800):
         """
@@ -271,18 +363,34 @@ class Server(object):
         Return: True if at least one peer responded. False if the store rpc
             completely failed.
         """
+        return self.setMany(keyword, [(key, value)], ttl)
+
+    def setMany(self, keyword, values, ttl=604800):
+        """
+        Like `set` but stores several key/value tuples under the same keyword
+        after a single lookup of the nodes closest to it.
+
+        Args:
+            keyword: The keyword to use. Should be hashed with hash160 before
+                passing it in here.
+            values: a list of (key, value) tuples as would be passed to `set`.
+
+        Return: True if at least one peer responded to at least one store.
+        """
         if len(keyword) != 20:
             return defer.succeed(False)
 
-        self.log.debug("setting '%s' on network" % keyword.encode("hex"))
+        self.log.debug("setting %s values at '%s' on network" % (len(values), keyword.encode("hex")))
+        self.valueCache.invalidate(keyword)
 
         def store(nodes):
             self.log.debug("setting '%s' on %s" % (keyword.encode("hex"), [str(i) for i in nodes]))
-            ds = [self.protocol.callStore(node, keyword, key, value, ttl) for node in nodes]
+            ds = [self.queueStore(node, [(keyword, key, value, ttl) for key, value in values]) for node in nodes]
 
             keynode = Node(keyword)
             if self.node.distanceTo(keynode) < max([n.distanceTo(keynode) for n in nodes]):
-                self.storage[keyword] = (key, value, ttl)
+                for key, value in values:
+                    self.storage[keyword] = (key, value, ttl)
                 self.log.debug("got a store request from %s, storing value" % str(self.node))
 
             return defer.DeferredList(ds).addCallback(_anyRespondSuccess)
@@ -295,6 +403,34 @@ class Server(object):
         spider = NodeSpiderCrawl(self.protocol, node, nearest, self.ksize, self.alpha)
         return spider.find().addCallback(store)
 
+    def queueStore(self, node, values):
+        """
+        Queue a list of (keyword, key, value, ttl) tuples to be stored on
+        `node`. Everything queued for the same node within `storeDelay`
+        seconds is sent together in as few STORE_MANY messages as possible.
+
+        Returns:
+            A `Deferred` firing with (reached, responses) for these values.
+        """
+        d = defer.Deferred()
+        if node.id not in self.pendingStores:
+            self.pendingStores[node.id] = (node, [], [])
+            reactor.callLater(self.storeDelay, self.sendStores, node.id)
+        queued, waiting = self.pendingStores[node.id][1:]
+        waiting.append((d, len(queued), len(queued) + len(values)))
+        queued.extend(values)
+        return d
+
+    def sendStores(self, nodeId):
+        node, queued, waiting = self.pendingStores.pop(nodeId)
+        self.log.debug("sending %s queued stores to %s" % (len(queued), str(node)))
+
+        def sent(result):
+            reached, responses = result
+            for d, start, end in waiting:
+                d.callback((reached, responses[start:end]))
+        return self.protocol.callStoreMany(node, queued).addCallback(sent)
+
     def delete(self, keyword, key, signature):
         """
         Delete the given key/value pair from the keyword dictionary on the network.
@@ -311,6 +447,7 @@ class Server(object):
         """
         self.log.debug("deleting '%s':'%s' from the network" % (keyword.encode("hex"), key.encode("hex")))
         dkey = digest(keyword)
+        self.valueCache.invalidate(dkey)
 
         def delete(nodes):
             self.log.debug("deleting '%s' on %s" % (key.encode("hex"), [str(i) for i in nodes]))
@@ -360,13 +497,14 @@ class Server(object):
                 self.log.debug("%s successfully resolved as %s" % (guid.encode("hex"), node))
                 return defer.succeed(node)
 
-        nearest = self.protocol.router.findNeighbors(node_to_find)
-        if len(nearest) == 0:
-            self.log.warning("there are no known neighbors to find node %s" % node_to_find.id.encode("hex"))
-            return defer.succeed(None)
-
-        spider = NodeSpiderCrawl(self.protocol, node_to_find, nearest, self.ksize, self.alpha, True)
-        return spider.find().addCallback(check_for_node)
+        def crawl():
+            nearest = self.protocol.router.findNeighbors(node_to_find)
+            if len(nearest) == 0:
+                self.log.warning("there are no known neighbors to find node %s" % node_to_find.id.encode("hex"))
+                return defer.succeed(None)
+            spider = NodeSpiderCrawl(self.protocol, node_to_find, nearest, self.ksize, self.alpha, True)
+            return spider.find().addCallback(check_for_node)
+        return self.nodeCache.lookup(guid, crawl)
 
     def saveState(self, fname):
         """
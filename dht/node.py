@@ -2,43 +2,79 @@
 Copyright (c) 2014 Brian Muller
 Copyright (c) 2015 OpenBazaar
 """
-import heapq
+import bisect
 
-from operator import itemgetter
 from protos import objects
 
 
+# the attributes which end up in the objects.Node protobuf
+WIRE_FIELDS = frozenset(['id', 'ip', 'port', 'pubkey', 'relay_node', 'nat_type', 'vendor'])
+
+
 class Node(object):
-    def __init__(self, node_id, ip=None, port=None, pubkey=None,
-                 relay_node=None, nat_type=None, vendor=False):
-        self.id = node_id
-        self.ip = ip
-        self.port = port
-        self.pubkey = pubkey
-        self.relay_node = relay_node
-        self.nat_type = nat_type
-        self.vendor = vendor
-        self.long_id = long(node_id.encode('hex'), 16)
+    """
+    A peer on the network. Nodes are created for every message we receive
+    and the routing table holds thousands so they have no per-instance dict.
 
-    def getProto(self):
-        node_address = objects.Node.IPAddress()
-        node_address.ip = self.ip
-        node_address.port = self.port
+    The protobuf for the node is built the first time it's asked for and kept
+    until one of the attributes it's made from is set again.
+    """
 
-        n = objects.Node()
-        n.guid = self.id
-        n.publicKey = self.pubkey
-        n.natType = self.nat_type
-        n.nodeAddress.MergeFrom(node_address)
-        n.vendor = self.vendor
+    __slots__ = ['id', 'ip', 'port', 'pubkey', 'relay_node', 'nat_type', 'vendor', 'long_id',
+                 '_proto', '_serialized']
 
-        if self.relay_node is not None:
-            relay_address = objects.Node.IPAddress()
-            relay_address.ip = self.relay_node[0]
-            relay_address.port = self.relay_node[1]
-            n.relayAddress.MergeFrom(relay_address)
+    def __init__(self, node_id, ip=None, port=None, pubkey=None,
+                 relay_node=None, nat_type=None, vendor=False):
+        setattr_ = object.__setattr__
+        setattr_(self, 'id', node_id)
+        setattr_(self, 'ip', ip)
+        setattr_(self, 'port', port)
+        setattr_(self, 'pubkey', pubkey)
+        setattr_(self, 'relay_node', relay_node)
+        setattr_(self, 'nat_type', nat_type)
+        setattr_(self, 'vendor', vendor)
+        setattr_(self, 'long_id', long(node_id.encode('hex'), 16))
+        setattr_(self, '_proto', None)
+        setattr_(self, '_serialized', None)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in WIRE_FIELDS:
+            object.__setattr__(self, '_proto', None)
+            object.__setattr__(self, '_serialized', None)
 
-        return n
+    def getProto(self):
+        """
+        Return the `objects.Node` for this node. The message is shared by
+        every caller so it must not be modified, copy it with `MergeFrom`.
+        """
+        if self._proto is None:
+            node_address = objects.Node.IPAddress()
+            node_address.ip = self.ip
+            node_address.port = self.port
+
+            n = objects.Node()
+            n.guid = self.id
+            n.publicKey = self.pubkey
+            n.natType = self.nat_type
+            n.nodeAddress.MergeFrom(node_address)
+            n.vendor = self.vendor
+
+            if self.relay_node is not None:
+                relay_address = objects.Node.IPAddress()
+                relay_address.ip = self.relay_node[0]
+                relay_address.port = self.relay_node[1]
+                n.relayAddress.MergeFrom(relay_address)
+            object.__setattr__(self, '_proto', n)
+        return self._proto
+
+    def getSerializedProto(self):
+        """
+        Return `getProto()` serialized to a string.
+        """
+        if self._serialized is None:
+            object.__setattr__(self, '_serialized', self.getProto().SerializeToString())
+        return self._serialized
 
     def sameHomeAs(self, node):
         return self.ip == node.ip and self.port == node.port
@@ -61,9 +97,15 @@ class Node(object):
     def __str__(self):
         return "%s:%s" % (self.ip, str(self.port))
 
+
 class NodeHeap(object):
     """
     A heap of nodes ordered by distance to a given node.
+
+    Nodes are kept in a list sorted by distance alongside a dict keyed by
+    node id, so membership tests and lookups by id are constant time and
+    the visible (closest C{maxsize}) nodes are a slice rather than a fresh
+    heap selection on every call.
     """
 
     def __init__(self, node, maxsize):
@@ -75,6 +117,7 @@ class NodeHeap(object):
         """
         self.node = node
         self.heap = []
+        self.nodes = {}
         self.contacted = set()
         self.maxsize = maxsize
 
@@ -86,33 +129,28 @@ class NodeHeap(object):
         removal of nodes may not change the visible size as previously added
         nodes suddenly become visible.
         """
-        peerIDs = set(peerIDs)
-        if len(peerIDs) == 0:
-            return
-        nheap = []
-        for distance, node in self.heap:
-            if node.id not in peerIDs:
-                heapq.heappush(nheap, (distance, node))
-        self.heap = nheap
+        for peerID in set(peerIDs):
+            node = self.nodes.pop(peerID, None)
+            if node is not None:
+                entry = (self.node.distanceTo(node), peerID)
+                del self.heap[bisect.bisect_left(self.heap, entry)]
 
     def getNodeById(self, node_id):
-        for _, node in self.heap:
-            if node.id == node_id:
-                return node
-        return None
+        return self.nodes.get(node_id, None)
 
     def allBeenContacted(self):
         return len(self.getUncontacted()) == 0
 
     def getIDs(self):
-        return [n.id for n in self]
+        return [node_id for _, node_id in self.heap[:self.maxsize]]
 
     def markContacted(self, node):
         self.contacted.add(node.id)
 
     def popleft(self):
         if len(self) > 0:
-            return heapq.heappop(self.heap)[1]
+            _, node_id = self.heap.pop(0)
+            return self.nodes.pop(node_id)
         return None
 
     def push(self, nodes):
@@ -127,21 +165,18 @@ class NodeHeap(object):
         for node in nodes:
             if node not in self:
                 distance = self.node.distanceTo(node)
-                heapq.heappush(self.heap, (distance, node))
+                bisect.insort(self.heap, (distance, node.id))
+                self.nodes[node.id] = node
 
     def __len__(self):
         return min(len(self.heap), self.maxsize)
 
     def __iter__(self):
-        nodes = heapq.nsmallest(self.maxsize, self.heap)
-        return iter(map(itemgetter(1), nodes))
+        return iter([self.nodes[node_id] for _, node_id in self.heap[:self.maxsize]])
 
     def __contains__(self, node):
-        # pylint: disable=unused-variable
-        for distance, n in self.heap:
-            if node.id == n.id:
-                return True
-        return False
+        return node.id in self.nodes
 
     def getUncontacted(self):
-        return [n for n in self if n.id not in self.contacted]
+        return [self.nodes[node_id] for _, node_id in self.heap[:self.maxsize]
+                if node_id not in self.contacted]
@@ -4,7 +4,7 @@ Copyright (c) 2015 OpenBazaar
 """
 
 import random
-from twisted.internet import reactor
+from twisted.internet import defer, reactor
 from zope.interface import implements
 import nacl.signing
 
@@ -15,7 +15,7 @@ from log import Logger
 from net.rpcudp import RPCProtocol
 from interfaces import MessageProcessor
 from protos import objects
-from protos.message import PING, STUN, STORE, DELETE, FIND_NODE, FIND_VALUE, HOLE_PUNCH, INV, VALUES
+from protos.message import PING, STUN, STORE, DELETE, FIND_NODE, FIND_VALUE, HOLE_PUNCH, INV, VALUES, STORE_MANY
 
 
 class KademliaProtocol(RPCProtocol):
@@ -30,8 +30,10 @@ class KademliaProtocol(RPCProtocol):
         self.db = database
         self.signing_key = signing_key
         self.log = Logger(system=self)
-        self.handled_commands = [PING, STUN, STORE, DELETE, FIND_NODE, FIND_VALUE, HOLE_PUNCH, INV, VALUES]
+        self.handled_commands = [PING, STUN, STORE, DELETE, FIND_NODE, FIND_VALUE, HOLE_PUNCH, INV, VALUES,
+                                 STORE_MANY]
         self.recent_transfers = set()
+        self.timeoutListeners = []
         RPCProtocol.__init__(self, sourceNode, self.router)
 
     def connect_multiplexer(self, multiplexer):
@@ -52,7 +54,7 @@ class KademliaProtocol(RPCProtocol):
 
     def rpc_ping(self, sender):
         self.addToRouter(sender)
-        return [self.sourceNode.getProto().SerializeToString()]
+        return [self.sourceNode.getSerializedProto()]
 
     def rpc_store(self, sender, keyword, key, value, ttl):
         self.addToRouter(sender)
@@ -63,6 +65,28 @@ class KademliaProtocol(RPCProtocol):
         else:
             return ["False"]
 
+    def rpc_store_many(self, sender, *serialized_values):
+        """
+        A STORE for up to 100 serialized `Value` objects at once. The response
+        has a "True" or "False" for each value, in order.
+        """
+        self.addToRouter(sender)
+        self.log.debug("got a store request for %s values from %s" % (len(serialized_values), str(sender)))
+        ret = []
+        for val in serialized_values[:100]:
+            try:
+                v = objects.Value()
+                v.ParseFromString(val)
+                if len(v.keyword) == 20 and len(v.valueKey) <= 33 and len(v.serializedData) <= 2100 \
+                        and v.ttl <= 604800:
+                    self.storage[v.keyword] = (v.valueKey, v.serializedData, int(v.ttl))
+                    ret.append("True")
+                else:
+                    ret.append("False")
+            except Exception:
+                ret.append("False")
+        return ret
+
     def rpc_delete(self, sender, keyword, key, signature):
         self.addToRouter(sender)
         value = self.storage.getSpecific(keyword, key)
@@ -100,9 +124,9 @@ class KademliaProtocol(RPCProtocol):
         nodeList = self.router.findNeighbors(node, exclude=sender)
         ret = []
         if self.sourceNode.id == key:
-            ret.append(self.sourceNode.getProto().SerializeToString())
+            ret.append(self.sourceNode.getSerializedProto())
         for n in nodeList:
-            ret.append(n.getProto().SerializeToString())
+            ret.append(n.getSerializedProto())
         return ret
 
     def rpc_find_value(self, sender, keyword):
@@ -154,6 +178,46 @@ class KademliaProtocol(RPCProtocol):
         d = self.store(nodeToAsk, keyword, key, value, str(int(round(ttl))))
         return d.addCallback(self.handleCallResponse, nodeToAsk)
 
+    def callStoreMany(self, nodeToAsk, values):
+        """
+        Store a list of (keyword, key, value, ttl) tuples on `nodeToAsk`, in
+        STORE_MANY messages of up to 100 values if it understands them or
+        else one STORE each.
+
+        Returns:
+            A `Deferred` firing with (reached, responses) where responses has
+            a "True" or "False" for each value.
+        """
+        peer = (nodeToAsk.ip, nodeToAsk.port)
+        if peer in self.multiplexer and self.multiplexer[peer].handler.remote_node_version > 2:
+            batches = [values[i:i + 100] for i in range(0, len(values), 100)]
+            ds = []
+            for batch in batches:
+                serialized = []
+                for keyword, key, value, ttl in batch:
+                    v = objects.Value()
+                    v.keyword = keyword
+                    v.valueKey = key
+                    v.serializedData = value
+                    v.ttl = int(round(ttl))
+                    serialized.append(v.SerializeToString())
+                ds.append(self.store_many(nodeToAsk, *serialized).addCallback(self.handleCallResponse, nodeToAsk))
+        else:
+            batches = [[v] for v in values]
+            ds = [self.callStore(nodeToAsk, keyword, key, value, ttl) for keyword, key, value, ttl in values]
+
+        def combine(results):
+            reached = False
+            responses = []
+            for batch, (success, result) in zip(batches, results):
+                if success and result[0] and result[1] is not None:
+                    reached = True
+                    responses.extend((list(result[1]) + ["False"] * len(batch))[:len(batch)])
+                else:
+                    responses.extend(["False"] * len(batch))
+            return reached, responses
+        return defer.DeferredList(ds).addCallback(combine)
+
     def callDelete(self, nodeToAsk, keyword, key, signature):
         d = self.delete(nodeToAsk, keyword, key, signature)
         return d.addCallback(self.handleCallResponse, nodeToAsk)
@@ -200,10 +264,9 @@ class KademliaProtocol(RPCProtocol):
                     self.callValues(node, values)
 
         inv = []
-        for keyword in self.storage.iterkeys():
-            keyword = keyword[0].decode("hex")
-            keynode = Node(keyword)
-            neighbors = self.router.findNeighbors(keynode, exclude=node)
+        keynodes = [Node(keyword[0].decode("hex")) for keyword in self.storage.iterkeys()]
+        for keynode, neighbors in zip(keynodes, self.router.findNeighborsMany(keynodes, exclude=node)):
+            keyword = keynode.id
             if len(neighbors) > 0:
                 newNodeClose = node.distanceTo(keynode) < neighbors[-1].distanceTo(keynode)
                 thisNodeClosest = self.sourceNode.distanceTo(keynode) < neighbors[0].distanceTo(keynode)
@@ -221,6 +284,14 @@ class KademliaProtocol(RPCProtocol):
         if len(inv) > 0:
             self.callInv(node, inv[:100]).addCallback(send_values)
 
+    def timeout(self, node):
+        """
+        Let the timeout listeners know we lost `node` before dropping it.
+        """
+        for listener in self.timeoutListeners:
+            listener(node)
+        RPCProtocol.timeout(self, node)
+
     def handleCallResponse(self, result, node):
         """
         If we get a response, add the node to the routing table.  If
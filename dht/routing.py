@@ -2,9 +2,8 @@
 Copyright (c) 2014 Brian Muller
 """
 
-import heapq
+import bisect
 import time
-import operator
 from collections import OrderedDict
 
 from dht.utils import OrderedSet, sharedPrefix
@@ -34,14 +33,20 @@ class KBucket(object):
         return one, two
 
     def removeNode(self, node):
+        """
+        Remove a C{Node} from the C{KBucket}.  Return the replacement node
+        that took its place, if any.
+        """
         if node.id not in self.nodes:
-            return
+            return None
 
         # delete node, and see if we can add a replacement
         del self.nodes[node.id]
         if len(self.replacementNodes) > 0:
             newnode = self.replacementNodes.pop()
             self.nodes[newnode.id] = newnode
+            return newnode
+        return None
 
     def hasInRange(self, node):
         return self.range[0] <= node.long_id <= self.range[1]
@@ -81,36 +86,65 @@ class KBucket(object):
         return len(self.nodes)
 
 
-class TableTraverser(object):
-    def __init__(self, table, startNode):
-        index = table.getBucketFor(startNode)
-        table.buckets[index].touchLastUpdated()
-        self.currentNodes = table.buckets[index].getNodes()
-        self.leftBuckets = table.buckets[:index]
-        self.rightBuckets = table.buckets[(index + 1):]
-        self.left = True
+class NeighborIndex(object):
+    """
+    Every node in the routing table's buckets sorted by id, so the exact k
+    closest nodes to an id can be found without computing the distance to
+    every contact.
 
-    def __iter__(self):
-        return self
+    Under the xor metric every id sharing a longer prefix with the target is
+    closer than any id that doesn't, so a query walks down the sorted list
+    bit by bit, taking the half of each range on the target's side first.
+    """
 
-    def next(self):
-        """
-        Pop an item from the left subtree, then right, then left, etc.
-        """
-        if len(self.currentNodes) > 0:
-            return self.currentNodes.pop()
+    def __init__(self):
+        self.ids = []
+        self.nodes = []
 
-        if self.left and len(self.leftBuckets) > 0:
-            self.currentNodes = self.leftBuckets.pop().getNodes()
-            self.left = False
-            return self.next()
+    def add(self, node):
+        index = bisect.bisect_left(self.ids, node.long_id)
+        if index < len(self.ids) and self.ids[index] == node.long_id:
+            self.nodes[index] = node
+        else:
+            self.ids.insert(index, node.long_id)
+            self.nodes.insert(index, node)
 
-        if len(self.rightBuckets) > 0:
-            self.currentNodes = self.rightBuckets.pop().getNodes()
-            self.left = True
-            return self.next()
+    def remove(self, node):
+        index = bisect.bisect_left(self.ids, node.long_id)
+        if index < len(self.ids) and self.ids[index] == node.long_id:
+            del self.ids[index]
+            del self.nodes[index]
 
-        raise StopIteration
+    def closest(self, target, k, exclude=None):
+        """
+        Return the `k` nodes closest to the long id `target`, nearest first,
+        skipping any on the same address as `exclude`.
+        """
+        found = []
+        self._collect(target, k, exclude, 0, len(self.ids), 159, found)
+        return found
+
+    def _collect(self, target, k, exclude, lo, hi, bit, found):
+        if hi - lo <= 8 or bit < 0:
+            candidates = sorted(range(lo, hi), key=lambda i: self.ids[i] ^ target)
+            for i in candidates:
+                if len(found) == k:
+                    return
+                if exclude is None or not self.nodes[i].sameHomeAs(exclude):
+                    found.append(self.nodes[i])
+            return
+        # every id in the range shares the bits above `bit`
+        mid = bisect.bisect_left(self.ids, ((self.ids[lo] >> bit) | 1) << bit, lo, hi)
+        if target >> bit & 1:
+            near, far = (mid, hi), (lo, mid)
+        else:
+            near, far = (lo, mid), (mid, hi)
+        self._collect(target, k, exclude, near[0], near[1], bit - 1, found)
+        if len(found) < k:
+            self._collect(target, k, exclude, far[0], far[1], bit - 1, found)
+
+    def __len__(self):
+        return len(self.ids)
 
 
 class RoutingTable(object):
@@ -127,11 +161,19 @@ class RoutingTable(object):
 
     def flush(self):
         self.buckets = [KBucket(0, 2 ** 160, self.ksize)]
+        # Sorted upper bounds of self.buckets, so the bucket for an id can
+        # be found with a binary search instead of a scan of every bucket.
+        self.bucketBounds = [2 ** 160]
+        # (ip, port) -> node for every node currently held in a bucket.
+        self.addresses = {}
+        self.neighbors = NeighborIndex()
 
     def splitBucket(self, index):
         one, two = self.buckets[index].split()
         self.buckets[index] = one
         self.buckets.insert(index + 1, two)
+        self.bucketBounds[index] = one.range[1]
+        self.bucketBounds.insert(index + 1, two.range[1])
 
     def getLonelyBuckets(self):
         """
@@ -142,25 +184,35 @@ class RoutingTable(object):
 
     def removeContact(self, node):
         index = self.getBucketFor(node)
-        self.buckets[index].removeNode(node)
+        bucket = self.buckets[index]
+        existing = bucket[node.id]
+        if existing is None:
+            return
+        replacement = bucket.removeNode(node)
+        self._unindexAddress(existing)
+        if replacement is not None:
+            self._indexAddress(replacement)
 
     def isNewNode(self, node):
         index = self.getBucketFor(node)
         return self.buckets[index].isNewNode(node)
 
     def checkAndRemoveDuplicate(self, node):
-        for bucket in self.buckets:
-            for n in bucket.getNodes():
-                if (n.ip, n.port) == (node.ip, node.port) and n.id != node.id:
-                    self.removeContact(n)
+        existing = self.addresses.get((node.ip, node.port), None)
+        if existing is not None and existing.id != node.id:
+            self.removeContact(existing)
 
     def addContact(self, node):
         self.checkAndRemoveDuplicate(node)
         index = self.getBucketFor(node)
         bucket = self.buckets[index]
+        previous = bucket[node.id]
 
         # this will succeed unless the bucket is full
         if bucket.addNode(node):
+            if previous is not None:
+                self._unindexAddress(previous)
+            self._indexAddress(node)
             return
 
         # Per section 4.2 of paper, split if the bucket has the node in its range
@@ -175,17 +227,41 @@ class RoutingTable(object):
         """
         Get the index of the bucket that the given node would fall into.
         """
-        for index, bucket in enumerate(self.buckets):
-            if node.long_id < bucket.range[1]:
-                return index
+        index = bisect.bisect_right(self.bucketBounds, node.long_id)
+        if index < len(self.buckets):
+            return index
+
+    def _indexAddress(self, node):
+        """
+        Record the address of a node that was just placed in a bucket. A node
+        promoted from a replacement list may share its address with a node we
+        already hold, in which case the older one is dropped.
+        """
+        self.checkAndRemoveDuplicate(node)
+        self.addresses[(node.ip, node.port)] = node
+        self.neighbors.add(node)
+
+    def _unindexAddress(self, node):
+        self.neighbors.remove(node)
+        address = (node.ip, node.port)
+        existing = self.addresses.get(address, None)
+        if existing is not None and existing.id == node.id:
+            del self.addresses[address]
 
     def findNeighbors(self, node, k=None, exclude=None):
+        """
+        Return the `k` nodes in the table closest to `node`, nearest first,
+        leaving out any on the same address as `exclude`.
+        """
+        index = self.getBucketFor(node)
+        if index is not None:
+            self.buckets[index].touchLastUpdated()
+        return self.neighbors.closest(node.long_id, k or self.ksize, exclude)
+
+    def findNeighborsMany(self, nodes, k=None, exclude=None):
+        """
+        Like `findNeighbors` for a list of nodes at once. Returns a list with
+        the neighbors of each.
+        """
         k = k or self.ksize
-        nodes = []
-        for neighbor in TableTraverser(self, node):
-            if exclude is None or not neighbor.sameHomeAs(exclude):
-                heapq.heappush(nodes, (node.distanceTo(neighbor), neighbor))
-            if len(nodes) == k:
-                break
-
-        return map(operator.itemgetter(1), heapq.nsmallest(k, nodes))
+        return [self.neighbors.closest(node.long_id, k, exclude) for node in nodes]
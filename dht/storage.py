@@ -5,6 +5,7 @@ Copyright (c) 2015 OpenBazaar
 
 import time
 import sqlite3 as lite
+from twisted.internet import reactor, task
 from zope.interface import implements, Interface
 from protos.objects import Value
 
@@ -34,9 +35,9 @@ class IStorage(Interface):
         Return the exact value for a given keyword and key.
         """
 
-    def cull(self):
+    def cull(self, limit=None):
         """
-        Iterate over all keys and remove expired items
+        Remove expired items, at most `limit` of them if given.
         """
 
     def delete(self, keyword, key):
@@ -59,38 +60,73 @@ class IStorage(Interface):
         Get the remaining time for a given key.
         """
 
+    def start_expiry(self):
+        """
+        Start removing expired items in the background.
+        """
+
 
 class ForgetfulStorage(object):
+    """
+    Keeps stored values in an in-memory SQLite database.
+
+    Values carry a deadline of `birthday + ttl`. Reads skip values past their
+    deadline and a single sweeper, started with :meth:`start_expiry`, deletes
+    them in batches of at most `cull_batch` rows every `cull_interval`
+    seconds, so lookups never open a write transaction.
+    """
     implements(IStorage)
 
-    def __init__(self, ttl=604800):
+    def __init__(self, ttl=604800, cull_interval=10, cull_batch=500, filepath=":memory:"):
 
         self.ttl = ttl
-        self.db = lite.connect(":memory:")
+        self.cull_batch = cull_batch
+        self.cull_interval = cull_interval
+        self.culled = 0
+        self.sweeper = task.LoopingCall(self.cull, cull_batch)
+        self.db = lite.connect(filepath)
         self.db.text_factory = str
         cursor = self.db.cursor()
-        cursor.execute('''CREATE TABLE dht(keyword TEXT, id BLOB, value BLOB, birthday FLOAT)''')
-        cursor.execute('''CREATE INDEX idx1 ON dht(keyword);''')
-        cursor.execute('''CREATE INDEX idx2 ON dht(birthday);''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS dht(keyword TEXT, id BLOB, value BLOB, birthday FLOAT)''')
+        cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_keyword_id ON dht(keyword, id);''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_birthday ON dht(birthday);''')
+        self.db.commit()
+
+    def _expiration(self):
+        return time.time() - self.ttl
+
+    def _written(self):
         self.db.commit()
 
+    def start_expiry(self):
+        """
+        Start the background sweeper that deletes expired values.
+        """
+        if not self.sweeper.running:
+            self.sweeper.start(self.cull_interval, now=False)
+
+    def stop_expiry(self):
+        if self.sweeper.running:
+            self.sweeper.stop()
+
     def __setitem__(self, keyword, values):
-        keyword = keyword.encode("hex")
         cursor = self.db.cursor()
         birthday = time.time() - (self.ttl - values[2])
-        cursor.execute('''INSERT INTO dht(keyword, id, value, birthday)
-                      SELECT ?,?,?,? WHERE NOT EXISTS(SELECT 1 FROM dht WHERE keyword=? AND id=?)''',
-                       (keyword, values[0], values[1], birthday, keyword, values[0]))
-        self.db.commit()
+        # an expired copy that the sweeper hasn't reached yet must not block the new value
+        cursor.execute('''DELETE FROM dht WHERE keyword=? AND id=? AND birthday < ?''',
+                       (keyword.encode("hex"), values[0], self._expiration()))
+        cursor.execute('''INSERT OR IGNORE INTO dht(keyword, id, value, birthday) VALUES (?,?,?,?)''',
+                       (keyword.encode("hex"), values[0], values[1], birthday))
+        self._written()
 
     def __getitem__(self, keyword):
-        self.cull()
         cursor = self.db.cursor()
-        cursor.execute('''SELECT id, value, birthday FROM dht WHERE keyword=?''', (keyword.encode("hex"),))
+        cursor.execute('''SELECT id, value, birthday FROM dht WHERE keyword=? AND birthday >= ?
+                          ORDER BY rowid''',
+                       (keyword.encode("hex"), self._expiration()))
         return cursor.fetchall()
 
     def get(self, keyword, default=None):
-        self.cull()
         kw = self[keyword]
         if len(kw) > 0:
             ret = []
@@ -106,31 +142,41 @@ class ForgetfulStorage(object):
     def getSpecific(self, keyword, key):
         try:
             cursor = self.db.cursor()
-            cursor.execute('''SELECT value FROM dht WHERE keyword=? AND id=?''', (keyword.encode("hex"), key))
+            cursor.execute('''SELECT value FROM dht WHERE keyword=? AND id=? AND birthday >= ?''',
+                           (keyword.encode("hex"), key, self._expiration()))
             return cursor.fetchone()[0]
         except Exception:
             return None
 
-    def cull(self):
-        expiration = time.time() - self.ttl
+    def cull(self, limit=None):
+        """
+        Delete expired values, oldest first. Returns the number of rows removed.
+        """
         cursor = self.db.cursor()
-        cursor.execute('''DELETE FROM dht WHERE birthday < ?''', (expiration,))
-        self.db.commit()
+        if limit is None:
+            cursor.execute('''DELETE FROM dht WHERE birthday < ?''', (self._expiration(),))
+        else:
+            cursor.execute('''DELETE FROM dht WHERE rowid IN
+                              (SELECT rowid FROM dht WHERE birthday < ? ORDER BY birthday LIMIT ?)''',
+                           (self._expiration(), limit))
+        culled = cursor.rowcount
+        if culled > 0:
+            self.culled += culled
+            self._written()
+        return culled
 
     def delete(self, keyword, key):
         try:
             cursor = self.db.cursor()
             cursor.execute('''DELETE FROM dht WHERE keyword=? AND id=?''', (keyword.encode("hex"), key))
-            self.db.commit()
+            self._written()
         except Exception:
             pass
-        self.cull()
 
     def iterkeys(self):
-        self.cull()
         try:
             cursor = self.db.cursor()
-            cursor.execute('''SELECT DISTINCT keyword FROM dht''')
+            cursor.execute('''SELECT DISTINCT keyword FROM dht WHERE birthday >= ?''', (self._expiration(),))
             keywords = cursor.fetchall()
             return keywords.__iter__()
         except Exception:
@@ -139,7 +185,9 @@ class ForgetfulStorage(object):
     def iteritems(self, keyword):
         try:
             cursor = self.db.cursor()
-            cursor.execute('''SELECT id, value FROM dht WHERE keyword=?''', (keyword.encode("hex"),))
+            cursor.execute('''SELECT id, value FROM dht WHERE keyword=? AND birthday >= ?
+                              ORDER BY rowid''',
+                           (keyword.encode("hex"), self._expiration()))
             return cursor.fetchall().__iter__()
         except Exception:
             return None
@@ -156,3 +204,56 @@ class ForgetfulStorage(object):
         cursor.execute('''PRAGMA page_size;''')
         size = cursor.fetchone()[0]
         return count * size
+
+    def get_stats(self):
+        """
+        Counters for monitoring: live entries, entries past their deadline
+        that have not been culled yet, and the total culled so far.
+        """
+        cursor = self.db.cursor()
+        cursor.execute('''SELECT COUNT(*) FROM dht''')
+        total = cursor.fetchone()[0]
+        cursor.execute('''SELECT COUNT(*) FROM dht WHERE birthday < ?''', (self._expiration(),))
+        expired = cursor.fetchone()[0]
+        return {
+            "entries": total - expired,
+            "expired": expired,
+            "culled": self.culled,
+            "size": self.get_db_size()
+        }
+
+
+class PersistentStorage(ForgetfulStorage):
+    """
+    A disk backed :class:`ForgetfulStorage` so the values this node is
+    responsible for survive a restart.
+
+    The database runs in WAL mode and writes are committed in batches at
+    most every `commit_interval` seconds.
+    """
+
+    def __init__(self, filepath, ttl=604800, cull_interval=10, cull_batch=500, commit_interval=5):
+        self.commit_interval = commit_interval
+        self.pending_commit = None
+        ForgetfulStorage.__init__(self, ttl, cull_interval, cull_batch, filepath)
+        cursor = self.db.cursor()
+        cursor.execute('''PRAGMA journal_mode=WAL''')
+        cursor.execute('''PRAGMA synchronous=NORMAL''')
+
+    def _written(self):
+        if self.pending_commit is None or not self.pending_commit.active():
+            self.pending_commit = reactor.callLater(self.commit_interval, self.commit)
+
+    def commit(self):
+        if self.pending_commit is not None and self.pending_commit.active():
+            self.pending_commit.cancel()
+        self.pending_commit = None
+        self.db.commit()
+
+    def close(self):
+        """
+        Stop the sweeper and flush outstanding writes to disk.
+        """
+        self.stop_expiry()
+        self.commit()
+        self.db.close()
@@ -0,0 +1,81 @@
+"""
+Micro-benchmark for `Node` memory use and protobuf encoding.
+
+Run with `python -m dht.tests.bench_node`. It is not collected by the
+test runner. Run it before and after a change to `dht.node` to compare.
+"""
+import gc
+import resource
+import sys
+import time
+
+from dht.node import Node
+from dht.routing import RoutingTable
+from dht.tests.utils import mknode
+from dht.utils import digest
+from protos import message
+from protos.objects import FULL_CONE
+
+
+class NullProtocol(object):
+    def callPing(self, nodeToAsk):
+        pass
+
+
+def node_args(count):
+    return [(digest(str(i)), "10.%d.%d.%d" % (i >> 16, (i >> 8) & 0xff, i & 0xff), 18467,
+             digest("key%s" % i), None, FULL_CONE) for i in range(count)]
+
+
+def node_size(node):
+    # the instance and its attribute dict, not the values shared with the caller
+    size = sys.getsizeof(node)
+    if hasattr(node, "__dict__"):
+        size += sys.getsizeof(node.__dict__)
+    return size
+
+
+def encode_node(node):
+    if hasattr(node, "getSerializedProto"):
+        return node.getSerializedProto()
+    return node.getProto().SerializeToString()
+
+
+def timed(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def main(count=10000, ksize=20, answers=50, messages=10000):
+    args = node_args(count)
+    gc.collect()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    nodes = []
+    elapsed = timed(lambda: nodes.extend(Node(*a) for a in args))
+    growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    print "create %d nodes      %.0f ms" % (count, elapsed * 1000)
+    print "node and attributes  %d bytes per node" % node_size(nodes[0])
+    print "rss growth           %.1f MB" % (growth / 1024.0)
+
+    router = RoutingTable(NullProtocol(), ksize, mknode())
+    for node in nodes:
+        router.addContact(node)
+    neighbors = router.findNeighbors(mknode())
+
+    def encode():
+        for _ in range(answers):
+            [encode_node(n) for n in neighbors]
+    print "encode %d nodes x %d  %.1f ms" % (len(neighbors), answers, timed(encode) * 1000)
+
+    source = nodes[0]
+
+    def send():
+        for _ in range(messages):
+            m = message.Message()
+            m.sender.MergeFrom(source.getProto())
+    print "set message sender   %.1f us" % (timed(send) / messages * 1000000)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""
+Micro-benchmark for the routing table hot paths.
+
+Run with `python -m dht.tests.bench_routing`. It is not collected by the
+test runner.
+"""
+import random
+import time
+
+from dht.node import Node
+from dht.routing import RoutingTable
+from dht.tests.utils import mknode
+
+
+class NullProtocol(object):
+    def callPing(self, nodeToAsk):
+        pass
+
+
+def timeit(name, func, nodes):
+    start = time.time()
+    for node in nodes:
+        func(node)
+    elapsed = time.time() - start
+    print "%-16s %8d ops in %.3fs (%d ops/sec)" % (name, len(nodes), elapsed, len(nodes) / max(elapsed, 1e-9))
+
+
+def main(count=10000, ksize=20):
+    router = RoutingTable(NullProtocol(), ksize, mknode())
+    nodes = [mknode(ip="10.%d.%d.%d" % (i >> 16, (i >> 8) & 0xff, i & 0xff), port=18467)
+             for i in range(count)]
+    timeit("addContact", router.addContact, nodes)
+    print "%d buckets, %d contacts" % (len(router.buckets), len(router.addresses))
+
+    random.shuffle(nodes)
+    timeit("isNewNode", router.isNewNode, nodes)
+    timeit("findNeighbors", router.findNeighbors, nodes[:count / 10])
+    duplicates = [Node(mknode().id, n.ip, n.port) for n in nodes[:count / 10]]
+    timeit("addDuplicate", router.addContact, duplicates)
+    timeit("removeContact", router.removeContact, nodes)
+
+
+if __name__ == "__main__":
+    main()
@@ -68,6 +68,7 @@ class ValueSpiderCrawlTest(unittest.TestCase):
     def tearDown(self):
         self.con.shutdown()
         self.wire_protocol.shutdown()
+        self.db.close()
         os.remove("test.db")
 
     def test_find(self):
@@ -249,6 +250,7 @@ class NodeSpiderCrawlTest(unittest.TestCase):
     def tearDown(self):
         self.con.shutdown()
         self.wire_protocol.shutdown()
+        self.db.close()
         os.remove("test.db")
 
     def test_find(self):
@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+
+import nacl.signing
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+from dht.network import Server, fetchSeed
+from dht.node import Node
+from dht.utils import digest
+from log import Logger
+from protos.objects import FULL_CONE
+from seed import snapshots
+
+
+class SeedResource(resource.Resource):
+    """
+    Serves a signed peer list the way seed/httpseed.py does.
+    """
+    isLeaf = True
+
+    def __init__(self, signing_key, nodes):
+        resource.Resource.__init__(self)
+        self.snapshots = snapshots.SnapshotEngine(signing_key, lambda: nodes)
+
+    def render_GET(self, request):
+        return snapshots.render(self.snapshots, request)
+
+
+class QuerySeedTest(unittest.TestCase):
+    def setUp(self):
+        # other tests point the reactor's callLater at a task.Clock and leave it there
+        vars(reactor).pop("callLater", None)
+        self.folder = tempfile.mkdtemp()
+        self.signing_key = nacl.signing.SigningKey.generate()
+        self.pubkey = self.signing_key.verify_key.encode().encode("hex")
+        self.nodes = [Node(digest("node%s" % i), "127.0.0.%s" % i, 18466 + i, digest("key%s" % i), None, FULL_CONE)
+                      for i in (1, 2)]
+        self.port = reactor.listenTCP(0, server.Site(SeedResource(self.signing_key, self.nodes)),
+                                      interface="127.0.0.1")
+        self.seed = "127.0.0.1:%s" % self.port.getHost().port
+
+        self.server = Server.__new__(Server)
+        self.server.log = Logger(system=self.server)
+        self.server.seedCache = os.path.join(self.folder, "seeds.pickle")
+        self.server.seedPeers = []
+        self.bootstrapped = defer.Deferred()
+        self.server.bootstrap = lambda addrs, retry=True: self.bootstrapped.callback((addrs, retry))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        return self.port.stopListening()
+
+    def test_fetchSeed(self):
+        d = fetchSeed(self.seed, self.pubkey)
+        d.addCallback(sorted)
+        d.addCallback(self.assertEqual, sorted(n.getProto().SerializeToString() for n in self.nodes))
+        return d
+
+    def test_fetchSeedBadSignature(self):
+        other = nacl.signing.SigningKey.generate().verify_key.encode().encode("hex")
+        return self.assertFailure(fetchSeed(self.seed, other), Exception)
+
+    def test_querySeedUsesFirstResponseAndCachesIt(self):
+        expected = [("127.0.0.1", 18467), ("127.0.0.2", 18468)]
+
+        def check(nodes):
+            self.assertEqual(sorted(nodes), expected)
+            self.assertTrue(os.path.isfile(self.server.seedCache))
+            # the next query starts from the saved peers straight away and
+            # bootstraps whatever the seed returns once it responds
+            d = self.server.querySeed([(self.seed, self.pubkey)])
+            self.assertTrue(d.called)
+            d.addCallback(lambda cached: self.assertEqual(sorted(cached), expected))
+            return d.addCallback(lambda _: self.bootstrapped)
+        d = self.server.querySeed([("127.0.0.1:1", self.pubkey), (self.seed, self.pubkey)])
+        d.addCallback(check)
+        d.addCallback(lambda (nodes, retry): self.assertEqual((sorted(nodes), retry), (expected, False)))
+        return d
@@ -51,6 +51,21 @@ class NodeTest(unittest.TestCase):
         n2 = Node(rid, "127.0.0.1", 1234, digest("pubkey"), ("127.0.0.1", 1234), objects.FULL_CONE, True)
         self.assertEqual(n1, n2.getProto())
 
+    def test_cached_proto(self):
+        n = Node(digest("id"), "127.0.0.1", 1234, digest("pubkey"), None, objects.FULL_CONE, False)
+        serialized = n.getSerializedProto()
+        self.assertIs(n.getProto(), n.getProto())
+        self.assertIs(n.getSerializedProto(), serialized)
+        self.assertEqual(serialized, n.getProto().SerializeToString())
+
+        n.relay_node = ("127.0.0.2", 1235)
+        self.assertEqual(n.getProto().relayAddress.ip, "127.0.0.2")
+        n.vendor = True
+        self.assertTrue(n.getProto().vendor)
+        self.assertNotEqual(n.getSerializedProto(), serialized)
+        self.assertEqual(n.getSerializedProto(), n.getProto().SerializeToString())
+        self.assertRaises(AttributeError, setattr, n, "name", "node")
+
     def test_tuple(self):
         n = Node('127.0.0.1', 0, 'testkey')
         i = n.__iter__()
@@ -96,3 +111,18 @@ class NodeHeapTest(unittest.TestCase):
         nh = NodeHeap(n, 5)
         val = nh.getNodeById('')
         self.assertIsNone(val)
+
+    def test_containsAndGetNodeById(self):
+        heap = NodeHeap(mknode(intid=0), 3)
+        nodes = [mknode(intid=x) for x in range(6)]
+        heap.push(nodes)
+        heap.push(nodes[2])
+        self.assertEqual(len(heap.heap), 6)
+        self.assertIn(nodes[5], heap)
+        self.assertIs(heap.getNodeById(nodes[4].id), nodes[4])
+
+        heap.remove([nodes[4].id, mknode(intid=99).id])
+        self.assertNotIn(nodes[4], heap)
+        self.assertIsNone(heap.getNodeById(nodes[4].id))
+        self.assertEqual(heap.popleft(), nodes[0])
+        self.assertEqual(heap.getIDs(), [nodes[1].id, nodes[2].id, nodes[3].id])
@@ -70,6 +70,7 @@ class KademliaProtocolTest(unittest.TestCase):
         if self.con.state != connection.State.SHUTDOWN:
             self.con.shutdown()
         self.wire_protocol.shutdown()
+        self.db.close()
         os.remove("test.db")
 
     def test_invalid_datagram(self):
@@ -441,6 +442,59 @@ class KademliaProtocolTest(unittest.TestCase):
         self.assertEqual(m.arguments[1], digest("Key"))
         self.assertEqual(m.arguments[2], self.protocol.sourceNode.getProto().SerializeToString())
 
+    def test_callStoreMany(self):
+        self._connecting_to_connected()
+
+        n = Node(digest("guid"), self.addr1[0], self.addr1[1], digest("pubkey"), None, objects.FULL_CONE, False)
+        self.wire_protocol[self.addr1] = self.con
+        self.con.handler = self.handler
+        self.handler.remote_node_version = 3
+        value = self.protocol.sourceNode.getProto().SerializeToString()
+        self.protocol.callStoreMany(n, [(digest("Keyword"), digest("Key"), value, 10),
+                                        (digest("Keyword2"), digest("Key"), value, 10)])
+
+        self.clock.advance(constants.PACKET_TIMEOUT)
+        connection.REACTOR.runUntilCurrent()
+        messages = self._sent_messages()
+        self.assertEqual([m.command for m in messages], [message.STORE_MANY])
+
+        m = messages[0]
+        self.assertEqual(len(m.arguments), 2)
+        v = objects.Value()
+        v.ParseFromString(m.arguments[1])
+        self.assertEqual(v.keyword, digest("Keyword2"))
+        self.assertEqual(v.valueKey, digest("Key"))
+        self.assertEqual(v.serializedData, value)
+        self.assertEqual(v.ttl, 10)
+
+    def test_callStoreManyFallsBackToStore(self):
+        self._connecting_to_connected()
+
+        n = Node(digest("guid"), self.addr1[0], self.addr1[1], digest("pubkey"), None, objects.FULL_CONE, False)
+        self.wire_protocol[self.addr1] = self.con
+        self.con.handler = self.handler
+        value = self.protocol.sourceNode.getProto().SerializeToString()
+        self.protocol.callStoreMany(n, [(digest("Keyword"), digest("Key"), value, 10),
+                                        (digest("Keyword2"), digest("Key"), value, 10)])
+
+        self.clock.advance(constants.PACKET_TIMEOUT)
+        connection.REACTOR.runUntilCurrent()
+        self.assertEqual([m.command for m in self._sent_messages()], [message.STORE, message.STORE])
+
+    def test_rpc_store_many(self):
+        value = self.protocol.sourceNode.getProto().SerializeToString()
+        values = []
+        for keyword in (digest("Keyword"), "bad keyword", digest("Keyword2")):
+            v = objects.Value()
+            v.keyword = keyword
+            v.valueKey = "Key"
+            v.serializedData = value
+            v.ttl = 10
+            values.append(v.SerializeToString())
+        r = self.protocol.rpc_store_many(self.node, *(values + ["not a value"]))
+        self.assertEqual(r, ["True", "False", "True", "False"])
+        self.assertEqual(self.storage.getSpecific(digest("Keyword2"), "Key"), value)
+
     def test_callFindValue(self):
         self._connecting_to_connected()
 
@@ -612,6 +666,16 @@ class KademliaProtocolTest(unittest.TestCase):
 
         self.next_seqnum = seqnum + 1
 
+    def _sent_messages(self):
+        messages = []
+        for call in self.proto_mock.send_datagram.call_args_list:
+            payload = packet.Packet.from_bytes(call[0][0]).payload
+            if payload:
+                m = message.Message()
+                m.ParseFromString(payload)
+                messages.append(m)
+        return messages
+
     def test_badRPCDelete(self):
         n = Node(digest("S"), self.addr1[0], self.addr1[1])
         val = self.protocol.rpc_delete(n, 'testkeyword', 'key', 'testsig')
@@ -73,3 +73,57 @@ class RoutingTableTest(unittest.TestCase):
         self.assertTrue(len(self.router.buckets), 1)
         self.assertTrue(len(self.router.buckets[0].nodes), 1)
         self.assertTrue(self.router.buckets[0].getNodes()[0].id == digest("asdf"))
+
+    def test_getBucketFor(self):
+        router = RoutingTable(self, 20, self.node)
+        for i in range(200):
+            router.addContact(mknode(ip="127.0.0.1", port=i))
+        self.assertTrue(len(router.buckets) > 1)
+        for bucket in router.buckets:
+            for node in bucket.getNodes():
+                self.assertIs(router.buckets[router.getBucketFor(node)], bucket)
+
+    def test_addSameIPAfterSplit(self):
+        router = RoutingTable(self, 20, self.node)
+        nodes = [mknode(ip="127.0.0.1", port=i) for i in range(200)]
+        for node in nodes:
+            router.addContact(node)
+        for node in nodes:
+            if not router.isNewNode(node):
+                break
+        for bucket in router.buckets:
+            del bucket.replacementNodes[:]
+        replacement = Node(node.id[:-1] + chr(ord(node.id[-1]) ^ 1), node.ip, node.port)
+        router.addContact(replacement)
+        self.assertTrue(router.isNewNode(node))
+        self.assertFalse(router.isNewNode(replacement))
+        self.assertIs(router.addresses[(node.ip, node.port)], replacement)
+
+    def test_removeContact(self):
+        router = RoutingTable(self, 20, self.node)
+        node = mknode(ip="127.0.0.1", port=1)
+        router.addContact(node)
+        router.removeContact(node)
+        self.assertTrue(router.isNewNode(node))
+        self.assertNotIn(("127.0.0.1", 1), router.addresses)
+        self.assertEqual(len(router.neighbors), 0)
+
+    def test_findNeighbors(self):
+        router = RoutingTable(self, 20, self.node)
+        for i in range(500):
+            router.addContact(mknode(ip="10.0.%d.%d" % (i >> 8, i & 0xff), port=18467))
+        contacts = [n for bucket in router.buckets for n in bucket.getNodes()]
+        self.assertEqual(len(router.neighbors), len(contacts))
+
+        targets = [mknode() for _ in range(20)] + contacts[:5]
+        for target, neighbors in zip(targets, router.findNeighborsMany(targets)):
+            expected = sorted(contacts, key=target.distanceTo)[:20]
+            self.assertEqual(neighbors, expected)
+            self.assertEqual(router.findNeighbors(target), expected)
+
+        target = contacts[0]
+        neighbors = router.findNeighbors(target, k=5, exclude=target)
+        self.assertEqual(neighbors, sorted(contacts, key=target.distanceTo)[1:6])
+
+    def callPing(self, nodeToAsk):
+        pass
@@ -1,7 +1,10 @@
 __author__ = 'chris'
+import os
+import shutil
+import tempfile
 from twisted.trial import unittest
 from dht.utils import digest
-from dht.storage import ForgetfulStorage
+from dht.storage import ForgetfulStorage, PersistentStorage
 from protos.objects import Value
 
 
@@ -61,3 +64,74 @@ class ForgetfulStorageTest(unittest.TestCase):
         p = ForgetfulStorage()
         p[self.keyword1] = (self.key1, self.value, .000000000001)
         self.assertTrue(p.get(self.keyword1) is None)
+
+    def test_cullInBatches(self):
+        p = ForgetfulStorage(cull_batch=2)
+        for i in range(5):
+            p[self.keyword1] = (digest(i), self.value, -1)
+        p[self.keyword2] = (self.key1, self.value, 10)
+        self.assertEqual(p.get_stats()["expired"], 5)
+        self.assertEqual(p.cull(2), 2)
+        self.assertEqual(p.cull(2), 2)
+        self.assertEqual(p.cull(2), 1)
+        self.assertEqual(p.cull(2), 0)
+        stats = p.get_stats()
+        self.assertEqual((stats["entries"], stats["expired"], stats["culled"]), (1, 0, 5))
+
+    def test_replaceExpired(self):
+        p = ForgetfulStorage()
+        p[self.keyword1] = (self.key1, self.value, -1)
+        p[self.keyword1] = (self.key1, self.value, 10)
+        self.assertEqual(self.value, p.getSpecific(self.keyword1, self.key1))
+
+    def test_expirySweeper(self):
+        p = ForgetfulStorage()
+        p.start_expiry()
+        self.assertTrue(p.sweeper.running)
+        p.stop_expiry()
+        self.assertFalse(p.sweeper.running)
+
+
+class PersistentStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.keyword1 = digest("shoes")
+        self.key1 = digest("contract1")
+        self.key2 = digest("contract2")
+        self.value = digest("node")
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "dht.db")
+        self.storage = PersistentStorage(self.path)
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.folder)
+
+    def test_setitem(self):
+        self.storage[self.keyword1] = (self.key1, self.value, 10)
+        self.storage[self.keyword1] = (self.key1, digest("other"), 10)
+        self.storage[self.keyword1] = (self.key2, self.value, 10)
+        ret = sorted(val[:2] for val in self.storage[self.keyword1])
+        self.assertEqual(ret, sorted([(self.key1, self.value), (self.key2, self.value)]))
+
+    def test_survivesRestart(self):
+        self.storage[self.keyword1] = (self.key1, self.value, 10)
+        self.storage.close()
+        self.storage = PersistentStorage(self.path)
+        self.assertEqual(self.value, self.storage.getSpecific(self.keyword1, self.key1))
+
+    def test_delete(self):
+        self.storage[self.keyword1] = (self.key1, self.value, 10)
+        self.storage.delete(self.keyword1, self.key1)
+        self.assertIsNone(self.storage.get(self.keyword1))
+
+    def test_expiredValuesHiddenUntilCulled(self):
+        self.storage[self.keyword1] = (self.key1, self.value, -1)
+        self.assertIsNone(self.storage.get(self.keyword1))
+        self.assertIsNone(self.storage.getSpecific(self.keyword1, self.key1))
+        self.assertEqual(list(self.storage.iterkeys()), [])
+        cursor = self.storage.db.cursor()
+        cursor.execute('''SELECT COUNT(*) FROM dht''')
+        self.assertEqual(cursor.fetchone()[0], 1)
+        self.storage.cull()
+        cursor.execute('''SELECT COUNT(*) FROM dht''')
+        self.assertEqual(cursor.fetchone()[0], 0)
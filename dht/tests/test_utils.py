@@ -1,9 +1,9 @@
 import hashlib
 
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, task
 
-from dht.utils import digest, sharedPrefix, OrderedSet, deferredDict
+from dht.utils import digest, sharedPrefix, OrderedSet, deferredDict, LookupCache
 
 
 class UtilsTest(unittest.TestCase):
@@ -56,3 +56,51 @@ class OrderedSetTest(unittest.TestCase):
         o.push('2')
         o.push('1')
         self.assertEqual(o, ['2', '1'])
+
+
+class LookupCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = LookupCache(60, maxEntries=2, clock=self.clock)
+        self.crawls = []
+
+    def crawl(self):
+        d = defer.Deferred()
+        self.crawls.append(d)
+        return d
+
+    def test_coalesces_and_expires(self):
+        results = []
+        self.cache.lookup("key", self.crawl).addCallback(results.append)
+        self.cache.lookup("key", self.crawl).addCallback(results.append)
+        self.assertEqual(len(self.crawls), 1)
+        self.crawls[0].callback(["value"])
+        self.assertEqual(results, [["value"], ["value"]])
+
+        self.clock.advance(59)
+        self.cache.lookup("key", self.crawl).addCallback(results.append)
+        self.assertEqual(len(self.crawls), 1)
+        self.clock.advance(1)
+        self.cache.lookup("key", self.crawl)
+        self.assertEqual(len(self.crawls), 2)
+        self.assertEqual(self.cache.get_stats(),
+                         {"entries": 0, "hits": 1, "misses": 2, "coalesced": 1})
+
+    def test_respects_ttl_and_skips_empty_results(self):
+        self.cache.lookup("key", self.crawl, ttl=lambda result: 10)
+        self.crawls[0].callback(["value"])
+        self.clock.advance(10)
+        self.cache.lookup("key", self.crawl)
+        self.crawls[1].callback(None)
+        self.cache.lookup("key", self.crawl)
+        self.assertEqual(len(self.crawls), 3)
+
+    def test_invalidate_and_eviction(self):
+        for key in ("a", "b", "c"):
+            self.cache.lookup(key, self.crawl)
+            self.crawls[-1].callback(key)
+            self.clock.advance(1)
+        self.assertEqual(sorted(self.cache.entries), ["b", "c"])
+        self.cache.invalidate("b")
+        self.cache.lookup("b", self.crawl)
+        self.assertEqual(len(self.crawls), 4)
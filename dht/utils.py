@@ -6,7 +6,8 @@ Copyright (c) 2014 Brian Muller
 import hashlib
 import operator
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
 
 
 def digest(s):
@@ -73,3 +74,76 @@ def sharedPrefix(args):
             break
         i += 1
     return args[0][:i]
+
+
+class LookupCache(object):
+    """
+    Remembers the results of DHT lookups for up to `maxAge` seconds, or less
+    if the result itself expires sooner, and has concurrent lookups of the
+    same key wait on a single crawl. Empty results and failures aren't cached.
+    """
+
+    def __init__(self, maxAge, maxEntries=1000, clock=reactor):
+        self.maxAge = maxAge
+        self.maxEntries = maxEntries
+        self.clock = clock
+        self.entries = {}
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def lookup(self, key, crawl, ttl=None):
+        """
+        Return a :class:`defer.Deferred` firing with the result for `key`.
+
+        Args:
+            crawl: called on a miss, returns a :class:`defer.Deferred` for the result.
+            ttl: optionally called with the result to get the number of seconds
+                it stays valid for.
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[1] > self.clock.seconds():
+                self.hits += 1
+                return defer.succeed(entry[0])
+            del self.entries[key]
+        if key in self.inflight:
+            self.coalesced += 1
+            d = defer.Deferred()
+            self.inflight[key].append(d)
+            return d
+        self.misses += 1
+        self.inflight[key] = []
+
+        def done(result):
+            waiting = self.inflight.pop(key)
+            if result and not isinstance(result, Failure):
+                self.put(key, result, self.maxAge if ttl is None else min(self.maxAge, ttl(result)))
+            for d in waiting:
+                d.callback(result)
+            return result
+        return crawl().addBoth(done)
+
+    def put(self, key, result, age):
+        if age <= 0:
+            return
+        now = self.clock.seconds()
+        if len(self.entries) >= self.maxEntries:
+            for k, entry in self.entries.items():
+                if entry[1] <= now:
+                    del self.entries[k]
+            while len(self.entries) >= self.maxEntries:
+                del self.entries[min(self.entries, key=lambda k: self.entries[k][1])]
+        self.entries[key] = (result, now + age)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def get_stats(self):
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced
+        }
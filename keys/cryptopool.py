@@ -0,0 +1,125 @@
+__author__ = 'chris'
+
+import bitcointools
+import multiprocessing
+import signal
+from config import CRYPTO_PROCESSES
+from log import Logger
+from twisted.internet import defer, reactor, task
+
+
+def ecdsa_verify(item):
+    """
+    Verify a `(message, signature, pubkey)` tuple where the signature is
+    encoded as by `bitcointools.encode_sig`. Invalid input is reported as an
+    invalid signature rather than raised since it runs in a worker process.
+    """
+    try:
+        message, signature, pubkey = item
+        return bool(bitcointools.ecdsa_raw_verify(message, bitcointools.decode_sig(signature), pubkey))
+    except Exception:
+        return False
+
+
+def ecdsa_sign(item):
+    """
+    Sign a `(message, privkey)` tuple and return the encoded signature or
+    None if the key is invalid.
+    """
+    try:
+        message, privkey = item
+        return bitcointools.encode_sig(*bitcointools.ecdsa_raw_sign(message, privkey))
+    except Exception:
+        return None
+
+
+def _init_worker():
+    # The workers are forked from the reactor process and inherit its signal
+    # handlers which would stop `Pool.terminate` from killing them.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class CryptoPool(object):
+    """
+    Runs the pure python bitcoin ECDSA math in a pool of worker processes so
+    verifying a page of ratings or re-signing every listing doesn't block
+    the reactor. With zero processes the work is done inline instead.
+
+    The workers are started on first use and terminated when the reactor
+    shuts down. Running batches are polled from the reactor every
+    `poll_interval` seconds. A batch that raises, or doesn't finish within
+    `timeout` seconds because a worker died, fails the returned `Deferred`.
+    """
+
+    def __init__(self, processes=2, timeout=300, poll_interval=0.05, clock=reactor):
+        self.processes = processes
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.clock = clock
+        self.pool = None
+        self.batches = 0
+        self.tasks = 0
+        self.log = Logger(system=self)
+
+    def map(self, func, items):
+        """
+        Call `func` on every item in a worker process and return a `Deferred`
+        firing with the list of results.
+        """
+        items = list(items)
+        self.batches += 1
+        self.tasks += len(items)
+        if self.processes <= 0 or len(items) == 0:
+            return defer.maybeDeferred(map, func, items)
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes, _init_worker)
+            reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+        return self._wait(self.pool.map_async(func, items))
+
+    def _wait(self, result):
+        # map_async has no error callback in python 2 so poll the result
+        # instead of tying up a thread on get(), which raises whatever went
+        # wrong in the workers once it's ready
+        d = defer.Deferred()
+        deadline = self.clock.seconds() + self.timeout
+
+        def poll():
+            if result.ready():
+                loop.stop()
+                try:
+                    value = result.get(0)
+                except Exception:
+                    d.errback()
+                else:
+                    d.callback(value)
+            elif self.clock.seconds() >= deadline:
+                loop.stop()
+                d.errback(multiprocessing.TimeoutError())
+        loop = task.LoopingCall(poll)
+        loop.clock = self.clock
+        loop.start(self.poll_interval, False)
+        return d
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def get_stats(self):
+        return {
+            "processes": self.processes,
+            "batches": self.batches,
+            "tasks": self.tasks
+        }
+
+
+pool = CryptoPool(CRYPTO_PROCESSES)
+
+
+def sign_ecdsa_many(items):
+    """
+    Sign a list of `(message, privkey)` tuples on the crypto pool. Returns a
+    `Deferred` firing with the list of encoded signatures.
+    """
+    return pool.map(ecdsa_sign, items)
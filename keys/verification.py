@@ -0,0 +1,128 @@
+__author__ = 'chris'
+
+import hashlib
+import nacl.hash
+import nacl.signing
+import threading
+from collections import OrderedDict
+from config import SIGNATURE_CACHE_SIZE
+from keys import cryptopool
+from nacl.exceptions import BadSignatureError
+
+
+class VerificationCache(object):
+    """
+    Remembers the outcome of signature and GUID proof of work checks so the
+    same contract, profile or message seen again doesn't cost another round
+    of elliptic curve math. Entries are keyed on the public key, a sha256 of
+    the message and the signature and the oldest are dropped once `size` is
+    reached. A size of zero turns the cache off.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key, check):
+        """
+        Return the cached result for `key`, calling `check` to compute it on
+        a miss.
+        """
+        result = self.get(key)
+        if result is None:
+            result = check()
+            self.put(key, result)
+        return result
+
+    def get(self, key):
+        if self.size <= 0:
+            return None
+        with self.lock:
+            result = self.entries.pop(key, None)
+            if result is None:
+                self.misses += 1
+                return None
+            self.entries[key] = result
+            self.hits += 1
+            return result
+
+    def put(self, key, result):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = result
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.size > 0,
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": float(self.hits) / lookups if lookups else 0.0
+            }
+
+
+cache = VerificationCache(SIGNATURE_CACHE_SIZE)
+
+
+def verify_signature(pubkey, message, signature):
+    """
+    Check an ed25519 signature made by `pubkey` over `message`. Like
+    `nacl.signing.VerifyKey.verify` this raises `BadSignatureError` if the
+    signature is invalid.
+    """
+    def check():
+        try:
+            nacl.signing.VerifyKey(pubkey).verify(message, signature)
+            return True
+        except BadSignatureError:
+            return False
+    key = ("ed25519", pubkey, hashlib.sha256(message).digest(), signature)
+    if not cache.lookup(key, check):
+        raise BadSignatureError("Signature was forged or corrupt")
+
+
+def verify_ecdsa_many(items):
+    """
+    Check a list of `(message, signature, pubkey)` tuples. Signatures that
+    aren't already cached are verified together on the crypto process pool.
+
+    Returns:
+        A `Deferred` firing with a list of bools in the same order.
+    """
+    keys = [_ecdsa_key(*item) for item in items]
+    results = [cache.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+
+    def verified(valid):
+        for i, result in zip(missing, valid):
+            cache.put(keys[i], result)
+            results[i] = result
+        return results
+    return cryptopool.pool.map(cryptopool.ecdsa_verify, [items[i] for i in missing]).addCallback(verified)
+
+
+def _ecdsa_key(message, signature, pubkey):
+    return "ecdsa", pubkey, hashlib.sha256(message).digest(), signature
+
+
+def valid_guid(pubkey, guid):
+    """
+    Return True if the hex encoded `guid` was derived from `pubkey` and
+    satisfies the proof of work.
+    """
+    def check():
+        h = nacl.hash.sha512(pubkey)
+        return h[:40] if int(h[40:46], 16) < 50 else ""
+    return cache.lookup(("guid", pubkey), check) == guid
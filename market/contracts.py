@@ -15,12 +15,14 @@ from bitcoin.core.script import CScript, OP_2, OP_3, OP_CHECKMULTISIG
 from bitcoin.wallet import P2SHBitcoinAddress, P2PKHBitcoinAddress, CBitcoinAddress
 from collections import OrderedDict
 from config import DATA_FOLDER, TRANSACTION_FEE
-from copy import deepcopy
 from datetime import datetime
+from db.contracts import PURCHASES_UNFUNDED, PURCHASES_IN_PROGRESS, PURCHASES_TRADE_RECEIPTS, SALES_UNFUNDED, \
+    SALES_IN_PROGRESS, SALES_TRADE_RECEIPTS
 from dht.utils import digest
 from hashlib import sha256
 from keys.bip32utils import derive_childkey
 from keys.keychain import KeyChain
+from keys.verification import verify_signature, verify_ecdsa_many
 from log import Logger
 from market.profile import Profile
 from market.btcprice import BtcPrice
@@ -28,6 +30,7 @@ from market.transactions import BitcoinTransaction
 from protos.countries import CountryCode
 from protos.objects import Listings
 from market.smtpnotification import SMTPNotification
+from twisted.internet import defer
 
 
 class Contract(object):
@@ -61,29 +64,18 @@ class Contract(object):
                 with open(file_path, 'r') as filename:
                     self.contract = json.load(filename, object_pairs_hook=OrderedDict)
             except Exception:
-                file_name = hash_value.encode("hex") + ".json"
-                if os.path.exists(os.path.join(DATA_FOLDER, "purchases", "unfunded", file_name)):
-                    file_path = os.path.join(DATA_FOLDER, "purchases", "unfunded", file_name)
-                elif os.path.exists(os.path.join(DATA_FOLDER, "purchases", "in progress", file_name)):
-                    file_path = os.path.join(DATA_FOLDER, "purchases", "in progress", file_name)
-                elif os.path.exists(os.path.join(DATA_FOLDER, "purchases", "trade receipts", file_name)):
-                    file_path = os.path.join(DATA_FOLDER, "purchases", "trade receipts", file_name)
-                elif os.path.exists(os.path.join(DATA_FOLDER, "store", "contracts", "unfunded", file_name)):
-                    file_path = os.path.join(DATA_FOLDER, "store", "contracts", "unfunded", file_name)
-                elif os.path.exists(os.path.join(DATA_FOLDER, "store", "contracts", "in progress", file_name)):
-                    file_path = os.path.join(DATA_FOLDER, "store", "contracts", "in progress", file_name)
-                elif os.path.exists(os.path.join(DATA_FOLDER, "store", "contracts", "trade receipts", file_name)):
-                    file_path = os.path.join(DATA_FOLDER, "store", "contracts", "trade receipts", file_name)
-
                 try:
-                    with open(file_path, 'r') as filename:
-                        self.contract = json.load(filename, object_pairs_hook=OrderedDict)
+                    self.contract = self.db.contracts.load(hash_value.encode("hex")) or {}
                 except Exception:
                     self.contract = {}
         else:
             self.contract = {}
         self.log = Logger(system=self)
 
+        # memoized serializations, see `serialize`
+        self._canonical = {}
+        self._canonical_state = None
+
         # used when purchasing this contract
         self.testnet = testnet
         self.notification_listener = None
@@ -269,13 +261,14 @@ class Contract(object):
                     }
                     self.contract["vendor_offer"]["listing"]["moderators"].append(moderator)
 
-        listing = json.dumps(self.contract["vendor_offer"]["listing"], indent=4)
+        listing = self.serialize("vendor_offer", "listing")
         self.contract["vendor_offer"]["signatures"] = {}
         self.contract["vendor_offer"]["signatures"]["guid"] = \
             base64.b64encode(self.keychain.signing_key.sign(listing)[:64])
         self.contract["vendor_offer"]["signatures"]["bitcoin"] = \
             bitcointools.encode_sig(*bitcointools.ecdsa_raw_sign(
                 listing, bitcointools.bip32_extract_key(self.keychain.bitcoin_master_privkey)))
+        self.changed()
         self.save()
 
     def add_purchase_info(self,
@@ -312,7 +305,7 @@ class Contract(object):
         order_json = {
             "buyer_order": {
                 "order": {
-                    "ref_hash": digest(json.dumps(self.contract, indent=4)).encode("hex"),
+                    "ref_hash": self.get_digest().encode("hex"),
                     "date": str(datetime.utcnow()) + " UTC",
                     "quantity": quantity,
                     "id": {
@@ -416,13 +409,14 @@ class Contract(object):
         order_json["buyer_order"]["order"]["payment"]["amount"] = round(amount_to_pay, 8)
         self.contract["buyer_order"] = order_json["buyer_order"]
 
-        order = json.dumps(self.contract["buyer_order"]["order"], indent=4)
+        order = self.serialize("buyer_order", "order")
         self.contract["buyer_order"]["signatures"] = {}
         self.contract["buyer_order"]["signatures"]["guid"] = \
             base64.b64encode(self.keychain.signing_key.sign(order)[:64])
         self.contract["buyer_order"]["signatures"]["bitcoin"] = \
             bitcointools.encode_sig(*bitcointools.ecdsa_raw_sign(
                 order, bitcointools.bip32_extract_key(self.keychain.bitcoin_master_privkey)))
+        self.changed()
 
         return (self.contract["buyer_order"]["order"]["payment"]["address"],
                 order_json["buyer_order"]["order"]["payment"]["amount"])
@@ -452,7 +446,7 @@ class Contract(object):
         conf_json = {
             "vendor_order_confirmation": {
                 "invoice": {
-                    "ref_hash": digest(json.dumps(self.contract, indent=4)).encode("hex")
+                    "ref_hash": self.get_digest().encode("hex")
                 }
             }
         }
@@ -464,7 +458,7 @@ class Contract(object):
             conf_json["vendor_order_confirmation"]["invoice"]["content_source"] = content_source
         if comments:
             conf_json["vendor_order_confirmation"]["invoice"]["comments"] = comments
-        order_id = digest(json.dumps(self.contract, indent=4)).encode("hex")
+        order_id = self.get_digest().encode("hex")
         # apply signatures
         outpoints = json.loads(self.db.sales.get_outpoint(order_id))
         if "moderator" in self.contract["buyer_order"]["order"]:
@@ -497,9 +491,7 @@ class Contract(object):
 
         self.contract["vendor_order_confirmation"] = conf_json["vendor_order_confirmation"]
         self.db.sales.update_status(order_id, 2)
-        file_path = os.path.join(DATA_FOLDER, "store", "contracts", "in progress", order_id + ".json")
-        with open(file_path, 'w') as outfile:
-            outfile.write(json.dumps(self.contract, indent=4))
+        self.db.contracts.save(order_id, self.contract, SALES_IN_PROGRESS)
 
     def accept_order_confirmation(self, notification_listener, confirmation_json=None):
         """
@@ -511,9 +503,7 @@ class Contract(object):
                 self.contract["vendor_order_confirmation"] = json.loads(confirmation_json,
                                                                         object_pairs_hook=OrderedDict)
 
-            contract_dict = json.loads(json.dumps(self.contract, indent=4), object_pairs_hook=OrderedDict)
-            del contract_dict["vendor_order_confirmation"]
-            contract_hash = digest(json.dumps(contract_dict, indent=4)).encode("hex")
+            contract_hash = self.get_digest(exclude=("vendor_order_confirmation",)).encode("hex")
             ref_hash = self.contract["vendor_order_confirmation"]["invoice"]["ref_hash"]
             if ref_hash != contract_hash:
                 raise Exception("Order number doesn't match")
@@ -531,11 +521,9 @@ class Contract(object):
             # update the order status in the db
             self.db.purchases.update_status(contract_hash, 2)
             self.db.purchases.status_changed(contract_hash, 1)
-            file_path = os.path.join(DATA_FOLDER, "purchases", "in progress", contract_hash + ".json")
 
             # update the contract in the file system
-            with open(file_path, 'w') as outfile:
-                outfile.write(json.dumps(self.contract, indent=4))
+            self.db.contracts.save(contract_hash, self.contract, PURCHASES_IN_PROGRESS)
             title = self.contract["vendor_offer"]["listing"]["item"]["title"]
             if "image_hashes" in self.contract["vendor_offer"]["listing"]["item"]:
                 image_hash = unhexlify(self.contract["vendor_offer"]["listing"]["item"]["image_hashes"][0])
@@ -576,12 +564,7 @@ class Contract(object):
         Add the final piece of the contract that appends the review and payout transaction.
         """
         self.blockchain = libbitcoin_client
-        contract_dict = json.loads(json.dumps(self.contract, indent=4), object_pairs_hook=OrderedDict)
-        if "dispute" in contract_dict:
-            del contract_dict["dispute"]
-        if "dispute_resolution" in contract_dict:
-            del contract_dict["dispute_resolution"]
-        reference_hash = digest(json.dumps(contract_dict, indent=4)).encode("hex")
+        reference_hash = self.get_digest(exclude=("dispute", "dispute_resolution")).encode("hex")
         receipt_json = {
             "buyer_receipt": {
                 "receipt": {
@@ -674,26 +657,21 @@ class Contract(object):
         self.contract["buyer_receipt"] = receipt_json["buyer_receipt"]
 
         if "rating" in self.contract["buyer_receipt"]["receipt"]:
+            tx_summary = self.serialize("buyer_receipt", "receipt", "rating", "tx_summary")
             self.contract["buyer_receipt"]["receipt"]["rating"]["signature"] = \
-                bitcointools.encode_sig(*bitcointools.ecdsa_raw_sign(json.dumps(
-                    self.contract["buyer_receipt"]["receipt"]["rating"]["tx_summary"], indent=4), buyer_priv))
+                bitcointools.encode_sig(*bitcointools.ecdsa_raw_sign(tx_summary, buyer_priv))
             if not anonymous:
                 self.contract["buyer_receipt"]["receipt"]["rating"]["guid_signature"] = \
-                    base64.b64encode(self.keychain.signing_key.sign(json.dumps(
-                        self.contract["buyer_receipt"]["receipt"]["rating"]["tx_summary"], indent=4))[:64])
+                    base64.b64encode(self.keychain.signing_key.sign(tx_summary)[:64])
+            self.changed()
 
         if status < 3:
             self.db.purchases.update_status(order_id, 3)
-            file_path = os.path.join(DATA_FOLDER, "purchases", "trade receipts", order_id + ".json")
-            with open(file_path, 'w') as outfile:
-                outfile.write(json.dumps(self.contract, indent=4))
-            file_path = os.path.join(DATA_FOLDER, "purchases", "in progress", order_id + ".json")
-            if os.path.exists(file_path):
-                os.remove(file_path)
+        if status < 3 or self.db.contracts.get_folder(order_id) != PURCHASES_IN_PROGRESS:
+            self.db.contracts.save(order_id, self.contract, PURCHASES_TRADE_RECEIPTS)
         else:
-            file_path = os.path.join(DATA_FOLDER, "purchases", "trade receipts", order_id + ".json")
-            with open(file_path, 'wb') as outfile:
-                outfile.write(json.dumps(self.contract, indent=4))
+            # a disputed order stays in progress until the dispute is closed
+            self.db.contracts.save(order_id, self.contract, PURCHASES_IN_PROGRESS)
 
     def accept_receipt(self, notification_listener, blockchain, receipt_json=None):
         """
@@ -708,13 +686,7 @@ class Contract(object):
             self.contract["buyer_receipt"] = json.loads(receipt_json,
                                                         object_pairs_hook=OrderedDict)
 
-        contract_dict = json.loads(json.dumps(self.contract, indent=4), object_pairs_hook=OrderedDict)
-        del contract_dict["buyer_receipt"]
-        if "dispute" in contract_dict:
-            del contract_dict["dispute"]
-        if "dispute_resolution" in contract_dict:
-            del contract_dict["dispute_resolution"]
-        contract_hash = digest(json.dumps(contract_dict, indent=4)).encode("hex")
+        contract_hash = self.get_digest(exclude=("buyer_receipt", "dispute", "dispute_resolution")).encode("hex")
         ref_hash = self.contract["buyer_receipt"]["receipt"]["ref_hash"]
         if ref_hash != contract_hash:
             raise Exception("Order number doesn't match")
@@ -791,12 +763,7 @@ class Contract(object):
         if status == 2:
             self.db.sales.status_changed(order_id, 1)
             self.db.sales.update_status(order_id, 3)
-        file_path = os.path.join(DATA_FOLDER, "store", "contracts", "trade receipts", order_id + ".json")
-        with open(file_path, 'w') as outfile:
-            outfile.write(json.dumps(self.contract, indent=4))
-        file_path = os.path.join(DATA_FOLDER, "store", "contracts", "in progress", order_id + ".json")
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        self.db.contracts.save(order_id, self.contract, SALES_TRADE_RECEIPTS)
 
         return order_id
 
@@ -808,7 +775,7 @@ class Contract(object):
         self.notification_listener = notification_listener
         self.blockchain = libbitcoin_client
         self.is_purchase = is_purchase
-        order_id = digest(json.dumps(self.contract, indent=4)).encode("hex")
+        order_id = self.get_digest().encode("hex")
         payment_address = self.contract["buyer_order"]["order"]["payment"]["address"]
         vendor_item = self.contract["vendor_offer"]["listing"]["item"]
         if "image_hashes" in vendor_item:
@@ -826,7 +793,7 @@ class Contract(object):
         else:
             buyer = self.contract["buyer_order"]["order"]["id"]["guid"]
         if is_purchase:
-            file_path = os.path.join(DATA_FOLDER, "purchases", "unfunded", order_id + ".json")
+            folder = PURCHASES_UNFUNDED
             self.db.purchases.new_purchase(order_id,
                                            self.contract["vendor_offer"]["listing"]["item"]["title"],
                                            self.contract["vendor_offer"]["listing"]["item"]["description"],
@@ -839,7 +806,7 @@ class Contract(object):
                                            proofSig,
                                            self.contract["vendor_offer"]["listing"]["metadata"]["category"])
         else:
-            file_path = os.path.join(DATA_FOLDER, "store", "contracts", "unfunded", order_id + ".json")
+            folder = SALES_UNFUNDED
             title = self.contract["vendor_offer"]["listing"]["item"]["title"]
             description = self.contract["vendor_offer"]["listing"]["item"]["description"]
             self.db.sales.new_sale(order_id,
@@ -864,8 +831,7 @@ class Contract(object):
             except Exception as e:
                 self.log.info("Error with SMTP notification: %s" % e.message)
 
-        with open(file_path, 'w') as outfile:
-            outfile.write(json.dumps(self.contract, indent=4))
+        self.db.contracts.save(order_id, self.contract, folder)
         self.blockchain.subscribe_address(str(payment_address), notification_cb=self.on_tx_received)
 
     def on_tx_received(self, address_version, address_hash, height, block_hash, tx):
@@ -893,7 +859,7 @@ class Contract(object):
                 if self.amount_funded >= amount_to_pay:  # if fully funded
                     self.payment_received()
                 else:
-                    order_id = digest(json.dumps(self.contract, indent=4)).encode("hex")
+                    order_id = self.get_digest().encode("hex")
                     notification_json = {
                         "notification": {
                             "type": "partial payment",
@@ -907,15 +873,14 @@ class Contract(object):
             self.log.critical("Error processing bitcoin transaction: %s" % e.message)
 
     def payment_received(self):
-        order_id = digest(json.dumps(self.contract, indent=4)).encode("hex")
+        order_id = self.get_digest().encode("hex")
         title = self.contract["vendor_offer"]["listing"]["item"]["title"]
         if "image_hashes" in self.contract["vendor_offer"]["listing"]["item"]:
             image_hash = unhexlify(self.contract["vendor_offer"]["listing"]["item"]["image_hashes"][0])
         else:
             image_hash = ""
         if self.is_purchase:
-            unfunded_path = os.path.join(DATA_FOLDER, "purchases", "unfunded", order_id + ".json")
-            in_progress_path = os.path.join(DATA_FOLDER, "purchases", "in progress", order_id + ".json")
+            in_progress = PURCHASES_IN_PROGRESS
             if "blockchain_id" in self.contract["vendor_offer"]["listing"]["id"]:
                 handle = self.contract["vendor_offer"]["listing"]["id"]["blockchain_id"]
             else:
@@ -937,8 +902,7 @@ class Contract(object):
             self.db.purchases.update_outpoint(order_id, json.dumps(self.outpoints))
             self.log.info("Payment for order id %s successfully broadcast to network." % order_id)
         else:
-            unfunded_path = os.path.join(DATA_FOLDER, "store", "contracts", "unfunded", order_id + ".json")
-            in_progress_path = os.path.join(DATA_FOLDER, "store", "contracts", "in progress", order_id + ".json")
+            in_progress = SALES_IN_PROGRESS
             buyer_guid = self.contract["buyer_order"]["order"]["id"]["guid"]
             if "blockchain_id" in self.contract["buyer_order"]["order"]["id"]:
                 handle = self.contract["buyer_order"]["order"]["id"]["blockchain_id"]
@@ -957,22 +921,59 @@ class Contract(object):
                                   "Payment was received for Order #%s." % order_id)
                 self.log.info("Received new order %s" % order_id)
 
-        os.rename(unfunded_path, in_progress_path)
+        self.db.contracts.move(order_id, in_progress)
 
     def get_contract_id(self):
         return self.contract["vendor_offer"]["listing"]["contract_id"]
 
     def get_order_id(self):
-        contract_dict = json.loads(json.dumps(self.contract, indent=4), object_pairs_hook=OrderedDict)
-        if "vendor_order_confirmation" in contract_dict:
-            del contract_dict["vendor_order_confirmation"]
-        if "buyer_receipt" in contract_dict:
-            del contract_dict["buyer_receipt"]
-        if "dispute" in contract_dict:
-            del contract_dict["dispute"]
-        if "dispute_resolution" in contract_dict:
-            del contract_dict["dispute_resolution"]
-        return digest(json.dumps(contract_dict, indent=4)).encode("hex")
+        return self.get_digest(exclude=("vendor_order_confirmation", "buyer_receipt",
+                                        "dispute", "dispute_resolution")).encode("hex")
+
+    def serialize(self, *path, **kwargs):
+        """
+        Return the json serialization of the section of the contract at `path`, the
+        form that gets hashed and signed. For example `serialize("buyer_order", "order")`.
+        Top level sections listed in the `exclude` keyword argument are left out.
+
+        The result is remembered until the contract changes. Replacing a top level
+        section is noticed automatically but anything that modifies a section in place
+        must call `changed` afterwards.
+        """
+        exclude = kwargs.get("exclude", ())
+        state = self.contract, self.contract.items()
+        if self._canonical_state is None or state[0] is not self._canonical_state[0] or \
+                len(state[1]) != len(self._canonical_state[1]) or \
+                any(k != k2 or v is not v2 for (k, v), (k2, v2) in zip(state[1], self._canonical_state[1])):
+            self._canonical = {}
+            self._canonical_state = state
+        key = path, tuple(exclude)
+        if key not in self._canonical:
+            if exclude:
+                section = OrderedDict((k, v) for k, v in self.contract.items() if k not in exclude)
+            else:
+                section = self.contract
+            for name in path:
+                section = section[name]
+            self._canonical[key] = [json.dumps(section, indent=4), None]
+        return self._canonical[key][0]
+
+    def get_digest(self, *path, **kwargs):
+        """
+        Return the hash of `serialize(*path, **kwargs)`. Memoized the same way.
+        """
+        serialized = self.serialize(*path, **kwargs)
+        entry = self._canonical[path, tuple(kwargs.get("exclude", ()))]
+        if entry[1] is None:
+            entry[1] = digest(serialized)
+        return entry[1]
+
+    def changed(self):
+        """
+        Forget the memoized serializations after the contract was modified in place.
+        """
+        self._canonical = {}
+        self._canonical_state = None
 
     def check_expired(self):
         expiry = self.contract["vendor_offer"]["listing"]["metadata"]["expiry"]
@@ -1001,6 +1002,7 @@ class Contract(object):
                     os.remove(image_path)
                 # remove pointer to the image from the filemap
                 self.db.filemap.delete(image_hash)
+                self.db.filecache.invalidate(image_hash)
 
         # delete the contract from disk
         if os.path.exists(file_path):
@@ -1012,6 +1014,7 @@ class Contract(object):
 
         # remove the pointer to the contract from the filemap
         self.db.filemap.delete(contract_hash.encode("hex"))
+        self.db.filecache.invalidate(contract_hash.encode("hex"))
 
     def save(self):
         """
@@ -1083,6 +1086,7 @@ class Contract(object):
 
         # save the mapping of the contract file path and contract hash in the database
         self.db.filemap.insert(data.contract_hash.encode("hex"), file_path[len(DATA_FOLDER):])
+        self.db.filecache.invalidate(data.contract_hash.encode("hex"))
 
         # save the `ListingMetadata` protobuf to the database as well
         self.db.listings.add_listing(data)
@@ -1131,12 +1135,7 @@ class Contract(object):
 
         self.db.purchases.update_status(order_id, 7)
         self.db.purchases.status_changed(order_id, 1)
-        file_path = os.path.join(DATA_FOLDER, "purchases", "trade receipts", order_id + ".json")
-        with open(file_path, 'w') as outfile:
-            outfile.write(json.dumps(self.contract, indent=4))
-        file_path = os.path.join(DATA_FOLDER, "purchases", "in progress", order_id + ".json")
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        self.db.contracts.save(order_id, self.contract, PURCHASES_TRADE_RECEIPTS)
 
         title = self.contract["vendor_offer"]["listing"]["item"]["title"]
         if "image_hashes" in self.contract["vendor_offer"]["listing"]["item"]:
@@ -1158,12 +1157,24 @@ class Contract(object):
     def verify(self, sender_key):
         """
         Validate that an order sent over by a buyer is filled out correctly.
+
+        Returns a `Deferred` firing with True or the reason the order is invalid.
+        The buyer's bitcoin signature is checked on the crypto pool.
         """
+        valid = self._verify_order(sender_key)
+        if valid is not True:
+            return defer.succeed(valid)
+
+        verify_obj = self.serialize("buyer_order", "order")
+        bitcoin_key = self.contract["buyer_order"]["order"]["id"]["pubkeys"]["bitcoin"]
+        bitcoin_sig = self.contract["buyer_order"]["signatures"]["bitcoin"]
+        d = verify_ecdsa_many([(verify_obj, bitcoin_sig, bitcoin_key)])
+        return d.addCallback(lambda v: True if v[0] else "Invalid Bitcoin signature")
+
+    def _verify_order(self, sender_key):
         SelectParams("testnet" if self.testnet else "mainnet")
         try:
-            contract_dict = json.loads(json.dumps(self.contract, indent=4), object_pairs_hook=OrderedDict)
-            del contract_dict["buyer_order"]
-            contract_hash = digest(json.dumps(contract_dict, indent=4))
+            contract_hash = self.get_digest(exclude=("buyer_order",))
 
             ref_hash = unhexlify(self.contract["buyer_order"]["order"]["ref_hash"])
             contract_id = self.contract["vendor_offer"]["listing"]["contract_id"]
@@ -1173,9 +1184,9 @@ class Contract(object):
                 raise Exception("Order for contract that doesn't exist")
 
             # verify the vendor's own signature
-            verify_key = self.keychain.signing_key.verify_key
-            verify_key.verify(json.dumps(self.contract["vendor_offer"]["listing"], indent=4),
-                              base64.b64decode(self.contract["vendor_offer"]["signatures"]["guid"]))
+            verify_signature(self.keychain.signing_key.verify_key.encode(),
+                             self.serialize("vendor_offer", "listing"),
+                             base64.b64decode(self.contract["vendor_offer"]["signatures"]["guid"]))
 
             # verify timestamp is within a reasonable time from now
             timestamp = self.contract["buyer_order"]["order"]["date"]
@@ -1184,16 +1195,10 @@ class Contract(object):
                 raise Exception("Timestamp on order not within 10 minutes of now")
 
             # verify the signatures on the order
-            verify_obj = json.dumps(self.contract["buyer_order"]["order"], indent=4)
-
-            verify_key = nacl.signing.VerifyKey(sender_key)
-            verify_key.verify(verify_obj, base64.b64decode(self.contract["buyer_order"]["signatures"]["guid"]))
+            verify_obj = self.serialize("buyer_order", "order")
 
-            bitcoin_key = self.contract["buyer_order"]["order"]["id"]["pubkeys"]["bitcoin"]
-            bitcoin_sig = self.contract["buyer_order"]["signatures"]["bitcoin"]
-            valid = bitcointools.ecdsa_raw_verify(verify_obj, bitcointools.decode_sig(bitcoin_sig), bitcoin_key)
-            if not valid:
-                raise Exception("Invalid Bitcoin signature")
+            verify_signature(sender_key, verify_obj,
+                             base64.b64decode(self.contract["buyer_order"]["signatures"]["guid"]))
 
             # verify the quantity does not exceed the max
             quantity = int(self.contract["buyer_order"]["order"]["quantity"])
@@ -1311,19 +1316,11 @@ class Contract(object):
     def validate_for_moderation(self, proof_sig):
         validation_failures = []
 
-        tmp_contract = deepcopy(self.contract)
-        if "buyer_order" in tmp_contract:
-            del tmp_contract["buyer_order"]
-        if "vendor_order_confirmation" in tmp_contract:
-            del tmp_contract["vendor_order_confirmation"]
-        if "buyer_receipt" in tmp_contract:
-            del tmp_contract["buyer_receipt"]
-        del tmp_contract["dispute"]
-
-        contract_hash = digest(json.dumps(tmp_contract, indent=4))
+        contract_hash = self.get_digest(exclude=("buyer_order", "vendor_order_confirmation",
+                                                 "buyer_receipt", "dispute"))
         ref_hash = unhexlify(self.contract["buyer_order"]["order"]["ref_hash"])
 
-        listing = json.dumps(self.contract["vendor_offer"]["listing"], indent=4)
+        listing = self.serialize("vendor_offer", "listing")
 
         # verify that the reference hash matches the contract
         if contract_hash != ref_hash:
@@ -1347,7 +1344,7 @@ class Contract(object):
             validation_failures.append("Bitcoin signature in vendor_offer is not valid;")
 
         # verify the signatures on the order
-        order = json.dumps(self.contract["buyer_order"]["order"], indent=4)
+        order = self.serialize("buyer_order", "order")
         buyer_guid_signature = self.contract["buyer_order"]["signatures"]["guid"]
         buyer_bitcoin_signature = self.contract["buyer_order"]["signatures"]["bitcoin"]
         buyer_bitcoin_pubkey = self.contract["buyer_order"]["order"]["id"]["pubkeys"]["bitcoin"]
@@ -1408,16 +1405,12 @@ class Contract(object):
 
         # validate vendor_order_confirmation
         if "vendor_order_confirmation" in self.contract:
-            contract_dict = json.loads(json.dumps(self.contract, indent=4), object_pairs_hook=OrderedDict)
-            del contract_dict["vendor_order_confirmation"]
-            if "buyer_receipt" in contract_dict:
-                del contract_dict["buyer_receipt"]
-            contract_hash = digest(json.dumps(contract_dict, indent=4)).encode("hex")
+            contract_hash = self.get_digest(exclude=("vendor_order_confirmation", "buyer_receipt")).encode("hex")
             ref_hash = self.contract["vendor_order_confirmation"]["invoice"]["ref_hash"]
             if ref_hash != contract_hash:
                 validation_failures.append("Reference hash in vendor_order_confirmation does not match order ID;")
             vendor_signature = self.contract["vendor_order_confirmation"]["signature"]
-            confirmation = json.dumps(self.contract["vendor_order_confirmation"]["invoice"], indent=4)
+            confirmation = self.serialize("vendor_order_confirmation", "invoice")
             verify_key = nacl.signing.VerifyKey(vendor_guid_pubkey)
             try:
                 verify_key.verify(confirmation, base64.b64decode(vendor_signature))
@@ -1456,15 +1449,11 @@ def check_unfunded_for_payment(db, libbitcoin_client, notification_listener, tes
 
 def check_order_for_payment(order_id, db, libbitcoin_client, notification_listener, testnet=False):
     try:
-        if os.path.exists(os.path.join(DATA_FOLDER, "purchases", "unfunded", order_id + ".json")):
-            file_path = os.path.join(DATA_FOLDER, "purchases", "unfunded", order_id + ".json")
-            is_purchase = True
-        elif os.path.exists(os.path.join(DATA_FOLDER, "store", "contracts", "unfunded", order_id + ".json")):
-            file_path = os.path.join(DATA_FOLDER, "store", "contracts", "unfunded", order_id + ".json")
-            is_purchase = False
-        with open(file_path, 'r') as filename:
-            order = json.load(filename, object_pairs_hook=OrderedDict)
-        c = Contract(db, contract=order, testnet=testnet)
+        folder = db.contracts.get_folder(order_id)
+        if folder not in (PURCHASES_UNFUNDED, SALES_UNFUNDED):
+            return
+        is_purchase = folder == PURCHASES_UNFUNDED
+        c = Contract(db, contract=db.contracts.load(order_id), testnet=testnet)
         c.blockchain = libbitcoin_client
         c.notification_listener = notification_listener
         c.is_purchase = is_purchase
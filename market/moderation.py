@@ -1,12 +1,10 @@
 import base64
 import json
 import nacl.signing
-import os
 import time
 from binascii import unhexlify
-from collections import OrderedDict
-from config import DATA_FOLDER
 from copy import deepcopy
+from db.contracts import PURCHASES_IN_PROGRESS, SALES_IN_PROGRESS, CASES
 from dht.utils import digest
 from keys.keychain import KeyChain
 from market.contracts import Contract
@@ -118,8 +116,7 @@ def process_dispute(contract, db, message_listener, notification_listener, testn
                               buyer, vendor, json.dumps(validation_failures),
                               contract["dispute"]["info"]["claim"])
 
-            with open(os.path.join(DATA_FOLDER, "cases", order_id + ".json"), 'wb') as outfile:
-                outfile.write(json.dumps(contract, indent=4))
+            db.contracts.save(order_id, contract, CASES)
     else:
         raise Exception("Order ID for dispute not found")
 
@@ -155,13 +152,10 @@ def close_dispute(resolution_json, db, message_listener, notification_listener,
 
     order_id = resolution_json["dispute_resolution"]["resolution"]["order_id"]
 
-    if os.path.exists(os.path.join(DATA_FOLDER, "purchases", "in progress", order_id + ".json")):
-        file_path = os.path.join(DATA_FOLDER, "purchases", "in progress", order_id + ".json")
-    elif os.path.exists(os.path.join(DATA_FOLDER, "store", "contracts", "in progress", order_id + ".json")):
-        file_path = os.path.join(DATA_FOLDER, "store", "contracts", "in progress", order_id + ".json")
-
-    with open(file_path, 'r') as filename:
-        contract = json.load(filename, object_pairs_hook=OrderedDict)
+    folder = db.contracts.get_folder(order_id)
+    if folder not in (PURCHASES_IN_PROGRESS, SALES_IN_PROGRESS):
+        raise Exception("Order ID for dispute not found")
+    contract = db.contracts.load(order_id)
 
     for moderator in contract["vendor_offer"]["listing"]["moderators"]:
         if moderator["guid"] == contract["buyer_order"]["order"]["moderator"]:
@@ -184,8 +178,7 @@ def close_dispute(resolution_json, db, message_listener, notification_listener,
         db.sales.status_changed(order_id, 1)
         db.sales.update_status(order_id, 5)
 
-    with open(file_path, 'wb') as outfile:
-        outfile.write(json.dumps(contract, indent=4))
+    db.contracts.save(order_id, contract, folder)
 
     p = PlaintextMessage()
     p.sender_guid = moderator_guid
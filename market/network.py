@@ -3,35 +3,38 @@ __author__ = 'chris'
 import base64
 import bitcointools
 import gnupg
-import httplib
+import heapq
 import json
 import nacl.signing
-import nacl.hash
 import nacl.encoding
 import nacl.utils
 import obelisk
 import os.path
-import pickle
 import time
 import struct
 from binascii import unhexlify
 from bitcoin.core import b2lx
-from collections import OrderedDict
-from config import DATA_FOLDER, TRANSACTION_FEE
+from collections import Counter, OrderedDict, deque
+from config import DATA_FOLDER, TRANSACTION_FEE, BROADCAST_CONCURRENCY
+from db.contracts import PURCHASES_IN_PROGRESS, SALES_IN_PROGRESS, SALES_TRADE_RECEIPTS, CASES
+from dht.network import fetchSeed
 from dht.node import Node
 from dht.utils import digest
 from keys.bip32utils import derive_childkey
+from keys.cryptopool import sign_ecdsa_many
 from keys.keychain import KeyChain
+from keys.verification import verify_signature, verify_ecdsa_many, valid_guid
 from log import Logger
 from market.contracts import Contract
 from market.moderation import process_dispute, close_dispute
 from market.profile import Profile
 from market.protocol import MarketProtocol
 from market.transactions import BitcoinTransaction
+from market.transfer import ChunkedDownload
 from nacl.public import PrivateKey, PublicKey, Box
 from protos import objects
-from seed import peers
 from twisted.internet import defer, reactor, task
+from twisted.python.failure import Failure
 
 
 class Server(object):
@@ -47,41 +50,42 @@ class Server(object):
         self.db = database
         self.log = Logger(system=self)
         self.protocol = MarketProtocol(kserver.node, self.router, signing_key, database, audit)
+        self.downloads = {}
+        self.images = ImageFetcher(self.get_image)
+        self.republisher = Republisher(kserver, database)
+        self.last_broadcast = None
         task.LoopingCall(self.update_listings).start(3600, now=True)
 
     def querySeed(self, list_seed_pubkey):
         """
-        Query an HTTP seed for known vendors and save the vendors to the db.
+        Query the HTTP seeds, all at once, for known vendors and save the vendors to the db.
 
         Args:
             Receives a list of one or more tuples Example [(seed, pubkey)]
             seed: A `string` consisting of "ip:port" or "hostname:port"
             pubkey: The hex encoded public key to verify the signature on the response
+
+        Returns:
+            A `Deferred` firing once every seed has responded or failed.
         """
 
-        for sp in list_seed_pubkey:
-            seed, pubkey = sp
-            try:
-                self.log.debug("querying %s for vendors" % seed)
-                c = httplib.HTTPConnection(seed)
-                c.request("GET", "/?type=vendors")
-                response = c.getresponse()
-                self.log.debug("Http response from %s: %s, %s" % (seed, response.status, response.reason))
-                data = response.read()
-                reread_data = data.decode("zlib")
-                proto = peers.PeerSeeds()
-                proto.ParseFromString(reread_data)
-                verify_key = nacl.signing.VerifyKey(pubkey, encoder=nacl.encoding.HexEncoder)
-                verify_key.verify("".join(proto.serializedNode), proto.signature)
-                for peer in proto.serializedNode:
-                    try:
-                        n = objects.Node()
-                        n.ParseFromString(peer)
-                        self.db.vendors.save_vendor(n.guid.encode("hex"), peer)
-                    except Exception:
-                        pass
-            except Exception, e:
-                self.log.error("failed to query seed: %s" % str(e))
+        def save_vendors(serialized_nodes):
+            for peer in serialized_nodes:
+                try:
+                    n = objects.Node()
+                    n.ParseFromString(peer)
+                    self.db.vendors.save_vendor(n.guid.encode("hex"), peer)
+                except Exception:
+                    pass
+
+        def failed(failure):
+            self.log.error("failed to query seed: %s" % failure.getErrorMessage())
+
+        ds = []
+        for seed, pubkey in list_seed_pubkey:
+            self.log.debug("querying %s for vendors" % seed)
+            ds.append(fetchSeed(seed, pubkey, "?type=vendors").addCallback(save_vendors).addErrback(failed))
+        return defer.DeferredList(ds)
 
     def get_contract(self, node_to_ask, contract_id):
         """
@@ -97,9 +101,13 @@ class Server(object):
         """
 
         def get_result(result):
+            file_path = None
             try:
-                if result[0]:
-                    contract = json.loads(result[1][0], object_pairs_hook=OrderedDict)
+                file_path = self._completed_file(result, contract_id.encode("hex"))
+                if file_path is not None:
+                    with open(file_path, "rb") as f:
+                        serialized_contract = f.read()
+                    contract = json.loads(serialized_contract, object_pairs_hook=OrderedDict)
                     id_in_contract = contract["vendor_offer"]["listing"]["contract_id"]
 
                     if id_in_contract != contract_id.encode("hex"):
@@ -109,15 +117,7 @@ class Server(object):
                     signature = contract["vendor_offer"]["signatures"]["guid"]
                     verify_obj = json.dumps(contract["vendor_offer"]["listing"], indent=4)
 
-                    verify_key = nacl.signing.VerifyKey(node_to_ask.pubkey)
-                    verify_key.verify(verify_obj, base64.b64decode(signature))
-
-                    bitcoin_key = contract["vendor_offer"]["listing"]["id"]["pubkeys"]["bitcoin"]
-                    bitcoin_sig = contract["vendor_offer"]["signatures"]["bitcoin"]
-                    valid = bitcointools.ecdsa_raw_verify(verify_obj, bitcointools.decode_sig(bitcoin_sig),
-                                                          bitcoin_key)
-                    if not valid:
-                        raise Exception("Invalid Bitcoin signature")
+                    verify_signature(node_to_ask.pubkey, verify_obj, base64.b64decode(signature))
 
                     if "moderators" in contract["vendor_offer"]["listing"]:
                         for moderator in contract["vendor_offer"]["listing"]["moderators"]:
@@ -125,28 +125,38 @@ class Server(object):
                             guid_key = moderator["pubkeys"]["guid"]
                             bitcoin_key = moderator["pubkeys"]["bitcoin"]["key"]
                             bitcoin_sig = base64.b64decode(moderator["pubkeys"]["bitcoin"]["signature"])
-                            h = nacl.hash.sha512(unhexlify(guid_key))
-                            pow_hash = h[40:]
-                            if int(pow_hash[:6], 16) >= 50 or guid != h[:40]:
+                            if not valid_guid(unhexlify(guid_key), guid):
                                 raise Exception('Invalid GUID')
-                            verify_key = nacl.signing.VerifyKey(guid_key, encoder=nacl.encoding.HexEncoder)
-                            verify_key.verify(unhexlify(bitcoin_key), bitcoin_sig)
+                            verify_signature(unhexlify(guid_key), unhexlify(bitcoin_key), bitcoin_sig)
                             #TODO: should probably also validate the handle here.
-                    self.cache(result[1][0], id_in_contract)
-                    if "image_hashes" in contract["vendor_offer"]["listing"]["item"]:
-                        for image_hash in contract["vendor_offer"]["listing"]["item"]["image_hashes"]:
-                            self.get_image(node_to_ask, unhexlify(image_hash))
-                    return contract
+
+                    bitcoin_key = contract["vendor_offer"]["listing"]["id"]["pubkeys"]["bitcoin"]
+                    bitcoin_sig = contract["vendor_offer"]["signatures"]["bitcoin"]
+                    d = verify_ecdsa_many([(verify_obj, bitcoin_sig, bitcoin_key)])
+                    return d.addCallback(bitcoin_verified, contract, file_path)
                 else:
                     self.log.warning("Fetched an invalid contract from %s" % node_to_ask.id.encode("hex"))
                     return None
             except Exception:
+                self._discard(file_path)
+                return None
+
+        def bitcoin_verified(valid, contract, file_path):
+            if not valid[0]:
+                self.log.warning("Fetched a contract with an invalid bitcoin signature from %s" %
+                                 node_to_ask.id.encode("hex"))
+                self._discard(file_path)
                 return None
+            self._move_to_cache(file_path, contract_id.encode("hex"))
+            if "image_hashes" in contract["vendor_offer"]["listing"]["item"]:
+                for image_hash in contract["vendor_offer"]["listing"]["item"]["image_hashes"]:
+                    self.images.fetch(node_to_ask, unhexlify(image_hash))
+            return contract
 
         if node_to_ask.ip is None:
             return defer.succeed(None)
         self.log.info("fetching contract %s from %s" % (contract_id.encode("hex"), node_to_ask))
-        d = self.protocol.callGetContract(node_to_ask, contract_id)
+        d = self._download(node_to_ask, contract_id, self.protocol.callGetContract)
         return d.addCallback(get_result)
 
     def get_image(self, node_to_ask, image_hash):
@@ -160,21 +170,81 @@ class Server(object):
         """
 
         def get_result(result):
+            file_path = None
             try:
-                if result[0] and digest(result[1][0]) == image_hash:
-                    self.cache(result[1][0], digest(result[1][0]).encode("hex"))
-                    return result[1][0]
-                else:
+                file_path = self._completed_file(result, image_hash.encode("hex"))
+                if file_path is None:
                     return None
+                with open(file_path, "rb") as f:
+                    valid = digest(f.read()) == image_hash
+                if valid:
+                    return self._move_to_cache(file_path, image_hash.encode("hex"))
+                self.log.warning("Fetched an invalid image from %s" % node_to_ask.id.encode("hex"))
             except Exception:
-                return None
+                pass
+            self._discard(file_path)
+            return None
 
         if node_to_ask.ip is None or len(image_hash) != 20:
             return defer.succeed(None)
         self.log.info("fetching image %s from %s" % (image_hash.encode("hex"), node_to_ask))
-        d = self.protocol.callGetImage(node_to_ask, image_hash)
+        d = self._download(node_to_ask, image_hash, self.protocol.callGetImage)
         return d.addCallback(get_result)
 
+    def _download(self, node_to_ask, file_hash, fetch):
+        """
+        Fetch a file from the given node in chunks. Requests for a file that is
+        already being downloaded wait for that download. Once it's done the
+        download is forgotten and, if it failed, its partial file is removed.
+        """
+        if file_hash not in self.downloads:
+            path = os.path.join(DATA_FOLDER, "cache", file_hash.encode("hex") + ".part")
+            self.downloads[file_hash] = ChunkedDownload(file_hash, path)
+        download = self.downloads[file_hash]
+
+        def finished(result):
+            if self.downloads.get(file_hash) is download:
+                del self.downloads[file_hash]
+            if isinstance(result, Failure) or not result[0] or result[1] is None:
+                self._discard(download.path)
+            return result
+        return download.start(fetch, node_to_ask).addBoth(finished)
+
+    @staticmethod
+    def _completed_file(result, filename):
+        """
+        Return the path to the file a download finished with or None. Another
+        request waiting on the same download may have moved it into the cache
+        folder already.
+        """
+        if not result[0] or result[1] is None:
+            return None
+        if os.path.isfile(result[1]):
+            return result[1]
+        cached = os.path.join(DATA_FOLDER, "cache", filename)
+        return cached if os.path.isfile(cached) else None
+
+    @staticmethod
+    def _discard(file_path):
+        """
+        Remove a download that failed or didn't verify.
+        """
+        if file_path is not None and file_path.endswith(".part") and os.path.isfile(file_path):
+            os.remove(file_path)
+
+    @staticmethod
+    def _move_to_cache(file_path, filename):
+        """
+        Move a verified download into the cache folder and return its new path.
+        """
+        cached = os.path.join(DATA_FOLDER, "cache", filename)
+        if file_path != cached:
+            # os.rename won't overwrite an existing file on windows
+            if os.name == "nt" and os.path.exists(cached):
+                os.remove(cached)
+            os.rename(file_path, cached)
+        return cached
+
     def get_profile(self, node_to_ask):
         """
         Downloads the profile from the given node. If the images do not already
@@ -183,8 +253,7 @@ class Server(object):
 
         def get_result(result):
             try:
-                verify_key = nacl.signing.VerifyKey(node_to_ask.pubkey)
-                verify_key.verify(result[1][0], result[1][1])
+                verify_signature(node_to_ask.pubkey, result[1][0], result[1][1])
                 p = objects.Profile()
                 p.ParseFromString(result[1][0])
                 if p.pgp_key.public_key:
@@ -193,10 +262,8 @@ class Server(object):
                     if not gpg.verify(p.pgp_key.signature) or \
                                     node_to_ask.id.encode('hex') not in p.pgp_key.signature:
                         p.ClearField("pgp_key")
-                if not os.path.isfile(os.path.join(DATA_FOLDER, 'cache', p.avatar_hash.encode("hex"))):
-                    self.get_image(node_to_ask, p.avatar_hash)
-                if not os.path.isfile(os.path.join(DATA_FOLDER, 'cache', p.header_hash.encode("hex"))):
-                    self.get_image(node_to_ask, p.header_hash)
+                self.images.fetch(node_to_ask, p.avatar_hash)
+                self.images.fetch(node_to_ask, p.header_hash)
                 self.cache(result[1][0], node_to_ask.id.encode("hex") + ".profile")
                 return p
             except Exception:
@@ -218,12 +285,10 @@ class Server(object):
 
         def get_result(result):
             try:
-                verify_key = nacl.signing.VerifyKey(node_to_ask.pubkey)
-                verify_key.verify(result[1][0], result[1][1])
+                verify_signature(node_to_ask.pubkey, result[1][0], result[1][1])
                 m = objects.Metadata()
                 m.ParseFromString(result[1][0])
-                if not os.path.isfile(os.path.join(DATA_FOLDER, 'cache', m.avatar_hash.encode("hex"))):
-                    self.get_image(node_to_ask, m.avatar_hash)
+                self.images.fetch(node_to_ask, m.avatar_hash)
                 return m
             except Exception:
                 return None
@@ -243,8 +308,7 @@ class Server(object):
 
         def get_result(result):
             try:
-                verify_key = nacl.signing.VerifyKey(node_to_ask.pubkey)
-                verify_key.verify(result[1][0], result[1][1])
+                verify_signature(node_to_ask.pubkey, result[1][0], result[1][1])
                 l = objects.Listings()
                 l.ParseFromString(result[1][0])
                 return l
@@ -266,13 +330,10 @@ class Server(object):
 
         def get_result(result):
             try:
-                verify_key = nacl.signing.VerifyKey(node_to_ask.pubkey)
-                verify_key.verify(result[1][0], result[1][1])
+                verify_signature(node_to_ask.pubkey, result[1][0], result[1][1])
                 l = objects.Listings().ListingMetadata()
                 l.ParseFromString(result[1][0])
-                if l.thumbnail_hash != "":
-                    if not os.path.isfile(os.path.join(DATA_FOLDER, 'cache', l.thumbnail_hash.encode("hex"))):
-                        self.get_image(node_to_ask, l.thumbnail_hash)
+                self.images.fetch(node_to_ask, l.thumbnail_hash)
                 return l
             except Exception:
                 return None
@@ -295,7 +356,7 @@ class Server(object):
         u.bitcoin_key.MergeFrom(k)
         u.moderator = True
         Profile(self.db).update(u)
-        proto = self.kserver.node.getProto().SerializeToString()
+        proto = self.kserver.node.getSerializedProto()
         self.kserver.set(digest("moderators"), digest(proto), proto)
         self.log.info("setting self as moderator on the network")
 
@@ -304,7 +365,7 @@ class Server(object):
         Deletes our moderator entry from the network.
         """
 
-        key = digest(self.kserver.node.getProto().SerializeToString())
+        key = digest(self.kserver.node.getSerializedProto())
         signature = self.signing_key.sign(key)[:64]
         self.kserver.delete("moderators", key, signature)
         Profile(self.db).remove_field("moderator")
@@ -386,8 +447,7 @@ class Server(object):
             # Verify the signature on the response
             f = objects.Followers()
             try:
-                verify_key = nacl.signing.VerifyKey(node_to_ask.pubkey)
-                verify_key.verify(response[1][0], response[1][1])
+                verify_signature(node_to_ask.pubkey, response[1][0], response[1][1])
                 f.ParseFromString(response[1][0])
             except Exception:
                 return (None, None)
@@ -397,13 +457,10 @@ class Server(object):
                 count = response[1][2]
             for follower in f.followers:
                 try:
-                    v_key = nacl.signing.VerifyKey(follower.pubkey)
                     signature = follower.signature
                     follower.ClearField("signature")
-                    v_key.verify(follower.SerializeToString(), signature)
-                    h = nacl.hash.sha512(follower.pubkey)
-                    pow_hash = h[40:]
-                    if int(pow_hash[:6], 16) >= 50 or follower.guid.encode("hex") != h[:40]:
+                    verify_signature(follower.pubkey, follower.SerializeToString(), signature)
+                    if not valid_guid(follower.pubkey, follower.guid.encode("hex")):
                         raise Exception('Invalid GUID')
                     if follower.following != node_to_ask.id:
                         raise Exception('Invalid follower')
@@ -433,19 +490,14 @@ class Server(object):
             # Verify the signature on the response
             f = objects.Following()
             try:
-                verify_key = nacl.signing.VerifyKey(node_to_ask.pubkey)
-                verify_key.verify(response[1][0], response[1][1])
+                verify_signature(node_to_ask.pubkey, response[1][0], response[1][1])
                 f.ParseFromString(response[1][0])
             except Exception:
                 return None
             for user in f.users:
                 try:
-                    v_key = nacl.signing.VerifyKey(user.pubkey)
-                    signature = user.signature
-                    v_key.verify(user.metadata.SerializeToString(), signature)
-                    h = nacl.hash.sha512(user.pubkey)
-                    pow_hash = h[40:]
-                    if int(pow_hash[:6], 16) >= 50 or user.guid.encode("hex") != h[:40]:
+                    verify_signature(user.pubkey, user.metadata.SerializeToString(), user.signature)
+                    if not valid_guid(user.pubkey, user.guid.encode("hex")):
                         raise Exception('Invalid GUID')
                 except Exception:
                     f.users.remove(user)
@@ -457,35 +509,30 @@ class Server(object):
 
     def broadcast(self, message):
         """
-        Sends a broadcast message to all online followers. It will resolve
-        each guid before sending the broadcast. Messages must be less than
-        140 characters. Returns the number of followers the broadcast reached.
+        Sends a broadcast message to all online followers. Each follower is
+        resolved and sent the broadcast in turn with `BROADCAST_CONCURRENCY`
+        followers in flight at once. Messages must be less than 140
+        characters.
+
+        Returns:
+            A `Deferred` firing with the `FanOut.get_progress` dict which
+            includes the number of followers reached.
         """
 
         if len(message) > 140:
-            return defer.succeed(0)
-
-        def send(nodes):
-            def how_many_reached(responses):
-                count = 0
-                for resp in responses:
-                    if resp[1][0] and resp[1][1][0] == "True":
-                        count += 1
-                return count
-
-            ds = []
-            signature = self.signing_key.sign(str(message))[:64]
-            for n in nodes:
-                if n[1] is not None:
-                    ds.append(self.protocol.callBroadcast(n[1], message, signature))
-            return defer.DeferredList(ds).addCallback(how_many_reached)
-        dl = []
-        f = objects.Followers()
-        f.ParseFromString(self.db.follow.get_followers())
-        for follower in f.followers:
-            dl.append(self.kserver.resolve(follower.guid))
+            return FanOut(None, None).run([])
+
+        signature = self.signing_key.sign(str(message))[:64]
+
+        def send(node):
+            def reached(response):
+                return response[0] and response[1][0] == "True"
+            return self.protocol.callBroadcast(node, message, signature).addCallback(reached)
+
+        connected = [c.handler.node.id for c in self.protocol.multiplexer.values() if c.handler.node is not None]
+        self.last_broadcast = FanOut(self.kserver.resolve, send, BROADCAST_CONCURRENCY)
         self.log.info("broadcasting %s to followers" % message)
-        return defer.DeferredList(dl).addCallback(send)
+        return self.last_broadcast.run(self.db.follow.get_follower_guids(), connected)
 
     def send_message(self, receiving_node, public_key, message_type, message, subject=None, store_only=False):
         """
@@ -545,11 +592,8 @@ class Server(object):
                             p.ParseFromString(plaintext)
                             signature = p.signature
                             p.ClearField("signature")
-                            verify_key = nacl.signing.VerifyKey(p.pubkey)
-                            verify_key.verify(p.SerializeToString(), signature)
-                            h = nacl.hash.sha512(p.pubkey)
-                            pow_hash = h[40:]
-                            if int(pow_hash[:6], 16) >= 50 or p.sender_guid.encode("hex") != h[:40]:
+                            verify_signature(p.pubkey, p.SerializeToString(), signature)
+                            if not valid_guid(p.pubkey, p.sender_guid.encode("hex")):
                                 raise Exception('Invalid guid')
                             if p.type == objects.PlaintextMessage.Type.Value("ORDER_CONFIRMATION"):
                                 c = Contract(self.db, hash_value=unhexlify(p.subject),
@@ -633,10 +677,7 @@ class Server(object):
                 if response[0] and response[1][0] == "True":
                     return True
                 elif not response[0]:
-                    contract_dict = json.loads(json.dumps(contract.contract, indent=4),
-                                               object_pairs_hook=OrderedDict)
-                    del contract_dict["vendor_order_confirmation"]
-                    order_id = digest(json.dumps(contract_dict, indent=4)).encode("hex")
+                    order_id = contract.get_digest(exclude=("vendor_order_confirmation",)).encode("hex")
                     self.send_message(Node(unhexlify(guid)),
                                       nacl.signing.VerifyKey(
                                           contract.contract["buyer_order"]["order"]["id"]["pubkeys"]["guid"],
@@ -676,11 +717,8 @@ class Server(object):
                 if response[0] and response[1][0] == "True":
                     return True
                 elif not response[0]:
-                    contract_dict = json.loads(json.dumps(contract.contract, indent=4),
-                                               object_pairs_hook=OrderedDict)
-                    del contract_dict["vendor_order_confirmation"]
-                    del contract_dict["buyer_receipt"]
-                    order_id = digest(json.dumps(contract_dict, indent=4)).encode("hex")
+                    order_id = contract.get_digest(exclude=("vendor_order_confirmation",
+                                                            "buyer_receipt")).encode("hex")
                     self.send_message(Node(unhexlify(guid)),
                                       nacl.signing.VerifyKey(
                                           contract.contract["vendor_offer"]["listing"]["id"]["pubkeys"]["guid"],
@@ -715,29 +753,27 @@ class Server(object):
         to both the moderator and other party to the dispute. If either party isn't online we will stick
         it in the DHT for them.
         """
+        folder = self.db.contracts.get_folder(order_id)
+        contract = self.db.contracts.load(order_id)
         try:
-            file_path = os.path.join(DATA_FOLDER, "purchases", "in progress", order_id + ".json")
-            with open(file_path, 'r') as filename:
-                contract = json.load(filename, object_pairs_hook=OrderedDict)
+            if folder == PURCHASES_IN_PROGRESS:
                 guid = contract["vendor_offer"]["listing"]["id"]["guid"]
                 handle = ""
                 if "blockchain_id" in contract["vendor_offer"]["listing"]["id"]:
                     handle = contract["vendor_offer"]["listing"]["id"]["blockchain_id"]
                 guid_key = contract["vendor_offer"]["listing"]["id"]["pubkeys"]["guid"]
                 proof_sig = self.db.purchases.get_proof_sig(order_id)
-        except Exception:
-            try:
-                file_path = os.path.join(DATA_FOLDER, "store", "contracts", "in progress", order_id + ".json")
-                with open(file_path, 'r') as filename:
-                    contract = json.load(filename, object_pairs_hook=OrderedDict)
-                    guid = contract["buyer_order"]["order"]["id"]["guid"]
-                    handle = ""
-                    if "blockchain_id" in contract["buyer_order"]["order"]["id"]:
-                        handle = contract["buyer_order"]["order"]["id"]["blockchain_id"]
-                    guid_key = contract["buyer_order"]["order"]["id"]["pubkeys"]["guid"]
-                    proof_sig = None
-            except Exception:
+            elif folder == SALES_IN_PROGRESS:
+                guid = contract["buyer_order"]["order"]["id"]["guid"]
+                handle = ""
+                if "blockchain_id" in contract["buyer_order"]["order"]["id"]:
+                    handle = contract["buyer_order"]["order"]["id"]["blockchain_id"]
+                guid_key = contract["buyer_order"]["order"]["id"]["pubkeys"]["guid"]
+                proof_sig = None
+            else:
                 return False
+        except Exception:
+            return False
 
         if "dispute" not in contract:
             keychain = KeyChain(self.db)
@@ -750,8 +786,7 @@ class Server(object):
                 contract["dispute"]["info"]["proof_sig"] = base64.b64encode(proof_sig)
             info = json.dumps(contract["dispute"]["info"], indent=4)
             contract["dispute"]["signature"] = base64.b64encode(keychain.signing_key.sign(info)[:64])
-            with open(file_path, 'wb') as outfile:
-                outfile.write(json.dumps(contract, indent=4))
+            self.db.contracts.save(order_id, contract, folder)
 
             if self.db.purchases.get_purchase(order_id) is not None:
                 self.db.purchases.update_status(order_id, 4)
@@ -804,8 +839,9 @@ class Server(object):
         parties and send it to them in a dispute_close message.
         """
 
-        with open(os.path.join(DATA_FOLDER, "cases", order_id + ".json"), "r") as filename:
-            contract = json.load(filename, object_pairs_hook=OrderedDict)
+        contract = self.db.contracts.load(order_id)
+        if contract is None:
+            raise Exception("Could not find the contract for this case")
 
         if "dispute_resolution" not in contract:
             if float(vendor_percentage) < 0 or float(moderator_percentage) < 0 or float(buyer_percentage) < 0:
@@ -903,8 +939,7 @@ class Server(object):
                             dispute_json["dispute_resolution"]["resolution"], indent=4))[:64])
 
                     contract["dispute_resolution"] = dispute_json["dispute_resolution"]
-                    with open(DATA_FOLDER + "cases/" + order_id + ".json", 'wb') as outfile:
-                        outfile.write(json.dumps(contract, indent=4))
+                    self.db.contracts.save(order_id, contract, CASES)
 
                     send(dispute_json)
 
@@ -958,15 +993,15 @@ class Server(object):
         the moderator has resolved the dispute and provided his signature.
         """
 
-        if os.path.exists(os.path.join(DATA_FOLDER, "purchases", "in progress", order_id + ".json")):
-            file_path = os.path.join(DATA_FOLDER, "purchases", "in progress", order_id + ".json")
+        folder = self.db.contracts.get_folder(order_id)
+        if folder == PURCHASES_IN_PROGRESS:
             outpoints = json.loads(self.db.purchases.get_outpoint(order_id))
-        elif os.path.exists(os.path.join(DATA_FOLDER, "store", "contracts", "in progress", order_id + ".json")):
-            file_path = os.path.join(DATA_FOLDER, "store", "contracts", "in progress", order_id + ".json")
+        elif folder == SALES_IN_PROGRESS:
             outpoints = json.loads(self.db.sales.get_outpoint(order_id))
+        else:
+            raise Exception("Order is not in progress")
 
-        with open(file_path, 'r') as filename:
-            contract = json.load(filename, object_pairs_hook=OrderedDict)
+        contract = self.db.contracts.load(order_id)
 
         outputs = []
 
@@ -1027,48 +1062,29 @@ class Server(object):
         elif self.db.sales.get_sale(order_id) is not None:
             self.db.sales.update_status(order_id, 6)
 
-    def get_ratings(self, node_to_ask, listing_hash=None):
+    def get_ratings(self, node_to_ask, listing_hash=None, on_batch=None):
         """
         Query the given node for a listing of ratings/reviews for the given listing.
+
+        The ratings are verified in batches. If `on_batch` is given it's called with
+        the valid ratings from each batch as soon as that batch has been checked.
+        The returned deferred fires with the full list of valid ratings.
         """
         def get_result(result):
             try:
-                verify_key = nacl.signing.VerifyKey(node_to_ask.pubkey)
-                verify_key.verify(result[1][0], result[1][1])
+                verify_signature(node_to_ask.pubkey, result[1][0], result[1][1])
                 ratings = json.loads(result[1][0].decode("zlib"), object_pairs_hook=OrderedDict)
-                ret = []
-                for rating in ratings:
-                    address = rating["tx_summary"]["address"]
-                    buyer_key = rating["tx_summary"]["buyer_key"]
-                    amount = rating["tx_summary"]["amount"]
-                    listing_hash = rating["tx_summary"]["listing"]
-                    proof_sig = rating["tx_summary"]["proof_of_tx"]
-                    try:
-                        verify_key.verify(str(address) + str(amount) + str(listing_hash) + str(buyer_key),
-                                          base64.b64decode(proof_sig))
-
-                        valid = bitcointools.ecdsa_raw_verify(json.dumps(rating["tx_summary"], indent=4),
-                                                              bitcointools.decode_sig(rating["signature"]),
-                                                              buyer_key)
-                        if not valid:
-                            raise Exception("Bitcoin signature not valid")
-
-                        if "buyer_guid" in rating["tx_summary"] or "buyer_guid_key" in rating["tx_summary"]:
-                            buyer_key_bin = unhexlify(rating["tx_summary"]["buyer_guid_key"])
-                            buyer_key = nacl.signing.VerifyKey(buyer_key_bin)
-                            buyer_key.verify(json.dumps(rating["tx_summary"], indent=4),
-                                             base64.b64decode(rating["guid_signature"]))
-                            h = nacl.hash.sha512(buyer_key_bin)
-                            pow_hash = h[40:]
-                            if int(pow_hash[:6], 16) >= 50 or rating["tx_summary"]["buyer_guid"] != h[:40]:
-                                raise Exception('Invalid GUID')
-
-                        ret.append(rating)
-                    except Exception:
-                        pass
-                return ret
             except Exception:
                 return None
+            if not isinstance(ratings, list):
+                self.log.warning("%s sent ratings which aren't a list" % node_to_ask)
+                return None
+            d = self.verify_ratings(node_to_ask.pubkey, ratings, on_batch)
+            return d.addErrback(verify_failed)
+
+        def verify_failed(failure):
+            self.log.error("failed to verify ratings from %s: %s" % (node_to_ask, failure.getErrorMessage()))
+            return None
 
         if node_to_ask.ip is None:
             return defer.succeed(None)
@@ -1077,19 +1093,69 @@ class Server(object):
         d = self.protocol.callGetRatings(node_to_ask, listing_hash)
         return d.addCallback(get_result)
 
+    def verify_ratings(self, vendor_key, ratings, on_batch=None, batch_size=50):
+        """
+        Check the vendor's proof of transaction, the buyer's guid signature and the
+        buyer's bitcoin signature on each rating. The bitcoin signatures of a batch are
+        checked together on the crypto pool. Ratings that pass are remembered in the
+        database by rating ID so they aren't verified again next time.
+
+        Returns:
+            A deferred firing with the list of valid ratings in their original order.
+        """
+        vendor = vendor_key.encode("hex")
+        ret = []
+
+        def verify_batch(batch):
+            # the rating ID matches the one the vendor stored it under
+            rating_ids = [digest(json.dumps(rating, indent=4)).encode("hex") for rating in batch]
+            valid_ids = self.db.ratings.get_verified(vendor, rating_ids)
+            pending = []
+            for rating, rating_id in zip(batch, rating_ids):
+                if rating_id in valid_ids:
+                    continue
+                try:
+                    tx_summary = rating["tx_summary"]
+                    summary = json.dumps(tx_summary, indent=4)
+                    verify_signature(vendor_key,
+                                     str(tx_summary["address"]) + str(tx_summary["amount"]) +
+                                     str(tx_summary["listing"]) + str(tx_summary["buyer_key"]),
+                                     base64.b64decode(tx_summary["proof_of_tx"]))
+
+                    if "buyer_guid" in tx_summary or "buyer_guid_key" in tx_summary:
+                        buyer_key_bin = unhexlify(tx_summary["buyer_guid_key"])
+                        verify_signature(buyer_key_bin, summary, base64.b64decode(rating["guid_signature"]))
+                        if not valid_guid(buyer_key_bin, tx_summary["buyer_guid"]):
+                            raise Exception('Invalid GUID')
+
+                    pending.append((rating_id, (summary, str(rating["signature"]), tx_summary["buyer_key"])))
+                except Exception:
+                    pass
+
+            def bitcoin_verified(results):
+                verified = [p[0] for p, valid in zip(pending, results) if valid]
+                if verified:
+                    self.db.ratings.add_verified(vendor, verified)
+                valid_ids.update(verified)
+                valid_ratings = [r for r, rating_id in zip(batch, rating_ids) if rating_id in valid_ids]
+                ret.extend(valid_ratings)
+                if on_batch is not None and valid_ratings:
+                    on_batch(valid_ratings)
+            return verify_ecdsa_many([p[1] for p in pending]).addCallback(bitcoin_verified)
+
+        d = defer.succeed(None)
+        for i in range(0, len(ratings), batch_size):
+            d.addCallback(lambda _, batch=ratings[i:i + batch_size]: verify_batch(batch))
+        return d.addCallback(lambda _: ret)
+
     def refund(self, order_id):
         """
         Refund the given order_id. If this is a direct payment he transaction will be
         immediately broadcast to the Bitcoin network otherwise the refund message sent
         to the buyer with contain the signature.
         """
-        file_path = os.path.join(DATA_FOLDER + "store", "contracts", "in progress", order_id + ".json")
-        if not os.path.exists(file_path):
-            file_path = os.path.join(DATA_FOLDER, "store", "contracts", "trade receipts", order_id + ".json")
         outpoints = json.loads(self.db.sales.get_outpoint(order_id))
-
-        with open(file_path, 'r') as filename:
-            contract = json.load(filename, object_pairs_hook=OrderedDict)
+        contract = self.db.contracts.load(order_id)
 
         buyer_guid = contract["buyer_order"]["order"]["id"]["guid"]
         buyer_enc_key = nacl.signing.VerifyKey(
@@ -1128,12 +1194,7 @@ class Server(object):
 
             contract["refund"] = refund_json["refund"]
             self.db.sales.update_status(order_id, 7)
-            file_path = os.path.join(DATA_FOLDER, "store", "contracts", "trade receipts", order_id + ".json")
-            with open(file_path, 'w') as outfile:
-                outfile.write(json.dumps(contract, indent=4))
-            file_path = os.path.join(DATA_FOLDER, "store", "contracts", "in progress", order_id + ".json")
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            self.db.contracts.save(order_id, contract, SALES_TRADE_RECEIPTS)
 
         def get_node(node_to_ask):
             def parse_response(response):
@@ -1168,34 +1229,29 @@ class Server(object):
         try:
             if self.protocol.multiplexer is None:
                 return reactor.callLater(1, self.update_listings)
+            # superseded by the published table
             fname = os.path.join(DATA_FOLDER, "store", "listings.pickle")
             if os.path.exists(fname):
-                with open(fname, 'r') as f:
-                    data = pickle.load(f)
-            else:
-                data = {}
+                os.remove(fname)
 
-            l = objects.Listings()
-            l.ParseFromString(self.db.listings.get_proto())
-            for listing in l.listing:
-                contract_hash = listing.contract_hash
-                c = Contract(self.db, hash_value=contract_hash, testnet=self.protocol.multiplexer.testnet)
-                if contract_hash not in data or time.time() - data[contract_hash] > 500000:
+            proto = self.kserver.node.getSerializedProto()
+            entries = {}
+            serialized_listings = self.db.listings.get_proto()
+            if serialized_listings is not None:
+                l = objects.Listings()
+                l.ParseFromString(serialized_listings)
+                for listing in l.listing:
+                    c = Contract(self.db, hash_value=listing.contract_hash,
+                                 testnet=self.protocol.multiplexer.testnet)
+                    if c.check_expired():
+                        c.delete(True)
+                        continue
+                    contract_id = unhexlify(c.get_contract_id())
                     for keyword in c.contract["vendor_offer"]["listing"]["item"]["keywords"]:
-                        self.kserver.set(digest(keyword.lower()), unhexlify(c.get_contract_id()),
-                                         self.kserver.node.getProto().SerializeToString())
-                    data[contract_hash] = time.time()
-                if c.check_expired():
-                    c.delete(True)
-                    if contract_hash in data:
-                        del data[contract_hash]
-            guid = KeyChain(self.db).guid
-            moderator = Profile(self.db).get().moderator
-            if (guid not in data or time.time() - data[guid] > 500000) and moderator:
-                self.make_moderator()
-                data[guid] = time.time()
-            with open(fname, 'w') as f:
-                pickle.dump(data, f)
+                        entries.setdefault(keyword.lower(), {})[contract_id] = proto
+            if Profile(self.db).get().moderator:
+                entries["moderators"] = {digest(proto): proto}
+            self.republisher.update(entries)
         except Exception:
             pass
 
@@ -1204,8 +1260,10 @@ class Server(object):
             l = objects.Listings()
             l.ParseFromString(self.db.listings.get_proto())
         except Exception:
-            return
+            return defer.succeed(None)
         keychain = KeyChain(self.db)
+        bitcoin_key = bitcointools.bip32_extract_key(keychain.bitcoin_master_privkey)
+        contracts = []
         for listing in l.listing:
             try:
                 contract_hash = listing.contract_hash
@@ -1249,14 +1307,23 @@ class Server(object):
                 c.contract["vendor_offer"]["signatures"] = {}
                 c.contract["vendor_offer"]["signatures"]["guid"] = \
                     base64.b64encode(keychain.signing_key.sign(listing)[:64])
-                c.contract["vendor_offer"]["signatures"]["bitcoin"] = \
-                    bitcointools.encode_sig(*bitcointools.ecdsa_raw_sign(
-                        listing, bitcointools.bip32_extract_key(keychain.bitcoin_master_privkey)))
-                c.previous_title = None
-                c.save()
+                contracts.append((c, listing))
             except Exception:
                 pass
 
+        def signed(signatures):
+            for (c, listing), signature in zip(contracts, signatures):
+                if signature is None:
+                    continue
+                c.contract["vendor_offer"]["signatures"]["bitcoin"] = signature
+                c.previous_title = None
+                c.save()
+
+        # sign every listing as one batch on the crypto pool rather than one at a time on the reactor
+        d = sign_ecdsa_many([(listing, bitcoin_key) for c, listing in contracts]).addCallback(signed)
+        return d.addErrback(lambda failure: self.log.error("failed to re-sign listings: %s" %
+                                                           failure.getErrorMessage()))
+
     @staticmethod
     def cache(file_to_save, filename):
         """
@@ -1276,3 +1343,269 @@ class Server(object):
         with open(filepath, "r") as filename:
             f = filename.read()
         return f
+
+
+class ImageFetcher(object):
+    """
+    Schedules image downloads so the same image is never requested more than
+    once at a time and no single peer, or the network as a whole, is flooded
+    with image requests. Images the UI is currently displaying jump ahead of
+    the ones we're only prefetching.
+    """
+
+    def __init__(self, get_image, max_concurrent=8, max_per_peer=2):
+        self.get_image = get_image
+        self.max_concurrent = max_concurrent
+        self.max_per_peer = max_per_peer
+        self.queue = []
+        self.pending = {}
+        self.active = {}
+        self.active_per_peer = Counter()
+        self.available = set()
+        self.count = 0
+        self.requested = 0
+        self.issued = 0
+        self.coalesced = 0
+        self.already_cached = 0
+        self.failed = 0
+
+    def fetch(self, node_to_ask, image_hash, visible=False):
+        """
+        Make sure an image is in the cache folder, downloading it from the
+        given node if needed.
+
+        Returns:
+            A `Deferred` firing with True once the image is cached or False
+            if it couldn't be downloaded.
+        """
+        if node_to_ask.ip is None or len(image_hash) != 20:
+            return defer.succeed(False)
+        self.requested += 1
+        if image_hash in self.available or \
+                os.path.isfile(os.path.join(DATA_FOLDER, 'cache', image_hash.encode("hex"))):
+            self.available.add(image_hash)
+            self.already_cached += 1
+            return defer.succeed(True)
+
+        d = defer.Deferred()
+        priority = 0 if visible else 1
+        if image_hash in self.active:
+            self.coalesced += 1
+            self.active[image_hash].append(d)
+        elif image_hash in self.pending:
+            self.coalesced += 1
+            waiting = self.pending[image_hash]
+            waiting[2].append(d)
+            if priority < waiting[1]:
+                waiting[1] = priority
+                self._enqueue(priority, image_hash)
+        else:
+            self.pending[image_hash] = [node_to_ask, priority, [d]]
+            self._enqueue(priority, image_hash)
+        self._pump()
+        return d
+
+    def _enqueue(self, priority, image_hash):
+        self.count += 1
+        heapq.heappush(self.queue, (priority, self.count, image_hash))
+
+    def _pump(self):
+        deferred = []
+        while self.queue and len(self.active) < self.max_concurrent:
+            entry = heapq.heappop(self.queue)
+            image_hash = entry[2]
+            if image_hash not in self.pending or self.pending[image_hash][1] != entry[0]:
+                continue
+            node = self.pending[image_hash][0]
+            if self.active_per_peer[node.id] >= self.max_per_peer:
+                deferred.append(entry)
+                continue
+            waiting = self.pending.pop(image_hash)[2]
+            self.active[image_hash] = waiting
+            self.active_per_peer[node.id] += 1
+            self.issued += 1
+            self.get_image(node, image_hash).addBoth(self._finished, node, image_hash)
+        for entry in deferred:
+            heapq.heappush(self.queue, entry)
+
+    def _finished(self, result, node, image_hash):
+        self.active_per_peer[node.id] -= 1
+        if self.active_per_peer[node.id] <= 0:
+            del self.active_per_peer[node.id]
+        success = result is not None and not isinstance(result, Failure)
+        if success:
+            self.available.add(image_hash)
+        else:
+            self.failed += 1
+        for d in self.active.pop(image_hash):
+            d.callback(success)
+        self._pump()
+
+    def get_stats(self):
+        return {
+            "requested": self.requested,
+            "issued": self.issued,
+            "coalesced": self.coalesced,
+            "already_cached": self.already_cached,
+            "failed": self.failed,
+            "queued": len(self.pending),
+            "active": len(self.active)
+        }
+
+
+class Republisher(object):
+    """
+    Keeps our listings, and our moderator entry, stored in the DHT. All the
+    entries under a keyword are stored together after a single node lookup
+    and only keywords with an entry that is new or close to expiring are
+    republished. The work is spread out over the update interval, no faster
+    than one keyword every `min_delay` seconds, and when each entry was
+    published is saved in the database so a restart doesn't start over.
+    """
+
+    def __init__(self, kserver, db, interval=3600, max_age=500000, min_delay=1, clock=reactor):
+        self.kserver = kserver
+        self.db = db
+        self.interval = interval
+        self.max_age = max_age
+        self.min_delay = min_delay
+        self.clock = clock
+        self.entries = {}
+        self.queue = []
+        self.delay = min_delay
+        self.call = None
+        self.publishing = None
+        self.published = 0
+        self.failed = 0
+
+    def update(self, entries):
+        """
+        Replace the entries we should have in the DHT and schedule the
+        keywords that need publishing.
+
+        Args:
+            entries: a dict mapping each keyword to a dict of the key/value
+                pairs to store under it.
+        """
+        timestamps = self.db.published.get_all()
+        self.db.published.delete([(keyword, entry_id) for keyword, entry_id in timestamps
+                                  if unhexlify(entry_id) not in entries.get(keyword, {})])
+        now = time.time()
+        self.entries = entries
+        self.queue = [keyword for keyword in sorted(entries) if keyword != self.publishing and
+                      any(now - timestamps.get((keyword, key.encode("hex")), 0) > self.max_age
+                          for key in entries[keyword])]
+        if self.queue:
+            self.delay = max(self.min_delay, float(self.interval) / len(self.queue))
+            if self.call is None and self.publishing is None:
+                self._next()
+
+    def _next(self):
+        self.call = None
+        if not self.queue:
+            return
+        keyword = self.queue.pop(0)
+        values = self.entries[keyword].items()
+        started = self.clock.seconds()
+        self.publishing = keyword
+
+        def published(success):
+            if success is True:
+                self.published += 1
+                self.db.published.update(keyword, [key.encode("hex") for key, _ in values], int(time.time()))
+            else:
+                self.failed += 1
+            self.publishing = None
+            self.call = self.clock.callLater(max(0, started + self.delay - self.clock.seconds()), self._next)
+        self.kserver.setMany(digest(keyword), values).addBoth(published)
+
+    def stop(self):
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
+        self.queue = []
+
+    def get_stats(self):
+        return {
+            "keywords": len(self.entries),
+            "queued": len(self.queue),
+            "published": self.published,
+            "failed": self.failed
+        }
+
+
+class FanOut(object):
+    """
+    Resolves a list of guids and passes each node to `send` as soon as it's
+    found, with at most `concurrency` guids being resolved or sent to at a
+    time so messaging thousands of followers doesn't start thousands of
+    crawls at once. Guids we already have a connection to go first as they
+    don't need a crawl.
+    """
+
+    def __init__(self, resolve, send, concurrency=20, clock=reactor):
+        self.resolve = resolve
+        self.send = send
+        self.concurrency = concurrency
+        self.clock = clock
+        self.queue = deque()
+        self.pumping = False
+        self.deferred = None
+        self.started = None
+        self.finished = None
+        self.total = 0
+        self.active = 0
+        self.done = 0
+        self.resolved = 0
+        self.reached = 0
+
+    def run(self, guids, connected=()):
+        """
+        Returns:
+            A `Deferred` firing with `get_progress` once every guid is done.
+        """
+        connected = set(connected)
+        self.queue = deque([guid for guid in guids if guid in connected] +
+                           [guid for guid in guids if guid not in connected])
+        self.total = len(self.queue)
+        self.started = self.clock.seconds()
+        self.deferred = defer.Deferred()
+        self._pump()
+        return self.deferred
+
+    def _pump(self):
+        # resolve and send can fire synchronously, loop instead of recursing
+        if self.pumping:
+            return
+        self.pumping = True
+        while self.queue and self.active < self.concurrency:
+            self.active += 1
+            self.resolve(self.queue.popleft()).addCallback(self._resolved).addBoth(self._finished)
+        self.pumping = False
+        if self.active == 0 and not self.queue and self.finished is None:
+            self.finished = self.clock.seconds()
+            self.deferred.callback(self.get_progress())
+
+    def _resolved(self, node):
+        if node is None:
+            return False
+        self.resolved += 1
+        return self.send(node)
+
+    def _finished(self, result):
+        self.active -= 1
+        self.done += 1
+        if result is True:
+            self.reached += 1
+        self._pump()
+
+    def get_progress(self):
+        elapsed = (self.finished if self.finished is not None else self.clock.seconds()) - self.started
+        return {
+            "followers": self.total,
+            "done": self.done,
+            "resolved": self.resolved,
+            "reached": self.reached,
+            "seconds": round(elapsed, 2),
+            "per_second": round(self.done / elapsed, 2) if elapsed > 0 else 0.0
+        }
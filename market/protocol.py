@@ -4,15 +4,16 @@ import json
 import nacl.signing
 import nacl.utils
 import nacl.encoding
-import nacl.hash
 from binascii import unhexlify
 from collections import OrderedDict
 from interfaces import MessageProcessor, BroadcastListener, MessageListener, NotificationListener
 from keys.bip32utils import derive_childkey
+from keys.verification import verify_signature, valid_guid
 from log import Logger
 from market.audit import Audit
 from market.contracts import Contract
 from market.moderation import process_dispute, close_dispute
+from market import transfer
 from market.profile import Profile
 from market.smtpnotification import SMTPNotification
 from nacl.public import PublicKey, Box
@@ -21,6 +22,7 @@ from protos.message import GET_CONTRACT, GET_IMAGE, GET_PROFILE, GET_LISTINGS, G
     GET_CONTRACT_METADATA, FOLLOW, UNFOLLOW, GET_FOLLOWERS, GET_FOLLOWING, BROADCAST, MESSAGE, ORDER, \
     ORDER_CONFIRMATION, COMPLETE_ORDER, DISPUTE_OPEN, DISPUTE_CLOSE, GET_RATINGS, REFUND
 from protos.objects import Metadata, Listings, Followers, PlaintextMessage
+from twisted.internet import defer
 from zope.interface import implements
 from zope.interface.exceptions import DoesNotImplement
 from zope.interface.verify import verifyObject
@@ -39,6 +41,8 @@ class MarketProtocol(RPCProtocol):
         self.db = database
         self.signing_key = signing_key
         self.listeners = []
+        self.signed_responses = {}
+        self.signed_responses_version = None
         self.handled_commands = [GET_CONTRACT, GET_IMAGE, GET_PROFILE, GET_LISTINGS, GET_USER_METADATA,
                                  GET_CONTRACT_METADATA, FOLLOW, UNFOLLOW, GET_FOLLOWERS, GET_FOLLOWING,
                                  BROADCAST, MESSAGE, ORDER, ORDER_CONFIRMATION, COMPLETE_ORDER, DISPUTE_OPEN,
@@ -50,39 +54,87 @@ class MarketProtocol(RPCProtocol):
     def add_listener(self, listener):
         self.listeners.append(listener)
 
-    def rpc_get_contract(self, sender, contract_hash):
+    def rpc_get_contract(self, sender, contract_hash, chunk=None):
         self.log.info("serving contract %s to %s" % (contract_hash.encode('hex'), sender))
-        self.audit.record(sender.id.encode("hex"), "GET_CONTRACT", contract_hash.encode('hex'))
         self.router.addContact(sender)
-        try:
-            with open(self.db.filemap.get_file(contract_hash.encode("hex")), "r") as filename:
-                contract = filename.read()
-            return [contract]
-        except Exception:
+
+        def not_found(failure):
             self.log.warning("could not find contract %s" % contract_hash.encode('hex'))
             return None
 
-    def rpc_get_image(self, sender, image_hash):
+        if chunk is None or chunk == "0":
+            self.audit.record(sender.id.encode("hex"), "GET_CONTRACT", contract_hash.encode('hex'))
+        if chunk is not None:
+            return self._read_chunk(contract_hash.encode("hex"), int(chunk)).addErrback(not_found)
+        d = self._read_file(contract_hash.encode("hex"), "r")
+        return d.addCallbacks(lambda contract: [contract], not_found)
+
+    def rpc_get_image(self, sender, image_hash, chunk=None):
         self.router.addContact(sender)
-        try:
-            if len(image_hash) != 20:
-                self.log.warning("Image hash is not 20 characters %s" % image_hash)
-                raise Exception("Invalid image hash")
-            self.log.info("serving image %s to %s" % (image_hash.encode('hex'), sender))
-            with open(self.db.filemap.get_file(image_hash.encode("hex")), "rb") as filename:
-                image = filename.read()
-            return [image]
-        except Exception:
+        if len(image_hash) != 20:
+            self.log.warning("Image hash is not 20 characters %s" % image_hash)
             self.log.warning("could not find image %s" % image_hash[:20].encode('hex'))
             return None
 
+        def not_found(failure):
+            self.log.warning("could not find image %s" % image_hash.encode('hex'))
+            return None
+
+        if chunk is not None:
+            return self._read_chunk(image_hash.encode("hex"), int(chunk)).addErrback(not_found)
+        self.log.info("serving image %s to %s" % (image_hash.encode('hex'), sender))
+        d = self._read_file(image_hash.encode("hex"), "rb")
+        return d.addCallbacks(lambda image: [image], not_found)
+
+    def _read_file(self, hash_value, mode):
+        """
+        Return a `Deferred` for the contents of a file in the filemap, served
+        from the file cache when possible.
+        """
+        data = self.db.filecache.get(hash_value)
+        if data is not None:
+            return defer.succeed(data)
+
+        def cache(data):
+            self.db.filecache.put(hash_value, data)
+            return data
+        return self.db.deferred.filemap.read_file(hash_value, mode).addCallback(cache)
+
+    def _read_chunk(self, hash_value, index):
+        """
+        Return a `Deferred` for the response to a chunked transfer request.
+        Only the requested chunk is read from disk unless the whole file is
+        already in the file cache.
+        """
+        data = self.db.filecache.get(hash_value)
+        if data is not None:
+            return defer.maybeDeferred(transfer.chunk_response, data, index)
+
+        def read():
+            return transfer.read_chunk(self.db.filemap.get_file(hash_value), index)
+        return self.db.deferred.run(read)
+
+    def _signed_response(self, key, serialize):
+        """
+        Return `[payload, signature]` for a response built from our profile
+        and listings. Responses are signed once and reused until either the
+        profile or the listings change in the database.
+        """
+        version = (self.db.profile.version, self.db.listings.version)
+        if version != self.signed_responses_version:
+            self.signed_responses = {}
+            self.signed_responses_version = version
+        if key not in self.signed_responses:
+            ser = serialize()
+            self.signed_responses[key] = [ser, self.signing_key.sign(ser)[:64]]
+        return self.signed_responses[key]
+
     def rpc_get_profile(self, sender):
         self.log.info("serving profile to %s" % sender)
         self.audit.record(sender.id.encode("hex"), "GET_PROFILE")
         self.router.addContact(sender)
         try:
-            proto = Profile(self.db).get(True)
-            return [proto, self.signing_key.sign(proto)[:64]]
+            return self._signed_response(GET_PROFILE, lambda: Profile(self.db).get(True))
         except Exception:
             self.log.error("unable to load the profile")
             return None
@@ -90,7 +142,8 @@ class MarketProtocol(RPCProtocol):
     def rpc_get_user_metadata(self, sender):
         self.log.info("serving user metadata to %s" % sender)
         self.router.addContact(sender)
-        try:
+
+        def serialize():
             proto = Profile(self.db).get(False)
             m = Metadata()
             m.name = proto.name
@@ -98,7 +151,9 @@ class MarketProtocol(RPCProtocol):
             m.short_description = proto.short_description
             m.avatar_hash = proto.avatar_hash
             m.nsfw = proto.nsfw
-            return [m.SerializeToString(), self.signing_key.sign(m.SerializeToString())[:64]]
+            return m.SerializeToString()
+        try:
+            return self._signed_response(GET_USER_METADATA, serialize)
         except Exception:
             self.log.error("unable to load profile metadata")
             return None
@@ -107,7 +162,8 @@ class MarketProtocol(RPCProtocol):
         self.log.info("serving store listings to %s" % sender)
         self.audit.record(sender.id.encode("hex"), "GET_LISTINGS")
         self.router.addContact(sender)
-        try:
+
+        def serialize():
             p = Profile(self.db).get()
             l = Listings()
             l.ParseFromString(self.db.listings.get_proto())
@@ -116,7 +172,9 @@ class MarketProtocol(RPCProtocol):
             for listing in l.listing:
                 if listing.hidden:
                     l.listing.remove(listing)
-            return [l.SerializeToString(), self.signing_key.sign(l.SerializeToString())[:64]]
+            return l.SerializeToString()
+        try:
+            return self._signed_response(GET_LISTINGS, serialize)
         except Exception:
             self.log.warning("could not find any listings in the database")
             return None
@@ -124,17 +182,15 @@ class MarketProtocol(RPCProtocol):
     def rpc_get_contract_metadata(self, sender, contract_hash):
         self.log.info("serving metadata for contract %s to %s" % (contract_hash.encode("hex"), sender))
         self.router.addContact(sender)
-        try:
-            proto = self.db.listings.get_proto()
+
+        def serialize():
+            listing = self.db.listings.get_listing(contract_hash)
             p = Profile(self.db).get()
-            l = Listings()
-            l.ParseFromString(proto)
-            for listing in l.listing:
-                if listing.contract_hash == contract_hash:
-                    listing.avatar_hash = p.avatar_hash
-                    listing.handle = p.handle
-                    ser = listing.SerializeToString()
-            return [ser, self.signing_key.sign(ser)[:64]]
+            listing.avatar_hash = p.avatar_hash
+            listing.handle = p.handle
+            return listing.SerializeToString()
+        try:
+            return self._signed_response((GET_CONTRACT_METADATA, contract_hash), serialize)
         except Exception:
             self.log.warning("could not find metadata for contract %s" % contract_hash.encode("hex"))
             return None
@@ -240,11 +296,8 @@ class MarketProtocol(RPCProtocol):
             p.ParseFromString(plaintext)
             signature = p.signature
             p.ClearField("signature")
-            verify_key = nacl.signing.VerifyKey(p.pubkey)
-            verify_key.verify(p.SerializeToString(), signature)
-            h = nacl.hash.sha512(p.pubkey)
-            pow_hash = h[40:]
-            if int(pow_hash[:6], 16) >= 50 or p.sender_guid.encode("hex") != h[:40] or p.sender_guid != sender.id:
+            verify_signature(p.pubkey, p.SerializeToString(), signature)
+            if not valid_guid(p.pubkey, p.sender_guid.encode("hex")) or p.sender_guid != sender.id:
                 raise Exception('Invalid guid')
             self.log.info("received a message from %s" % sender)
             self.router.addContact(sender)
@@ -265,7 +318,15 @@ class MarketProtocol(RPCProtocol):
             order = box.decrypt(encrypted)
             c = Contract(self.db, contract=json.loads(order, object_pairs_hook=OrderedDict),
                          testnet=self.multiplexer.testnet)
-            v = c.verify(sender.pubkey)
+            d = c.verify(sender.pubkey)
+            d.addErrback(lambda failure: "verification failed: %s" % failure.getErrorMessage())
+            return d.addCallback(self._order_verified, sender, c)
+        except Exception, e:
+            self.log.error("Exception (%s) occurred processing order from %s" % (e.message, sender))
+            return ["False"]
+
+    def _order_verified(self, v, sender, c):
+        try:
             if v is True:
                 self.router.addContact(sender)
                 self.log.info("received an order from %s, waiting for payment..." % sender)
@@ -387,12 +448,18 @@ class MarketProtocol(RPCProtocol):
             self.log.error("unable to parse refund message from %s" % sender)
             return [e.message]
 
-    def callGetContract(self, nodeToAsk, contract_hash):
-        d = self.get_contract(nodeToAsk, contract_hash)
+    def callGetContract(self, nodeToAsk, contract_hash, chunk=None):
+        if chunk is None:
+            d = self.get_contract(nodeToAsk, contract_hash)
+        else:
+            d = self.get_contract(nodeToAsk, contract_hash, chunk)
         return d.addCallback(self.handleCallResponse, nodeToAsk)
 
-    def callGetImage(self, nodeToAsk, image_hash):
-        d = self.get_image(nodeToAsk, image_hash)
+    def callGetImage(self, nodeToAsk, image_hash, chunk=None):
+        if chunk is None:
+            d = self.get_image(nodeToAsk, image_hash)
+        else:
+            d = self.get_image(nodeToAsk, image_hash, chunk)
         return d.addCallback(self.handleCallResponse, nodeToAsk)
 
     def callGetProfile(self, nodeToAsk):
@@ -0,0 +1,56 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+from db.datastore import Database
+from dht.utils import digest
+from market.contracts import Contract
+
+
+class ContractSerializationTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = Database(filepath=os.path.join(self.folder, "test.db"))
+        self.db.keys.set_key("guid", "b54a4f932c620937c05ab0d4bd2b98e434c4946c7d4b23737c139fbdea116255", "")
+        self.db.keys.set_key("bitcoin", "xprv", "xpub")
+        contract = OrderedDict()
+        contract["vendor_offer"] = OrderedDict([("listing", OrderedDict([("contract_id", "abc")]))])
+        contract["buyer_order"] = OrderedDict([("order", OrderedDict([("quantity", 1)]))])
+        self.contract = Contract(self.db, contract=contract)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.folder)
+
+    def test_serialize_matches_json_dumps(self):
+        self.assertEqual(self.contract.serialize(), json.dumps(self.contract.contract, indent=4))
+        self.assertEqual(self.contract.serialize("buyer_order", "order"),
+                         json.dumps(self.contract.contract["buyer_order"]["order"], indent=4))
+        self.assertEqual(self.contract.get_digest(exclude=("buyer_order",)),
+                         digest(json.dumps(OrderedDict([("vendor_offer", self.contract.contract["vendor_offer"])]),
+                                           indent=4)))
+
+    def test_order_id_ignores_later_sections(self):
+        order_id = self.contract.get_order_id()
+        self.assertEqual(order_id, digest(json.dumps(self.contract.contract, indent=4)).encode("hex"))
+        self.contract.contract["vendor_order_confirmation"] = {"invoice": {"ref_hash": order_id}}
+        self.contract.contract["buyer_receipt"] = {"receipt": {}}
+        self.assertEqual(self.contract.get_order_id(), order_id)
+        self.assertNotEqual(self.contract.get_digest().encode("hex"), order_id)
+
+    def test_memoized_until_changed(self):
+        order = self.contract.serialize("buyer_order", "order")
+        self.contract.contract["buyer_order"]["order"]["quantity"] = 2
+        self.assertEqual(self.contract.serialize("buyer_order", "order"), order)
+        self.contract.changed()
+        self.assertIn('"quantity": 2', self.contract.serialize("buyer_order", "order"))
+
+        # replacing or removing a top level section is picked up without calling changed()
+        self.contract.contract["buyer_order"] = OrderedDict([("order", OrderedDict([("quantity", 3)]))])
+        self.assertIn('"quantity": 3', self.contract.serialize("buyer_order", "order"))
+        del self.contract.contract["buyer_order"]
+        self.assertEqual(self.contract.get_order_id(),
+                         digest(json.dumps(self.contract.contract, indent=4)).encode("hex"))
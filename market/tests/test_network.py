@@ -0,0 +1,300 @@
+import base64
+import json
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import bitcointools
+import nacl.signing
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from config import DATA_FOLDER
+from db.datastore import Database
+from dht.utils import digest
+from dht.tests.utils import mknode
+from keys import cryptopool, verification
+from keys.cryptopool import CryptoPool
+from keys.guid import GUID
+from keys.verification import VerificationCache
+from log import Logger
+from market import transfer
+from market.network import FanOut, ImageFetcher, Republisher, Server
+from market.transfer import CHUNK_SIZE
+from protos import objects
+
+
+class ImageFetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.requests = []
+        self.fetcher = ImageFetcher(self.get_image, max_concurrent=2, max_per_peer=1)
+
+    def get_image(self, node, image_hash):
+        d = defer.Deferred()
+        self.requests.append((node, image_hash, d))
+        return d
+
+    def test_coalesces_requests_for_the_same_image(self):
+        node = mknode(ip="127.0.0.1", port=18467)
+        results = []
+        self.fetcher.fetch(node, digest("image")).addCallback(results.append)
+        self.fetcher.fetch(mknode(ip="127.0.0.1", port=18467), digest("image")).addCallback(results.append)
+        self.assertEqual(len(self.requests), 1)
+        self.requests[0][2].callback("image")
+        self.assertEqual(results, [True, True])
+        self.fetcher.fetch(node, digest("image")).addCallback(results.append)
+        self.assertEqual(len(self.requests), 1)
+        stats = self.fetcher.get_stats()
+        self.assertEqual(stats["issued"], 1)
+        self.assertEqual(stats["coalesced"], 1)
+        self.assertEqual(stats["already_cached"], 1)
+
+    def test_limits_concurrency_per_peer_and_prioritizes_visible_images(self):
+        node = mknode(ip="127.0.0.1", port=18467)
+        other = mknode(ip="127.0.0.1", port=18467)
+        self.fetcher.fetch(node, digest("first"))
+        self.fetcher.fetch(node, digest("prefetch"))
+        self.fetcher.fetch(node, digest("visible"), visible=True)
+        self.fetcher.fetch(other, digest("other"))
+        self.fetcher.fetch(other, digest("queued"))
+        self.assertEqual([r[1] for r in self.requests], [digest("first"), digest("other")])
+
+        self.requests[0][2].callback(None)
+        self.assertEqual(self.requests[2][1], digest("visible"))
+        self.assertEqual(self.fetcher.get_stats()["failed"], 1)
+        self.assertEqual(self.fetcher.get_stats()["queued"], 2)
+
+
+class RepublisherTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = Database(filepath=os.path.join(self.folder, "test.db"))
+        self.clock = task.Clock()
+        self.stores = []
+        self.republisher = Republisher(self, self.db, interval=100, min_delay=10, clock=self.clock)
+
+    def tearDown(self):
+        self.republisher.stop()
+        self.db.close()
+        shutil.rmtree(self.folder)
+
+    def setMany(self, keyword, values):
+        self.stores.append((keyword, sorted(values)))
+        return defer.succeed(True)
+
+    def test_publishes_each_keyword_once_spread_over_the_interval(self):
+        entries = {"shoes": {"a": "node", "b": "node"}, "boots": {"a": "node"}}
+        self.republisher.update(entries)
+        self.assertEqual(self.stores, [(digest("boots"), [("a", "node")])])
+        self.clock.advance(49)
+        self.assertEqual(len(self.stores), 1)
+        self.clock.advance(1)
+        self.assertEqual(self.stores[1], (digest("shoes"), [("a", "node"), ("b", "node")]))
+
+        # nothing is due until a new entry shows up, even after a restart
+        republisher = Republisher(self, self.db, interval=100, clock=self.clock)
+        republisher.update(entries)
+        self.assertEqual(len(self.stores), 2)
+        entries["boots"]["c"] = "node"
+        republisher.update(entries)
+        self.assertEqual(self.stores[2], (digest("boots"), [("a", "node"), ("c", "node")]))
+
+        # entries no longer wanted are forgotten
+        republisher.update({"shoes": entries["shoes"]})
+        self.assertEqual(set(self.db.published.get_all()),
+                         {("shoes", "a".encode("hex")), ("shoes", "b".encode("hex"))})
+
+
+class FanOutTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.resolves = {}
+        self.sent = []
+
+    def resolve(self, guid):
+        if guid == "connected":
+            return defer.succeed(mknode(ip="127.0.0.1", port=18467))
+        self.resolves[guid] = defer.Deferred()
+        return self.resolves[guid]
+
+    def send(self, node):
+        self.sent.append(node)
+        return defer.succeed(True)
+
+    def test_limits_resolutions_in_flight_and_sends_as_they_resolve(self):
+        fanout = FanOut(self.resolve, self.send, concurrency=2, clock=self.clock)
+        results = []
+        fanout.run(["a", "b", "c", "connected"], connected=["connected"]).addCallback(results.append)
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(sorted(self.resolves), ["a", "b"])
+
+        self.clock.advance(1)
+        self.resolves["a"].callback(mknode(ip="127.0.0.1", port=18467))
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(sorted(self.resolves), ["a", "b", "c"])
+        self.resolves["b"].callback(None)
+        self.resolves["c"].callback(mknode(ip="127.0.0.1", port=18467))
+        self.assertEqual(results, [{"followers": 4, "done": 4, "resolved": 3, "reached": 3,
+                                    "seconds": 1, "per_second": 4.0}])
+
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server.__new__(Server)
+        self.server.log = Logger(system=self.server)
+        self.server.downloads = {}
+        self.server.protocol = self
+        self.data = os.urandom(CHUNK_SIZE + 100)
+        self.image_hash = digest("another image")
+        self.part = os.path.join(DATA_FOLDER, "cache", self.image_hash.encode("hex") + ".part")
+        self.response = None
+        if not os.path.isdir(os.path.dirname(self.part)):
+            os.makedirs(os.path.dirname(self.part))
+
+    def tearDown(self):
+        if os.path.exists(self.part):
+            os.remove(self.part)
+
+    def callGetImage(self, node, image_hash, chunk=None):
+        if self.response is not None:
+            return defer.succeed(self.response)
+        return defer.succeed((True, tuple(transfer.chunk_response(self.data, int(chunk)))))
+
+    def test_image_that_does_not_verify_is_removed(self):
+        d = self.server.get_image(mknode(ip="127.0.0.1", port=18467), self.image_hash)
+        d.addCallback(self.assertIsNone)
+        d.addCallback(lambda _: self.assertFalse(os.path.exists(self.part)))
+        d.addCallback(lambda _: self.assertEqual(self.server.downloads, {}))
+        return d
+
+    def test_failed_download_is_forgotten(self):
+        self.response = (False, None)
+        d = self.server.get_image(mknode(ip="127.0.0.1", port=18467), self.image_hash)
+        d.addCallback(self.assertIsNone)
+        d.addCallback(lambda _: self.assertEqual(self.server.downloads, {}))
+        return d
+
+
+class BroadcastTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.server = Server.__new__(Server)
+        self.server.db = Database(filepath=os.path.join(self.folder, "test.db"))
+        self.server.log = Logger(system=self.server)
+        self.server.signing_key = nacl.signing.SigningKey.generate()
+        self.server.kserver = self
+        self.server.protocol = self
+        self.server.last_broadcast = None
+        self.multiplexer = {}
+        self.broadcasts = []
+        self.guids = [digest(str(i)) for i in range(35)]
+        for guid in self.guids:
+            f = objects.Followers.Follower()
+            f.guid = guid
+            self.server.db.follow.set_follower(f.SerializeToString())
+
+    def tearDown(self):
+        self.server.db.close()
+        shutil.rmtree(self.folder)
+
+    def resolve(self, guid):
+        return defer.succeed(mknode(guid, "127.0.0.1", 18467))
+
+    def callBroadcast(self, node, message, signature):
+        self.broadcasts.append((node.id, message))
+        return defer.succeed((True, ("True",)))
+
+    def test_broadcast_reaches_every_follower(self):
+        d = self.server.broadcast("hello")
+
+        def check(progress):
+            self.assertEqual(progress["followers"], 35)
+            self.assertEqual(progress["reached"], 35)
+            self.assertEqual(sorted(self.broadcasts), sorted((guid, "hello") for guid in self.guids))
+            self.assertIs(self.server.last_broadcast.deferred, d)
+        return d.addCallback(check)
+
+    def test_broadcast_rejects_long_messages(self):
+        d = self.server.broadcast("a" * 141)
+        d.addCallback(lambda progress: self.assertEqual(progress["followers"], 0))
+        d.addCallback(lambda _: self.assertEqual(self.broadcasts, []))
+        return d
+
+
+class VerifyRatingsTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.pool = cryptopool.pool
+        self.cache = verification.cache
+        cryptopool.pool = CryptoPool(processes=0)
+        verification.cache = VerificationCache(size=0)
+        self.server = Server.__new__(Server)
+        self.server.db = Database(filepath=os.path.join(self.folder, "test.db"))
+        self.vendor_key = nacl.signing.SigningKey.generate()
+        self.buyer = GUID.from_privkey("b54a4f932c620937c05ab0d4bd2b98e434c4946c7d4b23737c139fbdea116255")
+        self.bitcoin_privkey = bitcointools.random_key()
+
+    def tearDown(self):
+        self.server.db.close()
+        shutil.rmtree(self.folder)
+        cryptopool.pool = self.pool
+        verification.cache = self.cache
+
+    def make_rating(self, listing, forge=False):
+        buyer_key = bitcointools.privkey_to_pubkey(self.bitcoin_privkey)
+        tx_summary = OrderedDict()
+        tx_summary["listing"] = listing
+        tx_summary["address"] = "1BoatSLRHtKNngkdXEeobR76b53LETtpyT"
+        tx_summary["amount"] = 0.1
+        tx_summary["buyer_key"] = buyer_key
+        tx_summary["proof_of_tx"] = base64.b64encode(self.vendor_key.sign(
+            str(tx_summary["address"]) + str(tx_summary["amount"]) + listing + buyer_key)[:64])
+        tx_summary["buyer_guid"] = self.buyer.guid.encode("hex")
+        tx_summary["buyer_guid_key"] = self.buyer.verify_key.encode().encode("hex")
+        summary = json.dumps(tx_summary, indent=4)
+        rating = OrderedDict()
+        rating["tx_summary"] = tx_summary
+        rating["signature"] = bitcointools.encode_sig(*bitcointools.ecdsa_raw_sign(
+            "forged" if forge else summary, self.bitcoin_privkey))
+        rating["guid_signature"] = base64.b64encode(self.buyer.signing_key.sign(summary)[:64])
+        return json.loads(json.dumps(rating), object_pairs_hook=OrderedDict)
+
+    def test_verify_ratings_in_batches_and_remembers_valid_ones(self):
+        vendor_pubkey = self.vendor_key.verify_key.encode()
+        ratings = [self.make_rating("a"), self.make_rating("b", forge=True), self.make_rating("c")]
+        batches = []
+        d = self.server.verify_ratings(vendor_pubkey, ratings, batches.append, batch_size=2)
+        d.addCallback(self.assertEqual, [ratings[0], ratings[2]])
+        d.addCallback(lambda _: self.assertEqual(batches, [[ratings[0]], [ratings[2]]]))
+        d.addCallback(lambda _: self.assertEqual(cryptopool.pool.get_stats()["tasks"], 3))
+
+        # only the rating that failed gets its bitcoin signature checked again
+        d.addCallback(lambda _: self.server.verify_ratings(vendor_pubkey, ratings))
+        d.addCallback(self.assertEqual, [ratings[0], ratings[2]])
+        d.addCallback(lambda _: self.assertEqual(cryptopool.pool.get_stats()["tasks"], 4))
+
+        # a different vendor can't vouch for the same ratings
+        d.addCallback(lambda _: self.server.verify_ratings(nacl.signing.SigningKey.generate().verify_key.encode(),
+                                                           ratings))
+        d.addCallback(self.assertEqual, [])
+        return d
+
+    def get_ratings(self, ratings):
+        serialized = json.dumps(ratings).encode("zlib")
+        signature = self.vendor_key.sign(serialized)[:64]
+        self.server.log = Logger(system=self.server)
+        self.server.protocol = self
+        self.callGetRatings = lambda node, listing_hash: defer.succeed((True, (serialized, signature)))
+        vendor = mknode(ip="127.0.0.1", port=18467)
+        vendor.pubkey = self.vendor_key.verify_key.encode()
+        return self.server.get_ratings(vendor)
+
+    def test_get_ratings_rejects_ratings_that_are_not_a_list(self):
+        return self.get_ratings({"rating": self.make_rating("a")}).addCallback(self.assertIsNone)
+
+    def test_get_ratings_fires_none_when_verification_fails(self):
+        def fail(vendor_key, ratings, on_batch=None):
+            return defer.fail(ValueError("pool timed out"))
+        self.server.verify_ratings = fail
+        return self.get_ratings([self.make_rating("a")]).addCallback(self.assertIsNone)
@@ -70,6 +70,7 @@ zaX5wLzZGfrFtWetE1kFBbzlmdb8jARlkRB68nvzSH3vCoyLkRXa9/l7FXouIuNG
         self.db.profile.set_temp_handle("test_handle")
 
     def tearDown(self):
+        self.db.close()
         os.remove("test.db")
 
     def test_MarketProfile_get_success(self):
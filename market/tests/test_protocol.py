@@ -1,10 +1,20 @@
+import nacl.signing
+import os
+import shutil
+import tempfile
+
 from twisted.trial import unittest
 from twisted.python import log
 
+from config import DATA_FOLDER
+from db.datastore import Database
+
 from dht.node import Node
 from dht.utils import digest
 from dht.routing import RoutingTable
+from market.profile import Profile
 from market.protocol import MarketProtocol
+from protos import objects
 from dht.tests.utils import mknode
 
 class MarketProtocolTest(unittest.TestCase):
@@ -36,3 +46,80 @@ class MarketProtocolTest(unittest.TestCase):
         exception_message = catcher.pop()
         self.assertEquals(catch_exception["message"][0], "[WARNING] could not find image 696e76616c69645f68617368")
         self.assertEquals(exception_message["message"][0], "[WARNING] Image hash is not 20 characters invalid_hash")
+
+    def test_MarketProtocol_rpc_get_image_reads_and_caches_file(self):
+        folder = tempfile.mkdtemp()
+        fd, image_path = tempfile.mkstemp(dir=DATA_FOLDER)
+        os.write(fd, "image data")
+        os.close(fd)
+        db = Database(filepath=os.path.join(folder, "test.db"))
+        image_hash = digest("image")
+        db.filemap.insert(image_hash.encode("hex"), os.path.relpath(image_path, DATA_FOLDER))
+
+        def cleanup():
+            db.close()
+            if os.path.exists(image_path):
+                os.remove(image_path)
+            shutil.rmtree(folder)
+        self.addCleanup(cleanup)
+
+        mp = MarketProtocol(self.node, self.router, 0, db)
+        d = mp.rpc_get_image(mknode(), image_hash)
+        d.addCallback(self.assertEqual, ["image data"])
+        d.addCallback(lambda _: os.remove(image_path))
+        d.addCallback(lambda _: mp.rpc_get_image(mknode(), image_hash))
+        d.addCallback(self.assertEqual, ["image data"])
+        d.addCallback(lambda _: mp.rpc_get_image(mknode(), image_hash, "0"))
+        d.addCallback(self.assertEqual, ["image data", "10", digest("image data")])
+        d.addCallback(lambda _: mp.rpc_get_image(mknode(), digest("missing")))
+        d.addCallback(self.assertIsNone)
+        return d
+
+    def test_MarketProtocol_rpc_get_profile_reuses_signature_until_profile_changes(self):
+        folder = tempfile.mkdtemp()
+        db = Database(filepath=os.path.join(folder, "test.db"))
+
+        def cleanup():
+            db.close()
+            shutil.rmtree(folder)
+        self.addCleanup(cleanup)
+
+        signing_key = nacl.signing.SigningKey.generate()
+        signatures = []
+
+        class CountingKey(object):
+            def sign(self, message):
+                signatures.append(message)
+                return signing_key.sign(message)
+
+        mp = MarketProtocol(self.node, self.router, CountingKey(), db, audit=False)
+        profile = Profile(db)
+        u = objects.Profile()
+        u.name = "first"
+        profile.update(u)
+
+        first = mp.rpc_get_profile(mknode())
+        self.assertEqual(first, mp.rpc_get_profile(mknode()))
+        self.assertEqual(len(signatures), 1)
+        signing_key.verify_key.verify(first[0], first[1])
+
+        u.name = "second"
+        profile.update(u)
+        second = mp.rpc_get_profile(mknode())
+        self.assertEqual(len(signatures), 2)
+        self.assertNotEqual(first[0], second[0])
+
+    def test_MarketProtocol_rpc_get_listings_without_listings(self):
+        folder = tempfile.mkdtemp()
+        db = Database(filepath=os.path.join(folder, "test.db"))
+
+        def cleanup():
+            db.close()
+            shutil.rmtree(folder)
+        self.addCleanup(cleanup)
+
+        mp = MarketProtocol(self.node, self.router, nacl.signing.SigningKey.generate(), db, audit=False)
+        u = objects.Profile()
+        u.name = "vendor"
+        Profile(db).update(u)
+        self.assertIsNone(mp.rpc_get_listings(mknode()))
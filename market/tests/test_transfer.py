@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from market import transfer
+from market.transfer import ChunkedDownload, CHUNK_SIZE
+from dht.utils import digest
+
+
+class TransferTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.data = os.urandom(CHUNK_SIZE * 3 + 100)
+        self.file_hash = digest(self.data)
+        self.path = os.path.join(self.folder, "file")
+        with open(self.path, "wb") as f:
+            f.write(self.data)
+        self.requests = []
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def fetch(self, node, file_hash, chunk=None):
+        self.requests.append(chunk)
+        if chunk is None:
+            return defer.succeed((True, (self.data,)))
+        return defer.succeed((True, tuple(transfer.chunk_response(self.data, int(chunk)))))
+
+    def test_read_chunk_matches_chunk_response(self):
+        for index in range(4):
+            self.assertEqual(transfer.read_chunk(self.path, index), transfer.chunk_response(self.data, index))
+        self.assertRaises(ValueError, transfer.read_chunk, self.path, 4)
+        self.assertRaises(ValueError, transfer.chunk_response, self.data, -1)
+
+    def assertDownloaded(self, result, path):
+        self.assertEqual(result, (True, path))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_download_in_chunks(self):
+        path = os.path.join(self.folder, "part")
+        download = ChunkedDownload(self.file_hash, path)
+        d = download.start(self.fetch, None)
+        d.addCallback(self.assertDownloaded, path)
+        d.addCallback(lambda _: self.assertEqual(self.requests, ["0", "1", "2", "3"]))
+        return d
+
+    def test_download_rejects_bad_manifests(self):
+        chunk, size, hashes = transfer.chunk_response(self.data, 0)
+        manifests = [
+            (size, hashes[:-1]),
+            (size, hashes[:-20]),
+            (size, hashes + hashes[:20]),
+            (str(transfer.MAX_FILE_SIZE + 1), hashes),
+            ("-1", hashes),
+            ("large", hashes)
+        ]
+
+        def check(_, manifest):
+            def fetch(node, file_hash, chunk_index=None):
+                self.requests.append(chunk_index)
+                return defer.succeed((True, (chunk,) + manifest))
+            return ChunkedDownload(self.file_hash, os.path.join(self.folder, "part")).start(fetch, None)
+
+        d = defer.succeed(None)
+        for manifest in manifests:
+            d.addCallback(check, manifest)
+            d.addCallback(self.assertEqual, (False, None))
+        d.addCallback(lambda _: self.assertEqual(self.requests, ["0"] * len(manifests)))
+        d.addCallback(lambda _: self.assertFalse(os.path.exists(os.path.join(self.folder, "part"))))
+        return d
+
+    def test_download_rejects_short_chunk(self):
+        def fetch(node, file_hash, chunk=None):
+            if chunk == "3":
+                self.requests.append(chunk)
+                return defer.succeed((True, (self.data[CHUNK_SIZE * 3:CHUNK_SIZE * 3 + 50],)))
+            return self.fetch(node, file_hash, chunk)
+
+        download = ChunkedDownload(self.file_hash, os.path.join(self.folder, "part"), retries=1)
+        d = download.start(fetch, None)
+        d.addCallback(self.assertEqual, (False, None))
+        return d
+
+    def test_download_retries_corrupt_chunk_and_resumes(self):
+        responses = {"2": [(True, ("corrupt",)), (False, None)]}
+
+        def fetch(node, file_hash, chunk=None):
+            if responses.get(chunk):
+                self.requests.append(chunk)
+                return defer.succeed(responses[chunk].pop(0))
+            return self.fetch(node, file_hash, chunk)
+
+        path = os.path.join(self.folder, "part")
+        download = ChunkedDownload(self.file_hash, path)
+        d = download.start(fetch, None)
+        d.addCallback(self.assertEqual, (False, None))
+        d.addCallback(lambda _: download.start(fetch, None))
+        d.addCallback(self.assertDownloaded, path)
+        d.addCallback(lambda _: self.assertEqual(self.requests, ["0", "1", "2", "2", "2", "3"]))
+        return d
+
+    def test_download_falls_back_for_old_peers(self):
+        def fetch(node, file_hash, chunk=None):
+            self.requests.append(chunk)
+            if chunk is not None:
+                return defer.succeed((True, ("TypeError",)))
+            return defer.succeed((True, (self.data,)))
+
+        path = os.path.join(self.folder, "part")
+        download = ChunkedDownload(self.file_hash, path)
+        d = download.start(fetch, None)
+        d.addCallback(self.assertDownloaded, path)
+        d.addCallback(lambda _: self.assertEqual(self.requests, ["0", None]))
+        return d
@@ -0,0 +1,137 @@
+import multiprocessing
+import time
+import unittest
+
+import bitcointools
+import nacl.signing
+from nacl.exceptions import BadSignatureError
+from twisted.internet import reactor, task
+from twisted.trial import unittest as trial
+
+from keys import cryptopool, verification
+from keys.cryptopool import CryptoPool
+from keys.guid import GUID
+from keys.verification import VerificationCache, verify_signature, verify_ecdsa_many, valid_guid
+
+
+class VerificationTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = verification.cache
+        verification.cache = VerificationCache(size=2)
+        self.signing_key = nacl.signing.SigningKey.generate()
+        self.pubkey = self.signing_key.verify_key.encode()
+
+    def tearDown(self):
+        verification.cache = self.cache
+
+    def test_verify_signature_caches_result(self):
+        signature = self.signing_key.sign("message")[:64]
+        verify_signature(self.pubkey, "message", signature)
+        verify_signature(self.pubkey, "message", signature)
+        self.assertRaises(BadSignatureError, verify_signature, self.pubkey, "forged", signature)
+        self.assertRaises(BadSignatureError, verify_signature, self.pubkey, "forged", signature)
+        stats = verification.cache.get_stats()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["hit_rate"], 0.5)
+
+    def test_cache_is_bounded(self):
+        for message in ("one", "two", "three"):
+            verify_signature(self.pubkey, message, self.signing_key.sign(message)[:64])
+        self.assertEqual(verification.cache.get_stats()["entries"], 2)
+
+    def test_disabled_cache_still_verifies(self):
+        verification.cache = VerificationCache(size=0)
+        signature = self.signing_key.sign("message")[:64]
+        verify_signature(self.pubkey, "message", signature)
+        self.assertRaises(BadSignatureError, verify_signature, self.pubkey, "forged", signature)
+        self.assertEqual(verification.cache.get_stats()["entries"], 0)
+
+    def test_ecdsa_workers(self):
+        privkey = bitcointools.random_key()
+        pubkey = bitcointools.privkey_to_pubkey(privkey)
+        signature = cryptopool.ecdsa_sign(("message", privkey))
+        self.assertTrue(cryptopool.ecdsa_verify(("message", signature, pubkey)))
+        self.assertFalse(cryptopool.ecdsa_verify(("forged", signature, pubkey)))
+        # malformed items are reported rather than raised in the worker
+        self.assertFalse(cryptopool.ecdsa_verify(("message", signature)))
+        self.assertIsNone(cryptopool.ecdsa_sign(("message",)))
+
+    def test_valid_guid(self):
+        g = GUID.from_privkey("b54a4f932c620937c05ab0d4bd2b98e434c4946c7d4b23737c139fbdea116255")
+        pubkey = g.verify_key.encode()
+        self.assertTrue(valid_guid(pubkey, g.guid.encode("hex")))
+        self.assertTrue(valid_guid(pubkey, g.guid.encode("hex")))
+        self.assertFalse(valid_guid(pubkey, "00" * 20))
+        self.assertFalse(valid_guid(self.pubkey, g.guid.encode("hex")))
+
+
+class CryptoPoolTest(trial.TestCase):
+    def setUp(self):
+        # other tests point the reactor's callLater at a task.Clock and leave it there
+        vars(reactor).pop("callLater", None)
+        self.pool = cryptopool.pool
+        self.cache = verification.cache
+        cryptopool.pool = CryptoPool(processes=1)
+        verification.cache = VerificationCache(size=10)
+        self.privkey = bitcointools.random_key()
+        self.pubkey = bitcointools.privkey_to_pubkey(self.privkey)
+
+    def tearDown(self):
+        cryptopool.pool.stop()
+        cryptopool.pool = self.pool
+        verification.cache = self.cache
+
+    def test_sign_and_verify_many(self):
+        def signed(signatures):
+            self.assertEqual(len(signatures), 2)
+            return verify_ecdsa_many([("one", signatures[0], self.pubkey),
+                                      ("two", signatures[1], self.pubkey),
+                                      ("three", signatures[1], self.pubkey),
+                                      ("four", "garbage", self.pubkey)])
+
+        d = cryptopool.sign_ecdsa_many([("one", self.privkey), ("two", self.privkey)])
+        d.addCallback(signed)
+        d.addCallback(self.assertEqual, [True, True, False, False])
+        d.addCallback(lambda _: self.assertEqual(cryptopool.pool.get_stats()["tasks"], 6))
+        return d
+
+    def test_worker_error_fails_deferred(self):
+        return self.assertFailure(cryptopool.pool.map(int, ["not a number"]), ValueError)
+
+    def test_timeout_fails_deferred(self):
+        cryptopool.pool = CryptoPool(processes=1, timeout=0.1)
+        return self.assertFailure(cryptopool.pool.map(time.sleep, [2]), multiprocessing.TimeoutError)
+
+    def test_results_are_polled_from_the_reactor(self):
+        class Result(object):
+            value = None
+
+            def ready(self):
+                return self.value is not None
+
+            def get(self, timeout):
+                return self.value
+
+        clock = task.Clock()
+        pool = CryptoPool(processes=1, timeout=1, poll_interval=0.1, clock=clock)
+        result, late = Result(), Result()
+        fired = []
+        pool._wait(result).addCallback(fired.append)
+        d = pool._wait(late)
+        clock.advance(0.5)
+        self.assertEqual(fired, [])
+        result.value = [True]
+        clock.advance(0.1)
+        self.assertEqual(fired, [[True]])
+        clock.advance(0.5)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        return self.assertFailure(d, multiprocessing.TimeoutError)
+
+    def test_inline_pool(self):
+        cryptopool.pool = CryptoPool(processes=0)
+        signature = bitcointools.encode_sig(*bitcointools.ecdsa_raw_sign("message", self.privkey))
+        d = verify_ecdsa_many([("message", signature, self.pubkey), ("forged", signature, self.pubkey)])
+        d.addCallback(self.assertEqual, [True, False])
+        d.addCallback(lambda _: self.assertIsNone(cryptopool.pool.pool))
+        return d
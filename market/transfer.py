@@ -0,0 +1,166 @@
+__author__ = 'chris'
+
+import os
+from dht.utils import digest
+from log import Logger
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+CHUNK_SIZE = 65536
+
+# the largest file we'll accept from a peer
+MAX_FILE_SIZE = 33554432
+
+
+def chunk_response(data, index):
+    """
+    Build the response to a chunk request from the full contents of a file.
+    The first chunk also carries the file size and the concatenated hashes of
+    every chunk so the downloader can verify each chunk as it arrives.
+    """
+    chunk = data[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE]
+    if index < 0 or (not chunk and index != 0):
+        raise ValueError("chunk %s out of range" % index)
+    if index != 0:
+        return [chunk]
+    hashes = "".join(digest(data[i:i + CHUNK_SIZE]) for i in range(0, max(len(data), 1), CHUNK_SIZE))
+    return [chunk, str(len(data)), hashes]
+
+
+def read_chunk(file_path, index):
+    """
+    Same as `chunk_response` but reads from disk, holding at most one chunk
+    in memory at a time.
+    """
+    size = os.path.getsize(file_path)
+    if index < 0 or (index * CHUNK_SIZE >= size and index != 0):
+        raise ValueError("chunk %s out of range" % index)
+    with open(file_path, "rb") as f:
+        f.seek(index * CHUNK_SIZE)
+        chunk = f.read(CHUNK_SIZE)
+        if index != 0:
+            return [chunk]
+        hashes = [digest(chunk)]
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            hashes.append(digest(data))
+    return [chunk, str(size), "".join(hashes)]
+
+
+def valid_manifest(size, hashes):
+    """
+    Check the size and chunk hashes a peer sent with the first chunk describe
+    a file we're willing to download.
+    """
+    return 0 <= size <= MAX_FILE_SIZE and len(hashes) % 20 == 0 and \
+        len(hashes) / 20 == max(1, (size + CHUNK_SIZE - 1) / CHUNK_SIZE)
+
+
+class ChunkedDownload(object):
+    """
+    Downloads a file from a peer one chunk at a time, writing each verified
+    chunk straight to a partial file on disk. If the transfer fails part way
+    through, calling `start` again only requests the chunks still missing.
+    The completed file is left at `path` for the caller to check and move
+    into place so it's never held in memory as a whole.
+
+    `fetch` is called as ``fetch(node, file_hash, chunk)`` for a single chunk
+    and ``fetch(node, file_hash)`` for the whole file, and must return a
+    `Deferred` firing with the usual ``(response_received, arguments)`` tuple.
+    Peers that don't support chunked transfers reject the extra argument, in
+    which case we fall back to requesting the whole file.
+    """
+
+    def __init__(self, file_hash, path, retries=3):
+        self.file_hash = file_hash
+        self.path = path
+        self.retries = retries
+        self.size = None
+        self.hashes = None
+        self.received = set()
+        self.waiting = []
+        self.log = Logger(system=self)
+
+    def missing(self):
+        return [i for i in range(len(self.hashes) / 20) if i not in self.received]
+
+    def start(self, fetch, node):
+        """
+        Returns a `Deferred` firing with ``(True, path)`` once every chunk has
+        been received or ``(False, None)`` if the peer stopped responding or
+        sent a bad manifest. ``(True, None)`` means the peer doesn't have the file.
+        Calls made while a transfer is running wait for its result.
+        """
+        d = defer.Deferred()
+        self.waiting.append(d)
+        if len(self.waiting) == 1:
+            self._run(fetch, node).addBoth(self._notify)
+        return d
+
+    def _notify(self, result):
+        if isinstance(result, Failure):
+            self.log.error("download of %s failed: %s" % (self.file_hash.encode("hex"), result.getErrorMessage()))
+            result = (False, None)
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(result)
+
+    @defer.inlineCallbacks
+    def _run(self, fetch, node):
+        if self.hashes is None or 0 not in self.received:
+            result = yield fetch(node, self.file_hash, "0")
+            if not result[0] or result[1] is None:
+                defer.returnValue(result)
+            if len(result[1]) != 3:
+                self.log.debug("%s does not support chunked transfers" % node)
+                result = yield fetch(node, self.file_hash)
+                if not result[0] or result[1] is None:
+                    defer.returnValue(result)
+                if len(result[1][0]) > MAX_FILE_SIZE:
+                    self.log.warning("%s sent an oversized file" % node)
+                    defer.returnValue((False, None))
+                with open(self.path, "wb") as f:
+                    f.write(result[1][0])
+                defer.returnValue((True, self.path))
+            chunk, size, hashes = result[1]
+            try:
+                size = int(size)
+            except ValueError:
+                size = -1
+            if not valid_manifest(size, hashes):
+                self.log.warning("%s sent an invalid manifest for %s" % (node, self.file_hash.encode("hex")))
+                defer.returnValue((False, None))
+            if hashes != self.hashes:
+                self.size, self.hashes = size, hashes
+                self.received = set()
+                with open(self.path, "wb") as f:
+                    f.truncate(self.size)
+            if not self._write(0, chunk):
+                defer.returnValue((False, None))
+
+        for index in self.missing():
+            for _ in range(self.retries):
+                result = yield fetch(node, self.file_hash, str(index))
+                if not result[0]:
+                    defer.returnValue(result)
+                if result[1] is not None and self._write(index, result[1][0]):
+                    break
+            else:
+                defer.returnValue((False, None))
+        defer.returnValue((True, self.path))
+
+    def _write(self, index, chunk):
+        """
+        Verify a chunk against the manifest and write it to the partial file.
+        """
+        length = min(CHUNK_SIZE, self.size - index * CHUNK_SIZE)
+        if len(chunk) != length or digest(chunk) != self.hashes[index * 20:(index + 1) * 20]:
+            self.log.warning("received corrupt chunk %s of %s" % (index, self.file_hash.encode("hex")))
+            return False
+        with open(self.path, "r+b") as f:
+            f.seek(index * CHUNK_SIZE)
+            f.write(chunk)
+        self.received.add(index)
+        return True
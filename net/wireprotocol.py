@@ -1,13 +1,12 @@
 __author__ = 'chris'
 
 import socket
-import nacl.signing
-import nacl.hash
 import time
 from config import SEEDS
 from dht.node import Node
 from dht.utils import digest
 from interfaces import MessageProcessor, Multiplexer, ConnectionHandler
+from keys.verification import valid_guid
 from log import Logger
 from net.dos import BanScore
 from protos.message import Message, PING, NOT_FOUND
@@ -95,9 +94,7 @@ class OpenBazaarProtocol(ConnectionMultiplexer):
                                  m.sender.vendor)
                 self.remote_node_version = m.protoVer
                 if self.time_last_message == 0:
-                    h = nacl.hash.sha512(m.sender.publicKey)
-                    pow_hash = h[40:]
-                    if int(pow_hash[:6], 16) >= 50 or m.sender.guid.encode("hex") != h[:40]:
+                    if not valid_guid(m.sender.publicKey, m.sender.guid.encode("hex")):
                         raise Exception('Invalid GUID')
                 for processor in self.processors:
                     if m.command in processor or m.command == NOT_FOUND:
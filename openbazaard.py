@@ -16,7 +16,7 @@ from daemon import Daemon
 from db.datastore import Database
 from dht.network import Server
 from dht.node import Node
-from dht.storage import ForgetfulStorage
+from dht.storage import ForgetfulStorage, PersistentStorage
 from keys.credentials import get_credentials
 from keys.keychain import KeyChain
 from log import Logger, FileLogObserver
@@ -50,6 +50,7 @@ def run(*args):
     WSPORT = args[5]
     HEARTBEATPORT = args[6]
     AUDIT = args[7]
+    PERSIST_DHT = args[9]
 
     def start_server(keys, first_startup=False):
         # logging
@@ -176,15 +177,21 @@ def run(*args):
         def shutdown():
             print "OpenBazaar Server v0.2.6 shutting down..."
             for vendor in protocol.vendors.values():
-                db.vendors.save_vendor(vendor.id.encode("hex"), vendor.getProto().SerializeToString())
+                db.vendors.save_vendor(vendor.id.encode("hex"), vendor.getSerializedProto())
             PortMapper().clean_my_mappings(PORT)
             protocol.shutdown()
+            if PERSIST_DHT:
+                storage.close()
+            db.close()
 
         reactor.addSystemEventTrigger('before', 'shutdown', shutdown)
 
     # database
     db = Database(TESTNET)
-    storage = ForgetfulStorage()
+    if PERSIST_DHT:
+        storage = PersistentStorage(os.path.join(DATA_FOLDER, "DHT-Testnet.db" if TESTNET else "DHT-Mainnet.db"))
+    else:
+        storage = ForgetfulStorage()
 
     # client authentication
     username, password = get_credentials(db)
@@ -260,6 +267,8 @@ commands:
             parser.add_argument('-w', '--websocketport', help="set the websocket api port", default=18466)
             parser.add_argument('-b', '--heartbeatport', help="set the heartbeat port", default=18470)
             parser.add_argument('-u', '--disableaudit', action='store_true', help="disable event logging")
+            parser.add_argument('-s', '--persistdht', action='store_true',
+                                help="keep the values stored in the dht on disk across restarts")
             parser.add_argument('--pidfile', help="name of the pid file", default="openbazaard.pid")
             args = parser.parse_args(sys.argv[2:])
 
@@ -275,11 +284,11 @@ commands:
                 self.daemon.pidfile = "/tmp/" + args.pidfile
                 self.daemon.start(args.testnet, args.loglevel, port, args.allowip,
                                   int(args.restapiport), int(args.websocketport),
-                                  int(args.heartbeatport), time.time(), args.disableaudit)
+                                  int(args.heartbeatport), time.time(), args.disableaudit, args.persistdht)
             else:
                 run(args.testnet, args.loglevel, port, args.allowip,
                     int(args.restapiport), int(args.websocketport),
-                    int(args.heartbeatport), time.time(), args.disableaudit)
+                    int(args.heartbeatport), time.time(), args.disableaudit, args.persistdht)
 
         def stop(self):
             # pylint: disable=W0612
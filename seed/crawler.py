@@ -0,0 +1,206 @@
+__author__ = 'chris'
+
+import random
+from collections import deque
+from dht.crawling import NodeSpiderCrawl
+from dht.node import Node
+from dht.utils import digest
+from log import Logger
+from protos import objects
+from twisted.internet import reactor, task
+
+
+class SeedCrawler(object):
+    """
+    Keeps the seed's picture of the network up to date without flooding it.
+
+    Every `interval` seconds the crawler fills a window of at most `concurrency`
+    outstanding requests: pings to the nodes in our routing table and the known
+    nodes we haven't checked for `recheck` seconds, and a spider crawl towards a
+    random id to find new ones.
+
+    A node's score is the number of times in a row it has answered, up to
+    `max_score`, or minus the number of times in a row it hasn't. Nodes which
+    stop answering are dropped once their score falls below `min_score` or
+    they haven't been seen for `expiry` seconds.
+
+    The nodes are saved in the database as they change so a restart picks up
+    where it left off.
+    """
+
+    def __init__(self, protocol, store, concurrency=10, interval=5, recheck=900, expiry=86400,
+                 max_score=10, min_score=-3, clock=reactor):
+        self.protocol = protocol
+        self.store = store
+        self.concurrency = concurrency
+        self.interval = interval
+        self.recheck = recheck
+        self.expiry = expiry
+        self.max_score = max_score
+        self.min_score = min_score
+        self.clock = clock
+        self.log = Logger(system=self)
+        self.nodes = {}
+        self.checked = {}
+        self.queue = deque()
+        self.dirty = set()
+        self.removed = set()
+        self.active = 0
+        self.crawling = False
+        self.loop = None
+        self.started = clock.seconds()
+        self.pings = 0
+        self.crawls = 0
+        self.joined = 0
+        self.departed = 0
+
+    def start(self):
+        """
+        Load the nodes saved by the last run and start crawling.
+        """
+        for serialized, score, first_seen, last_seen in self.store.get_all():
+            node = _node(serialized)
+            if node is not None:
+                self.nodes[node.id] = [node, score, first_seen, last_seen]
+        self.log.info("loaded %s saved nodes" % len(self.nodes))
+        self.loop = task.LoopingCall(self.tick)
+        self.loop.clock = self.clock
+        self.loop.start(self.interval, True)
+
+    def stop(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        self.save()
+
+    def add(self, node):
+        """
+        Record that `node` just answered us.
+        """
+        now = int(self.clock.seconds())
+        entry = self.nodes.get(node.id)
+        if entry is None:
+            self.nodes[node.id] = [node, 1, now, now]
+            self.joined += 1
+        else:
+            entry[0] = node
+            entry[1] = min(max(entry[1], 0) + 1, self.max_score)
+            entry[3] = now
+        self.checked[node.id] = now
+        self.removed.discard(node.id)
+        self.dirty.add(node.id)
+
+    def get_nodes(self):
+        """
+        Return the nodes which answered the last time we checked.
+        """
+        return [entry[0] for entry in self.nodes.values() if entry[1] > 0]
+
+    def tick(self):
+        now = self.clock.seconds()
+        if len(self.queue) == 0:
+            # nodes which contacted the seed itself get checked like any other
+            for bucket in self.protocol.router.buckets:
+                for node in bucket.getNodes():
+                    if node.id not in self.nodes:
+                        self.queue.append(node)
+            for guid, entry in self.nodes.items():
+                if now - self.checked.get(guid, 0) >= self.recheck:
+                    self.queue.append(entry[0])
+        if not self.crawling and self.active < self.concurrency:
+            self._crawl()
+        while self.active < self.concurrency and len(self.queue) > 0:
+            node = self.queue.popleft()
+            if now - self.checked.get(node.id, 0) >= self.recheck:
+                self._ping(node)
+        self.save()
+
+    def save(self):
+        """
+        Write the nodes that changed since the last call to the database.
+        """
+        if len(self.dirty) > 0:
+            entries = []
+            for guid in self.dirty:
+                node, score, first_seen, last_seen = self.nodes[guid]
+                entries.append((guid, node.getSerializedProto(), score, first_seen, last_seen))
+            self.store.update(entries)
+            self.dirty = set()
+        if len(self.removed) > 0:
+            self.store.delete(list(self.removed))
+            self.removed = set()
+
+    def get_stats(self):
+        hours = max(self.clock.seconds() - self.started, 1) / 3600.0
+        return {
+            "known": len(self.nodes),
+            "live": len([entry for entry in self.nodes.values() if entry[1] > 0]),
+            "vendors": len([entry for entry in self.nodes.values() if entry[1] > 0 and entry[0].vendor]),
+            "active_requests": self.active,
+            "pings": self.pings,
+            "crawls": self.crawls,
+            "joined": self.joined,
+            "departed": self.departed,
+            "joined_per_hour": self.joined / hours,
+            "departed_per_hour": self.departed / hours
+        }
+
+    def _ping(self, node):
+        self.active += 1
+        self.pings += 1
+        self.checked[node.id] = int(self.clock.seconds())
+
+        def response(result):
+            self.active -= 1
+            if result[0]:
+                self.add(node)
+            else:
+                self._missed(node)
+        self.protocol.callPing(node).addCallbacks(response, lambda failure: response((False, None)))
+
+    def _missed(self, node):
+        entry = self.nodes.get(node.id)
+        if entry is None:
+            return
+        entry[1] = min(entry[1], 0) - 1
+        self.dirty.add(node.id)
+        if entry[1] < self.min_score or self.clock.seconds() - entry[3] > self.expiry:
+            del self.nodes[node.id]
+            self.checked.pop(node.id, None)
+            self.dirty.discard(node.id)
+            self.removed.add(node.id)
+            self.departed += 1
+
+    def _crawl(self):
+        target = Node(digest(random.getrandbits(255)))
+        nearest = self.protocol.router.findNeighbors(target)
+        if len(nearest) == 0:
+            nearest = [entry[0] for entry in self.nodes.values() if entry[1] > 0][:self.protocol.ksize]
+        if len(nearest) == 0:
+            return
+        self.active += 1
+        self.crawls += 1
+        self.crawling = True
+
+        def found(nodes):
+            for node in nodes:
+                self.add(node)
+
+        def done(result):
+            self.active -= 1
+            self.crawling = False
+            return result
+        spider = NodeSpiderCrawl(self.protocol, target, nearest, self.protocol.ksize, 3)
+        d = spider.find().addCallback(found).addBoth(done)
+        d.addErrback(lambda failure: self.log.warning("crawl failed: %s" % failure.getErrorMessage()))
+
+
+def _node(serialized):
+    n = objects.Node()
+    try:
+        n.ParseFromString(serialized)
+        return Node(n.guid, n.nodeAddress.ip, n.nodeAddress.port, n.publicKey,
+                    None if not n.HasField("relayAddress") else (n.relayAddress.ip, n.relayAddress.port),
+                    n.natType,
+                    n.vendor)
+    except Exception:
+        return None
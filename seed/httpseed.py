@@ -4,27 +4,23 @@ import json
 import os
 import pickle
 import platform
-import random
 import stun
 import sys
 import nacl.encoding
 import nacl.hash
 import nacl.signing
-from binascii import hexlify
 from config import DATA_FOLDER
 from daemon import Daemon
 from db.datastore import Database
-from dht.crawling import NodeSpiderCrawl
 from dht.network import Server
 from dht.node import Node
-from dht.utils import digest, deferredDict
 from keys.keychain import KeyChain
 from log import Logger, FileLogObserver
 from net.wireprotocol import OpenBazaarProtocol
 from protos import objects
-from random import shuffle
-from seed import peers
-from twisted.internet import task, reactor
+from seed import snapshots
+from seed.crawler import SeedCrawler
+from twisted.internet import reactor
 from twisted.python import log, logfile
 from twisted.web import resource, server
 
@@ -86,107 +82,32 @@ def run(*args):
             def __init__(self, kserver_r):
                 resource.Resource.__init__(self)
                 self.kserver = kserver_r
-                self.nodes = {}
-                for bucket in self.kserver.protocol.router.buckets:
-                    for node in bucket.getNodes():
-                        self.nodes[(node.ip, node.port)] = node
-                self.nodes[(this_node.ip, this_node.port)] = this_node
-                loopingCall = task.LoopingCall(self.crawl)
-                loopingCall.start(900, True)
-
-            def crawl(self):
-                def gather_results(result):
-                    for proto in result:
-                        n = objects.Node()
-                        try:
-                            n.ParseFromString(proto)
-                            node = Node(n.guid, n.nodeAddress.ip, n.nodeAddress.port, n.signedPublicKey,
-                                        None if not n.HasField("relayAddress") else
-                                        (n.relayAddress.ip, n.relayAddress.port),
-                                        n.natType,
-                                        n.vendor)
-                            self.nodes[(node.ip, node.port)] = node
-                        except Exception:
-                            pass
-
-                def start_crawl(results):
-                    for node, result in results.items():
-                        if not result[0]:
-                            del self.nodes[(node.ip, node.port)]
-                    node = Node(digest(random.getrandbits(255)))
-                    nearest = self.kserver.protocol.router.findNeighbors(node)
-                    spider = NodeSpiderCrawl(self.kserver.protocol, node, nearest, 100, 4)
-                    spider.find().addCallback(gather_results)
-
-                ds = {}
-                for bucket in self.kserver.protocol.router.buckets:
-                    for node in bucket.getNodes():
-                        self.nodes[(node.ip, node.port)] = node
-                for node in self.nodes.values():
-                    if node.id != this_node.id:
-                        ds[node] = self.kserver.protocol.callPing(node)
-                deferredDict(ds).addCallback(start_crawl)
+                self.crawler = SeedCrawler(self.kserver.protocol, db.seed_nodes)
+                self.crawler.start()
+                reactor.addSystemEventTrigger('before', 'shutdown', self.crawler.stop)
+                self.snapshots = snapshots.SnapshotEngine(signing_key,
+                                                          lambda: self.crawler.get_nodes() + [this_node])
+                self.snapshots.start()
 
             def getChild(self, child, request):
+                if child == "stats":
+                    return StatsResource(self.crawler)
                 return self
 
             def render_GET(self, request):
-                nodes = self.nodes.values()
-                shuffle(nodes)
                 logger.info("Received a request for nodes, responding...")
-                if "format" in request.args:
-                    if request.args["format"][0] == "json":
-                        json_list = []
-                        if "type" in request.args and request.args["type"][0] == "vendors":
-                            for node in nodes:
-                                if node.vendor is True:
-                                    node_dic = {}
-                                    node_dic["ip"] = node.ip
-                                    node_dic["port"] = node.port
-                                    node_dic["guid"] = node.id.encode("hex")
-                                    json_list.append(node_dic)
-                            sig = signing_key.sign(str(json_list))
-                            resp = {"peers": json_list, "signature": hexlify(sig[:64])}
-                            request.write(json.dumps(resp, indent=4))
-                        else:
-                            for node in nodes[:50]:
-                                node_dic = {}
-                                node_dic["ip"] = node.ip
-                                node_dic["port"] = node.port
-                                json_list.append(node_dic)
-                            sig = signing_key.sign(str(json_list))
-                            resp = {"peers": json_list, "signature": hexlify(sig[:64])}
-                            request.write(json.dumps(resp, indent=4))
-                    elif request.args["format"][0] == "protobuf":
-                        proto = peers.PeerSeeds()
-                        for node in nodes[:50]:
-                            proto.serializedNode.append(node.getProto().SerializeToString())
+                return snapshots.render(self.snapshots, request)
 
-                        sig = signing_key.sign("".join(proto.serializedNode))[:64]
-                        proto.signature = sig
-                        uncompressed_data = proto.SerializeToString()
-                        request.write(uncompressed_data.encode("zlib"))
-                else:
-                    proto = peers.PeerSeeds()
-                    if "type" in request.args and request.args["type"][0] == "vendors":
-                        for node in nodes:
-                            if node.vendor is True:
-                                proto.serializedNode.append(node.getProto().SerializeToString())
+        class StatsResource(resource.Resource):
+            isLeaf = True
 
-                        sig = signing_key.sign("".join(proto.serializedNode))[:64]
-                        proto.signature = sig
-                        uncompressed_data = proto.SerializeToString()
-                        request.write(uncompressed_data.encode("zlib"))
-                    else:
-                        for node in nodes[:50]:
-                            proto.serializedNode.append(node.getProto().SerializeToString())
+            def __init__(self, crawler):
+                resource.Resource.__init__(self)
+                self.crawler = crawler
 
-                        sig = signing_key.sign("".join(proto.serializedNode))[:64]
-                        proto.signature = sig
-                        uncompressed_data = proto.SerializeToString()
-                        request.write(uncompressed_data.encode("zlib"))
-                request.finish()
-                return server.NOT_DONE_YET
+            def render_GET(self, request):
+                request.setHeader('content-type', "application/json")
+                return json.dumps(self.crawler.get_stats(), indent=4)
 
         server_protocol = server.Site(WebResource(kserver))
         reactor.listenTCP(HTTPPORT, server_protocol)
@@ -0,0 +1,130 @@
+__author__ = 'chris'
+
+import hashlib
+import json
+import random
+from binascii import hexlify
+from seed import peers
+from twisted.internet import reactor, task
+
+PROTOBUF = "protobuf"
+JSON = "json"
+PEERS = "peers"
+VENDORS = "vendors"
+
+# (format, type) of every response the seed serves
+KINDS = ((PROTOBUF, PEERS), (PROTOBUF, VENDORS), (JSON, PEERS), (JSON, VENDORS))
+
+
+class Snapshot(object):
+    """
+    A signed response body ready to be written to a request.
+    """
+
+    def __init__(self, body, timestamp):
+        self.body = body
+        self.timestamp = timestamp
+        self.etag = hashlib.sha1(body).hexdigest()
+
+
+class SnapshotEngine(object):
+    """
+    Builds the signed and compressed responses of the HTTP seed ahead of time
+    so answering a request is just writing out bytes already in memory.
+
+    Every `interval` seconds `rotations` differently shuffled snapshots of each
+    kind of response are made from the nodes returned by `get_nodes` and the
+    requests are handed them in turn so bootstrapping clients still spread out
+    over the network.
+    """
+
+    def __init__(self, signing_key, get_nodes, rotations=8, interval=60, max_peers=50, clock=reactor):
+        self.signing_key = signing_key
+        self.get_nodes = get_nodes
+        self.rotations = rotations
+        self.interval = interval
+        self.max_peers = max_peers
+        self.clock = clock
+        self.snapshots = dict((kind, []) for kind in KINDS)
+        self.next = dict((kind, 0) for kind in KINDS)
+        self.loop = None
+
+    def start(self):
+        self.loop = task.LoopingCall(self.refresh)
+        self.loop.clock = self.clock
+        self.loop.start(self.interval, True)
+
+    def stop(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+
+    def refresh(self):
+        """
+        Replace all the snapshots with ones made from the current node list.
+        """
+        nodes = list(self.get_nodes())
+        timestamp = int(self.clock.seconds())
+        snapshots = dict((kind, []) for kind in KINDS)
+        for _ in range(max(self.rotations, 1)):
+            random.shuffle(nodes)
+            vendors = [node for node in nodes if node.vendor is True]
+            snapshots[(PROTOBUF, PEERS)].append(Snapshot(self._protobuf(nodes[:self.max_peers]), timestamp))
+            snapshots[(PROTOBUF, VENDORS)].append(Snapshot(self._protobuf(vendors), timestamp))
+            snapshots[(JSON, PEERS)].append(Snapshot(self._json(nodes[:self.max_peers], False), timestamp))
+            snapshots[(JSON, VENDORS)].append(Snapshot(self._json(vendors, True), timestamp))
+        self.snapshots = snapshots
+
+    def get(self, kind, etags=()):
+        """
+        Return the next `Snapshot` of the given (format, type) kind. If one of
+        `etags` is a current snapshot that one is returned so the client can be
+        told it already has it.
+        """
+        snapshots = self.snapshots[kind]
+        if len(snapshots) == 0:
+            self.refresh()
+            snapshots = self.snapshots[kind]
+        for snapshot in snapshots:
+            if snapshot.etag in etags:
+                return snapshot
+        i = self.next[kind] % len(snapshots)
+        self.next[kind] = i + 1
+        return snapshots[i]
+
+    def _protobuf(self, nodes):
+        proto = peers.PeerSeeds()
+        for node in nodes:
+            proto.serializedNode.append(node.getSerializedProto())
+        proto.signature = self.signing_key.sign("".join(proto.serializedNode))[:64]
+        return proto.SerializeToString().encode("zlib")
+
+    def _json(self, nodes, vendors):
+        json_list = []
+        for node in nodes:
+            node_dic = {}
+            node_dic["ip"] = node.ip
+            node_dic["port"] = node.port
+            if vendors:
+                node_dic["guid"] = node.id.encode("hex")
+            json_list.append(node_dic)
+        sig = self.signing_key.sign(str(json_list))
+        resp = {"peers": json_list, "signature": hexlify(sig[:64])}
+        return json.dumps(resp, indent=4)
+
+
+def render(engine, request):
+    """
+    Return the body of the snapshot asked for by the request's `format` and `type`
+    arguments, or an empty body with a 304 status if the client already has it.
+    """
+    fmt = request.args["format"][0] if "format" in request.args else PROTOBUF
+    if fmt not in (PROTOBUF, JSON):
+        return ""
+    # the protobuf format has only ever served general peers
+    vendors = "type" in request.args and request.args["type"][0] == VENDORS and \
+        request.args.get("format", [None])[0] != PROTOBUF
+    etags = [tag.strip('",') for tag in (request.getHeader("if-none-match") or "").split()]
+    snapshot = engine.get((fmt, VENDORS if vendors else PEERS), etags)
+    if request.setETag('"%s"' % snapshot.etag) or request.setLastModified(snapshot.timestamp):
+        return ""
+    return snapshot.body
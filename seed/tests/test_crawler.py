@@ -0,0 +1,207 @@
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from db.datastore import Database
+from dht.node import Node
+from dht.utils import digest
+from protos.objects import FULL_CONE
+from seed.crawler import SeedCrawler
+
+
+class FakeBucket(object):
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def getNodes(self):
+        return self.nodes
+
+
+class FakeProtocol(object):
+    def __init__(self, nodes=()):
+        self.ksize = 20
+        self.router = self
+        self.buckets = [FakeBucket(list(nodes))]
+        self.neighbors = []
+        self.pings = []
+        self.finds = []
+        self.crawler = None
+
+    def findNeighbors(self, node):
+        return self.neighbors
+
+    def callPing(self, node):
+        assert self.crawler.active <= self.crawler.concurrency
+        d = defer.Deferred()
+        self.pings.append((node, d))
+        return d
+
+    def callFindNode(self, node, target):
+        assert self.crawler.active <= self.crawler.concurrency
+        d = defer.Deferred()
+        self.finds.append((node, d))
+        return d
+
+
+def mknode(i):
+    return Node(digest("node%s" % i), "127.0.0.%s" % (i % 250 + 1), 18467, digest("key%s" % i), None, FULL_CONE)
+
+
+class SeedCrawlerTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = Database(filepath=os.path.join(self.folder, "test.db"))
+        self.store = self.db.seed_nodes
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.nodes = [mknode(i) for i in range(25)]
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.folder)
+
+    def crawler(self, protocol, **kwargs):
+        crawler = SeedCrawler(protocol, self.store, clock=self.clock, **kwargs)
+        protocol.crawler = crawler
+        return crawler
+
+    def saved(self):
+        return dict((entry[0], tuple(entry[1:])) for entry in self.store.get_all())
+
+    def test_never_exceeds_concurrency(self):
+        protocol = FakeProtocol(self.nodes)
+        crawler = self.crawler(protocol, concurrency=5, interval=5)
+        crawler.start()
+        self.assertEqual(len(protocol.pings), 5)
+        self.assertEqual(crawler.active, 5)
+
+        self.clock.advance(5)
+        self.assertEqual(len(protocol.pings), 5)
+
+        for node, d in protocol.pings[:2]:
+            d.callback((True, None))
+        self.assertEqual(crawler.active, 3)
+        self.clock.advance(5)
+        # the nodes which answered seed a crawl, which takes one of the slots
+        self.assertEqual(len(protocol.finds), 2)
+        self.assertEqual(len(protocol.pings), 6)
+        self.assertEqual(crawler.active, 5)
+
+        answered = 2
+        while answered < len(protocol.pings):
+            for node, d in protocol.pings[answered:]:
+                d.callback((True, None))
+                answered += 1
+            self.clock.advance(5)
+            self.assertTrue(crawler.active <= 5)
+        self.assertEqual(sorted(node.id for node, _ in protocol.pings), sorted(node.id for node in self.nodes))
+        self.assertEqual(len(crawler.get_nodes()), 25)
+        self.assertEqual(len(self.saved()), 25)
+        crawler.stop()
+
+    def test_crawl_counts_towards_concurrency(self):
+        protocol = FakeProtocol(self.nodes)
+        protocol.neighbors = self.nodes[:3]
+        crawler = self.crawler(protocol, concurrency=4, interval=5)
+        crawler.start()
+        self.assertEqual(len(protocol.finds), 3)
+        self.assertEqual(len(protocol.pings), 3)
+        self.assertEqual(crawler.active, 4)
+
+        self.clock.advance(5)
+        self.assertEqual(len(protocol.finds), 3)
+        for node, d in protocol.finds:
+            d.callback((True, [mknode(100).getSerializedProto()]))
+        self.assertEqual(crawler.active, 3)
+        self.assertFalse(crawler.crawling)
+        self.assertIn(digest("node100"), crawler.nodes)
+        crawler.stop()
+
+    def test_scores(self):
+        crawler = self.crawler(FakeProtocol(), max_score=3)
+        node = self.nodes[0]
+        for score in (1, 2, 3, 3):
+            crawler.add(node)
+            self.assertEqual(crawler.nodes[node.id][1], score)
+        self.assertEqual(crawler.get_nodes(), [node])
+
+        for score in (-1, -2):
+            crawler._missed(node)
+            self.assertEqual(crawler.nodes[node.id][1], score)
+        self.assertEqual(crawler.get_nodes(), [])
+
+        crawler.add(node)
+        self.assertEqual(crawler.nodes[node.id][1], 1)
+        crawler._missed(self.nodes[1])
+        self.assertNotIn(self.nodes[1].id, crawler.nodes)
+
+    def test_failed_ping_is_a_miss(self):
+        protocol = FakeProtocol()
+        crawler = self.crawler(protocol)
+        crawler.add(self.nodes[0])
+        crawler._ping(self.nodes[0])
+        protocol.pings[0][1].errback(Exception("timeout"))
+        self.assertEqual(crawler.nodes[self.nodes[0].id][1], -1)
+        self.assertEqual(crawler.active, 0)
+
+    def test_drops_nodes_below_min_score(self):
+        crawler = self.crawler(FakeProtocol(), min_score=-3)
+        node = self.nodes[0]
+        crawler.add(node)
+        crawler.save()
+        self.assertIn(node.getSerializedProto(), self.saved())
+
+        for _ in range(3):
+            crawler._missed(node)
+        self.assertEqual(crawler.nodes[node.id][1], -3)
+        crawler._missed(node)
+        self.assertNotIn(node.id, crawler.nodes)
+        self.assertEqual(crawler.removed, set([node.id]))
+        self.assertNotIn(node.id, crawler.dirty)
+        self.assertEqual(crawler.get_stats()["departed"], 1)
+
+        crawler.save()
+        self.assertEqual(crawler.removed, set())
+        self.assertNotIn(node.getSerializedProto(), self.saved())
+
+    def test_drops_expired_nodes(self):
+        crawler = self.crawler(FakeProtocol(), expiry=3600)
+        crawler.add(self.nodes[0])
+        crawler.add(self.nodes[1])
+        crawler.save()
+
+        self.clock.advance(3601)
+        crawler.add(self.nodes[1])
+        crawler._missed(self.nodes[0])
+        crawler._missed(self.nodes[1])
+        self.assertEqual(crawler.removed, set([self.nodes[0].id]))
+        self.assertEqual(crawler.nodes[self.nodes[1].id][1], -1)
+
+        crawler.save()
+        self.assertEqual(self.saved(), {self.nodes[1].getSerializedProto(): (-1, 1000, 4601)})
+
+    def test_start_reloads_saved_nodes(self):
+        crawler = self.crawler(FakeProtocol())
+        for node in self.nodes[:3]:
+            crawler.add(node)
+        crawler.add(self.nodes[0])
+        crawler._missed(self.nodes[2])
+        crawler.stop()
+
+        self.clock.advance(60)
+        protocol = FakeProtocol()
+        crawler = self.crawler(protocol)
+        crawler.start()
+        self.assertEqual(sorted(crawler.nodes), sorted(node.id for node in self.nodes[:3]))
+        self.assertEqual([crawler.nodes[node.id][1:] for node in self.nodes[:3]],
+                         [[2, 1000, 1000], [1, 1000, 1000], [-1, 1000, 1000]])
+        self.assertEqual(sorted(node.id for node in crawler.get_nodes()),
+                         sorted(node.id for node in self.nodes[:2]))
+        self.assertEqual(crawler.nodes[self.nodes[0].id][0].getSerializedProto(),
+                         self.nodes[0].getSerializedProto())
+        # the reloaded live nodes seed the first crawl
+        self.assertEqual(len(protocol.finds), 2)
+        crawler.stop()
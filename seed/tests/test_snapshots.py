@@ -0,0 +1,114 @@
+import json
+
+import nacl.signing
+from twisted.internet import task
+from twisted.web import http
+from twisted.web.test.requesthelper import DummyRequest
+from twisted.trial import unittest
+
+from dht.node import Node
+from dht.utils import digest
+from protos.objects import FULL_CONE
+from seed import peers
+from seed.snapshots import SnapshotEngine, render, JSON, PROTOBUF, PEERS, VENDORS
+
+
+class FakeRequest(DummyRequest):
+    """
+    A `DummyRequest` which handles conditional requests the way a real one does.
+    """
+    method = "GET"
+    lastModified = None
+    setETag = http.Request.__dict__["setETag"]
+    setLastModified = http.Request.__dict__["setLastModified"]
+
+    def __init__(self, args=None, headers=None):
+        DummyRequest.__init__(self, [""])
+        self.args = args or {}
+        for name, value in (headers or {}).items():
+            self.requestHeaders.setRawHeaders(name, [value])
+
+
+class SnapshotEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.signing_key = nacl.signing.SigningKey.generate()
+        self.nodes = [Node(digest("node%s" % i), "127.0.0.%s" % i, 18466 + i, digest("key%s" % i), None, FULL_CONE,
+                           i % 2 == 0) for i in range(10)]
+        self.engine = SnapshotEngine(self.signing_key, lambda: self.nodes, rotations=3, interval=60, max_peers=4,
+                                     clock=self.clock)
+
+    def serialized(self, nodes):
+        return sorted(node.getSerializedProto() for node in nodes)
+
+    def peer_seeds(self, body):
+        proto = peers.PeerSeeds()
+        proto.ParseFromString(body.decode("zlib"))
+        self.signing_key.verify_key.verify("".join(proto.serializedNode), proto.signature)
+        return list(proto.serializedNode)
+
+    def test_get_rotates_through_snapshots(self):
+        self.engine.start()
+        first = [self.engine.get((PROTOBUF, PEERS)) for _ in range(3)]
+        self.assertEqual(len(set(id(snapshot) for snapshot in first)), 3)
+        self.assertIs(self.engine.get((PROTOBUF, PEERS)), first[0])
+        self.assertIs(self.engine.get((PROTOBUF, PEERS)), first[1])
+        for snapshot in first:
+            self.assertEqual(snapshot.timestamp, 1000)
+            self.assertEqual(len(self.peer_seeds(snapshot.body)), 4)
+            self.assertTrue(set(self.peer_seeds(snapshot.body)) <= set(self.serialized(self.nodes)))
+
+        self.clock.advance(60)
+        refreshed = self.engine.get((PROTOBUF, PEERS))
+        self.assertNotIn(refreshed, first)
+        self.assertEqual(refreshed.timestamp, 1060)
+        self.engine.stop()
+
+    def test_get_refreshes_when_empty(self):
+        snapshot = self.engine.get((JSON, VENDORS))
+        resp = json.loads(snapshot.body)
+        self.assertEqual(sorted(peer["guid"] for peer in resp["peers"]),
+                         sorted(node.id.encode("hex") for node in self.nodes if node.vendor))
+
+    def test_get_returns_the_snapshot_a_client_has(self):
+        snapshots = [self.engine.get((JSON, PEERS)) for _ in range(3)]
+        self.assertIs(self.engine.get((JSON, PEERS), [snapshots[1].etag]), snapshots[1])
+        self.assertIs(self.engine.get((JSON, PEERS), ["unknown"]), snapshots[0])
+
+    def test_render_not_modified(self):
+        request = FakeRequest()
+        body = render(self.engine, request)
+        etag = request.etag
+        self.assertEqual(self.peer_seeds(body), self.peer_seeds(self.engine.snapshots[(PROTOBUF, PEERS)][0].body))
+
+        request = FakeRequest(headers={"If-None-Match": etag})
+        self.assertEqual(render(self.engine, request), "")
+        self.assertEqual(request.responseCode, http.NOT_MODIFIED)
+
+        request = FakeRequest(headers={"If-Modified-Since": http.datetimeToString(1000)})
+        self.assertEqual(render(self.engine, request), "")
+        self.assertEqual(request.responseCode, http.NOT_MODIFIED)
+
+        self.clock.advance(60)
+        self.nodes = [Node(digest("other%s" % i), "127.0.1.%s" % i, 18466 + i, digest("key%s" % i), None, FULL_CONE)
+                      for i in range(10)]
+        self.engine.refresh()
+        request = FakeRequest(headers={"If-None-Match": etag, "If-Modified-Since": http.datetimeToString(1000)})
+        self.assertNotEqual(render(self.engine, request), "")
+        self.assertIsNone(request.responseCode)
+
+    def test_render_protobuf_vendors_serves_peers(self):
+        request = FakeRequest({"format": [PROTOBUF], "type": [VENDORS]})
+        body = render(self.engine, request)
+        self.assertEqual(body, self.engine.snapshots[(PROTOBUF, PEERS)][0].body)
+        self.assertNotIn(body, [snapshot.body for snapshot in self.engine.snapshots[(PROTOBUF, VENDORS)]])
+
+    def test_render_json(self):
+        resp = json.loads(render(self.engine, FakeRequest({"format": [JSON], "type": [VENDORS]})))
+        self.assertEqual(len(resp["peers"]), 5)
+        self.assertTrue(all("guid" in peer for peer in resp["peers"]))
+        resp = json.loads(render(self.engine, FakeRequest({"format": [JSON]})))
+        self.assertEqual(len(resp["peers"]), 4)
+        self.assertTrue(all("guid" not in peer for peer in resp["peers"]))
+        self.assertEqual(render(self.engine, FakeRequest({"format": ["xml"]})), "")